@@ -3,7 +3,7 @@
 from __future__ import print_function
 
 import os, sys, time, shutil, zipfile, subprocess, argparse, json, tempfile
-import hashlib, logging
+import re, hashlib, logging, multiprocessing
 
 try:
     from urllib2 import urlopen
@@ -14,6 +14,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--stack-name", default="lambda-scheduler-default", help="Name for the CloudFormation stack.")
 parser.add_argument("--clean", action="store_true", help="Remove all build artifacts first.")
 parser.add_argument("--build-lambda-functions-only", action="store_true", help="Just build the Lambda functions and exit.")
+parser.add_argument("--slim", action="store_true", help="Leave dependencies the Lambda runtime provides out of function packages.")
+parser.add_argument("--build-workers", type=int, default=None, help="Functions to build at once (default: one per CPU).")
 
 
 s3_lambda_upload_prefix = "lambda/"
@@ -24,9 +26,39 @@ build_dir = os.path.join(repo_dir, "build")
 deploy_venv_dir = os.path.join(build_dir, "deploy-venv")
 deploy_pip_dir = os.path.join(build_dir, "deploy-pip")
 functions_source_dir = os.path.join(repo_dir, "lambda/functions")
+shared_source_dir = os.path.join(repo_dir, "lambda/shared")
+dependency_cache_dir = os.path.join(build_dir, "dependency-cache")
+
+# Stack operations are polled this often while events are arriving, backing off
+# to stack_poll_max_seconds while they aren't.
+stack_poll_min_seconds = 2
+stack_poll_max_seconds = 15
+
+upload_multipart_threshold_bytes = 8 * 1024 * 1024
+
+# Provided by the Lambda runtime (boto3 and what it depends on), or not used by
+# any function (docutils), so left out of slim packages.
+runtime_provided_packages = ["boto3", "botocore", "s3transfer", "jmespath", "python-dateutil", "six", "docutils"]
+
+# The earliest time a zip can hold.
+reproducible_zip_date_time = (1980, 1, 1, 0, 0, 0)
 
 sys.path.insert(1, deploy_pip_dir)
 
+# The base stack is created before there's a bucket to hold the packaged
+# StackCleanupFunction, so it starts out with this instead. The bucket holds no
+# more than the deployment artifacts until the full stack replaces it.
+base_stack_cleanup_function_code = """
+import boto3, cfnresponse
+
+def lambda_handler(event, context):
+    if event.get("RequestType") == "Delete":
+        if boto3.resource("cloudformation").Stack(event["StackId"]).stack_status == "DELETE_IN_PROGRESS":
+            boto3.resource("s3").Bucket(event["ResourceProperties"]["SharedBucket"]).objects.all().delete()
+
+    cfnresponse.send(event, context, cfnresponse.SUCCESS, {}, None)
+""".lstrip()
+
 def create_deploy_virtualenv():
     
     import pip
@@ -128,9 +160,9 @@ def ensure_build_dir_exists():
         except:
             raise Exception("Error creating build directory at {}.".format(build_dir))
 
-def build_lambda_function_environments():
+def build_lambda_function_environments(max_workers=None, slim=False):
     
-    import checksumdir
+    from concurrent.futures import ProcessPoolExecutor
     
     function_source_dir_list = []
 
@@ -138,77 +170,243 @@ def build_lambda_function_environments():
         if dir_name != functions_source_dir:
             break
     
-        for each_subdir in subdir_list:
+        for each_subdir in sorted(subdir_list):
             function_source_dir_list.append(os.path.join(dir_name, each_subdir))
+    
+    # Each function builds in its own process; a failure in one fails the build.
+    with ProcessPoolExecutor(max_workers=max_workers or max(1, min(len(function_source_dir_list), multiprocessing.cpu_count()))) as executor:
+        for each_function_name in executor.map(build_lambda_function, function_source_dir_list, [slim] * len(function_source_dir_list)):
+            pass
+    
+    return function_source_dir_list
 
-    for each_function_source_dir in function_source_dir_list:
+def build_lambda_function(each_function_source_dir, slim=False):
     
-        each_function_name = each_function_source_dir.split("/")[-1]
-        
-        each_function_build_metadata_file_path = os.path.join(build_dir, "{}.json".format(each_function_name))
-        
-        each_function_previous_build_metadata = {
-            "source": "",
-            "zip": ""
-        }
-        
-        if os.path.exists(each_function_build_metadata_file_path):
-            each_function_previous_build_metadata = json.loads(open(each_function_build_metadata_file_path).read())
-        
-        source_dir_hash = checksumdir.dirhash(each_function_source_dir)
-        
-        zip_output_path = os.path.join(build_dir, "{}.zip".format(each_function_name))
+    import checksumdir
+    
+    each_function_name = each_function_source_dir.split("/")[-1]
+    
+    each_function_build_metadata_file_path = os.path.join(build_dir, "{}.json".format(each_function_name))
+    
+    each_function_previous_build_metadata = {
+        "source": "",
+        "zip": ""
+    }
+    
+    if os.path.exists(each_function_build_metadata_file_path):
+        each_function_previous_build_metadata = json.loads(open(each_function_build_metadata_file_path).read())
+    
+    source_dir_hash = checksumdir.dirhash(each_function_source_dir)
+    
+    # Shared modules are part of every function's package.
+    if os.path.isdir(shared_source_dir):
+        source_dir_hash = "{}-{}".format(source_dir_hash, checksumdir.dirhash(shared_source_dir))
+    
+    if slim:
+        source_dir_hash = "{}-slim".format(source_dir_hash)
+    
+    zip_output_path = os.path.join(build_dir, "{}.zip".format(each_function_name))
+    
+    if os.path.exists(zip_output_path):
+        if each_function_previous_build_metadata["source"] == source_dir_hash:
+            if file_sha256_checksum_for_lambda(zip_output_path) == each_function_previous_build_metadata["zip"]:
+                print("{} already built.".format(each_function_name))
+                return each_function_name
+    
+    print("Building Lambda function: {}".format(each_function_name))
+    
+    function_build_dir = os.path.join(build_dir, each_function_name)
+
+    if os.path.exists(function_build_dir):
+        shutil.rmtree(function_build_dir)
+    
+    pip_requirements_path = os.path.join(each_function_source_dir, "requirements.txt")
+    
+    requirements_lines = []
+    
+    if os.path.exists(pip_requirements_path):
+        requirements_lines = list(x.strip() for x in open(pip_requirements_path) if x.strip())
+    
+    if slim:
+        requirements_lines = list(x for x in requirements_lines if requirement_name(x) not in runtime_provided_packages)
+    
+    # Dependencies go in first, so the function's own files win any clash.
+    if len(requirements_lines) > 0:
+        shutil.copytree(install_dependencies("\n".join(requirements_lines) + "\n"), function_build_dir)
+    
+    copy_tree_into(each_function_source_dir, function_build_dir)
+    
+    if os.path.isdir(shared_source_dir):
+        copy_tree_into(shared_source_dir, function_build_dir)
+    
+    write_reproducible_zip(function_build_dir, zip_output_path)
+    
+    new_build_metadata = {
+        "source": source_dir_hash,
+        "zip": file_sha256_checksum_for_lambda(zip_output_path),
+        "slim": slim,
+        "package-bytes": os.path.getsize(zip_output_path),
+        "cold-import-seconds": measure_cold_import_seconds(function_build_dir)
+    }
+    
+    open(each_function_build_metadata_file_path, "w").write(json.dumps(new_build_metadata, indent=4))
+
+    print("Successfully built Lambda function: {}. {}".format(
+        each_function_name,
+        build_comparison(each_function_previous_build_metadata, new_build_metadata)
+    ))
+    
+    return each_function_name
+
+def requirement_name(requirement_line):
+    return re.split(r"[<>=!~;\[ ]", requirement_line, 1)[0].lower()
+
+def measure_cold_import_seconds(function_build_dir, runs=3):
+    
+    '''
+        Returns the median time taken to import the function's module in a new
+        interpreter, or None if it can't be imported here. Anything left out of
+        a slim package is imported from this environment, as it would be from
+        the runtime's.
+    '''
+    
+    import_timings = []
+    
+    for _ in range(runs):
+        p = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, time; sys.path.insert(0, sys.argv[1]); started = time.time(); import index; print(time.time() - started)",
+                function_build_dir
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
         
-        if os.path.exists(zip_output_path):
-            if each_function_previous_build_metadata["source"] == source_dir_hash:
-                if file_sha256_checksum_for_lambda(zip_output_path) == each_function_previous_build_metadata["zip"]:
-                    print("{} already built.".format(each_function_name))
-                    continue
+        p_stdout, p_stderr = p.communicate()
         
-        print("Building Lambda function: {}".format(each_function_name))
+        if p.returncode != 0:
+            return None
         
-        function_build_dir = os.path.join(build_dir, each_function_name)
+        import_timings.append(float(p_stdout.decode("utf-8").strip().splitlines()[-1]))
+    
+    return round(sorted(import_timings)[len(import_timings) // 2], 4)
+
+def build_comparison(previous_build_metadata, new_build_metadata):
+    
+    def describe(build_metadata):
+        return "{} bytes, {} cold import".format(
+            build_metadata.get("package-bytes", "?"),
+            "?" if build_metadata.get("cold-import-seconds") is None else "{:.3f}s".format(build_metadata["cold-import-seconds"])
+        )
+    
+    if "package-bytes" not in previous_build_metadata:
+        return describe(new_build_metadata)
+    
+    return "{} (was {})".format(describe(new_build_metadata), describe(previous_build_metadata))
+
+def install_dependencies(requirements_text):
+    
+    '''
+        Returns a directory holding the dependencies in requirements_text,
+        installing them only if no function has already installed the same
+        requirements (with this Python version).
+    '''
     
-        if os.path.exists(function_build_dir):
-            shutil.rmtree(function_build_dir)
+    requirements_hash = hashlib.sha256(
+        (requirements_text + sys.version).encode("utf-8")
+    ).hexdigest()
     
-        shutil.copytree(each_function_source_dir, function_build_dir)
+    dependencies_dir = os.path.join(dependency_cache_dir, requirements_hash)
     
-        pip_requirements_path = os.path.join(function_build_dir, "requirements.txt")
+    if os.path.isdir(dependencies_dir):
+        return dependencies_dir
     
-        if os.path.exists(pip_requirements_path):
+    if not os.path.isdir(dependency_cache_dir):
+        try:
+            os.makedirs(dependency_cache_dir)
+        except OSError:
             
-            print("Installing dependencies.")
-            p = subprocess.Popen(
-                ["pip", "install", "-r", pip_requirements_path, "-t", function_build_dir],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-        
-            exit_code = p.wait()
-            p_stdout, p_stderr = p.communicate()
+            # Made by a build running in parallel.
+            pass
+    
+    install_dir = tempfile.mkdtemp(dir=dependency_cache_dir)
+    
+    pip_requirements_path = "{}.txt".format(install_dir)
+    open(pip_requirements_path, "w").write(requirements_text)
+    
+    print("Installing dependencies.")
+    
+    # Not compiled, as .pyc files embed timestamps.
+    p = subprocess.Popen(
+        ["pip", "install", "--no-compile", "-r", pip_requirements_path, "-t", install_dir],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    p_stdout, p_stderr = p.communicate()
+    
+    os.unlink(pip_requirements_path)
+
+    if p.returncode != 0:
+        shutil.rmtree(install_dir)
+        print("pip invocation failed.", file=sys.stderr)
+        print(p_stderr, file=sys.stderr)
+        sys.exit(1)
+    
+    try:
+        os.rename(install_dir, dependencies_dir)
+    except OSError:
         
-            if exit_code != 0:
-                print("pip invocation failed.", file=sys.stderr)
-                print(p_stderr, file=sys.stderr)
-                sys.exit(1)
+        # Another build installed the same requirements first.
+        shutil.rmtree(install_dir)
     
-        build_zip_path = os.path.join(build_dir, each_function_name)
-        if os.path.exists("{}.zip".format(build_zip_path)):
-            os.unlink("{}.zip".format(build_zip_path))
+    return dependencies_dir
+
+def copy_tree_into(source_dir, destination_dir):
     
-        shutil.make_archive(build_zip_path, "zip", function_build_dir)
+    for dir_name, subdir_list, file_list in os.walk(source_dir):
+        each_destination_dir = os.path.join(destination_dir, os.path.relpath(dir_name, source_dir))
         
-        new_build_metadata = {
-            "source": source_dir_hash,
-            "zip": file_sha256_checksum_for_lambda(zip_output_path)
-        }
+        if not os.path.isdir(each_destination_dir):
+            os.makedirs(each_destination_dir)
+        
+        for each_file_name in file_list:
+            shutil.copy2(os.path.join(dir_name, each_file_name), os.path.join(each_destination_dir, each_file_name))
+
+def write_reproducible_zip(source_dir, zip_path):
+    
+    '''
+        Zips source_dir so that the same files always give the same bytes:
+        entries in sorted order, with fixed timestamps and permissions, and
+        without compiled files.
+    '''
+    
+    file_paths = []
+    
+    for dir_name, subdir_list, file_list in os.walk(source_dir):
+        subdir_list[:] = list(x for x in subdir_list if x != "__pycache__")
         
-        open(each_function_build_metadata_file_path, "w").write(json.dumps(new_build_metadata, indent=4))
+        for each_file_name in file_list:
+            if not each_file_name.endswith((".pyc", ".pyo")):
+                file_paths.append(os.path.join(dir_name, each_file_name))
+    
+    temp_zip_path = "{}.tmp".format(zip_path)
+    
+    with zipfile.ZipFile(temp_zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for each_arcname, each_file_path in sorted((os.path.relpath(x, source_dir).replace(os.sep, "/"), x) for x in file_paths):
+            each_zip_info = zipfile.ZipInfo(each_arcname, date_time=reproducible_zip_date_time)
+            each_zip_info.compress_type = zipfile.ZIP_DEFLATED
+            each_zip_info.create_system = 3
+            each_zip_info.external_attr = (0o100755 if os.access(each_file_path, os.X_OK) else 0o100644) << 16
+            
+            zip_file.writestr(each_zip_info, open(each_file_path, "rb").read())
     
-        print("Successfully built Lambda function: {}.".format(each_function_name))
+    if os.path.exists(zip_path):
+        os.unlink(zip_path)
     
-    return function_source_dir_list
+    os.rename(temp_zip_path, zip_path)
 
 
 def create_base_cloudformation_stack(cf_stack_name):
@@ -228,7 +426,7 @@ def create_base_cloudformation_stack(cf_stack_name):
             del cf_template_object[each_key]
 
     for each_key in cf_template_object.get("Parameters", {}).keys():
-        if each_key != "LogRetentionDays":
+        if each_key not in ["LogRetentionDays", "IdempotencyRetentionDays"]:
             del cf_template_object["Parameters"][each_key]
 
     for each_key in cf_template_object.get("Outputs", {}).keys():
@@ -251,6 +449,10 @@ def create_base_cloudformation_stack(cf_stack_name):
         if each_key not in base_resources_list:
             del cf_template_object["Resources"][each_key]
 
+    cf_template_object["Resources"]["StackCleanupFunction"]["Properties"]["Code"] = {
+        "ZipFile": base_stack_cleanup_function_code
+    }
+
     cf_template_object["Description"] = "Initial Deployment: {}".format(cf_template_object["Description"])
 
     cloudformation_client = boto3.client("cloudformation")
@@ -264,98 +466,258 @@ def create_base_cloudformation_stack(cf_stack_name):
 
     print("New CloudFormation Stack ID: {}".format(stack_id))
 
-    last_status = "CREATE_IN_PROGRESS"
-    s3_bucket_name = None
+    this_stack = wait_for_stack(stack_id, "CREATE_COMPLETE")
+    
+    s3_bucket_name = get_stack_output(this_stack, "SharedBucket")
 
-    while True:
-        response = cloudformation_client.describe_stacks(
-            StackName = stack_id
-        )
+    if s3_bucket_name is None:
+        raise Exception("Unabled to find shared S3 bucket name in stack outputs.")
     
-        this_stack = response["Stacks"][0]
+    print("Shared S3 bucket: {}".format(s3_bucket_name))
     
-        last_status = this_stack["StackStatus"]
+    return stack_id, s3_bucket_name
+
+def get_existing_stack(cf_stack_name):
+    
+    '''
+        Returns the stack ID and shared bucket of an already deployed stack, or
+        None if there's no stack by that name.
+    '''
+    
+    try:
+        this_stack = boto3.client("cloudformation").describe_stacks(
+            StackName = cf_stack_name
+        )["Stacks"][0]
+    except botocore.exceptions.ClientError as e:
+        if "does not exist" in e.response["Error"]["Message"]:
+            return None
+        raise
+    
+    if this_stack["StackStatus"] not in ["CREATE_COMPLETE", "UPDATE_COMPLETE", "UPDATE_ROLLBACK_COMPLETE"]:
+        raise Exception("Stack {} can't be updated in its current status: {}".format(cf_stack_name, this_stack["StackStatus"]))
+    
+    s3_bucket_name = get_stack_output(this_stack, "SharedBucket")
+    
+    if s3_bucket_name is None:
+        raise Exception("Unabled to find shared S3 bucket name in stack outputs.")
+    
+    print("Existing CloudFormation Stack ID: {}".format(this_stack["StackId"]))
+    print("Shared S3 bucket: {}".format(s3_bucket_name))
+    
+    return this_stack["StackId"], s3_bucket_name
+
+def get_stack_output(this_stack, output_key):
     
-        print(" > Stack status: {}".format(last_status))
+    for each_output_pair in this_stack.get("Outputs", []):
+        if each_output_pair["OutputKey"] == output_key:
+            return each_output_pair["OutputValue"]
     
-        if last_status != "CREATE_IN_PROGRESS":
-            for each_output_pair in this_stack.get("Outputs", []):
-                if each_output_pair["OutputKey"] == "SharedBucket":
-                    s3_bucket_name = each_output_pair["OutputValue"]
-                    break
+    return None
+
+def wait_for_stack(stack_id, expected_status, seen_event_ids=None):
+    
+    '''
+        Waits for the stack's current operation to finish, printing its events as
+        they arrive. Polls every stack_poll_min_seconds while events are arriving,
+        backing off to stack_poll_max_seconds while they aren't. Events in
+        seen_event_ids (from earlier operations) aren't printed.
+    '''
+    
+    cloudformation_client = boto3.client("cloudformation")
+    
+    if seen_event_ids is None:
+        seen_event_ids = set()
+    
+    poll_seconds = stack_poll_min_seconds
+    
+    while True:
+        new_events = list_new_stack_events(stack_id, seen_event_ids)
+        
+        for each_event in new_events:
+            print(" > {} {}: {}{}".format(
+                each_event["ResourceType"],
+                each_event["LogicalResourceId"],
+                each_event["ResourceStatus"],
+                " ({})".format(each_event["ResourceStatusReason"]) if each_event.get("ResourceStatusReason") else ""
+            ))
         
+        this_stack = cloudformation_client.describe_stacks(
+            StackName = stack_id
+        )["Stacks"][0]
+        
+        last_status = this_stack["StackStatus"]
+        
+        if not last_status.endswith("_IN_PROGRESS"):
             break
+        
+        if len(new_events) > 0:
+            poll_seconds = stack_poll_min_seconds
+        else:
+            poll_seconds = min(poll_seconds * 2, stack_poll_max_seconds)
+        
+        time.sleep(poll_seconds)
     
-        time.sleep(10)
-
-    if last_status != "CREATE_COMPLETE":
+    print(" > Stack status: {}".format(last_status))
+    
+    if last_status != expected_status:
         raise Exception("Stack reached unexpected status: {}".format(last_status))
+    
+    return this_stack
 
-    if s3_bucket_name is None:
-        raise Exception("Unabled to find shared S3 bucket name in stack outputs.")
+def list_new_stack_events(stack_id, seen_event_ids):
     
-    print("Shared S3 bucket: {}".format(s3_bucket_name))
+    '''
+        Returns the stack's events that aren't in seen_event_ids, oldest first,
+        and adds them to it.
+    '''
     
-    return stack_id, s3_bucket_name
+    new_events = []
+    
+    # Newest first, so only the pages up to the first seen event are read.
+    paginator = boto3.client("cloudformation").get_paginator("describe_stack_events")
+    
+    for each_page in paginator.paginate(StackName=stack_id):
+        each_page_events = list(x for x in each_page["StackEvents"] if x["EventId"] not in seen_event_ids)
+        new_events.extend(each_page_events)
+        
+        if len(each_page_events) < len(each_page["StackEvents"]):
+            break
+    
+    seen_event_ids.update(x["EventId"] for x in new_events)
+    
+    return list(reversed(new_events))
 
 def upload_lambda_function_deployment_packages(s3_bucket_name, function_source_dir_list):
 
-    s3_client = boto3.client("s3")
-    s3_client.put_object(
-        Body = open(cf_template_path),
-        Bucket = s3_bucket_name,
-        Key = s3_template_upload_key
-    )
+    '''
+        Uploads the template and the function packages, concurrently, skipping
+        any whose content hash matches the one stored with the bucket's copy.
+        Returns the names of the functions whose packages were uploaded.
+    '''
 
-    for each_function_source_dir in function_source_dir_list:
-    
-        each_function_name = each_function_source_dir.split("/")[-1]
+    from concurrent.futures import ThreadPoolExecutor
+    from boto3.s3.transfer import TransferConfig
+
+    s3_client = boto3.client("s3")
     
-        build_zip_path = os.path.join(build_dir, each_function_name)
+    # Large packages are uploaded in parts, several at once.
+    transfer_config = TransferConfig(multipart_threshold=upload_multipart_threshold_bytes)
     
-        print("Uploading {}.zip.".format(each_function_name))
+    upload_list = [(cf_template_path, s3_template_upload_key, None)]
     
-        s3_client.put_object(
-            Body = open("{}.zip".format(build_zip_path)),
-            Bucket = s3_bucket_name,
-            Key = "lambda/{}.zip".format(each_function_name)
+    for each_function_source_dir in function_source_dir_list:
+        each_function_name = each_function_source_dir.split("/")[-1]
+        
+        upload_list.append((
+            os.path.join(build_dir, "{}.zip".format(each_function_name)),
+            "{}{}.zip".format(s3_lambda_upload_prefix, each_function_name),
+            each_function_name
+        ))
+    
+    def upload_each(each_upload):
+        each_path, each_key, each_function_name = each_upload
+        
+        each_sha256 = file_sha256_hexdigest(each_path)
+        
+        try:
+            each_metadata = s3_client.head_object(
+                Bucket = s3_bucket_name,
+                Key = each_key
+            ).get("Metadata", {})
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+                raise
+            each_metadata = {}
+        
+        if each_metadata.get("sha256") == each_sha256:
+            print("{} unchanged.".format(each_key))
+            return None
+        
+        print("Uploading {}.".format(each_key))
+        
+        s3_client.upload_file(
+            each_path,
+            s3_bucket_name,
+            each_key,
+            ExtraArgs = {
+                "Metadata": {
+                    "sha256": each_sha256
+                }
+            },
+            Config = transfer_config
         )
+        
+        return each_function_name
+    
+    with ThreadPoolExecutor(max_workers=len(upload_list)) as executor:
+        uploaded_names = list(executor.map(upload_each, upload_list))
+    
+    return list(x for x in uploaded_names if x is not None)
 
 def update_base_stack_to_full_stack(stack_id, s3_bucket_name):
 
+    '''
+        Updates the stack to the full template, whether it's the base stack just
+        created or a stack deployed before. Does nothing if nothing's changed.
+    '''
+
     print("Updating stack's template with full content.")
     
+    # Only this update's events are printed.
+    seen_event_ids = set()
+    list_new_stack_events(stack_id, seen_event_ids)
+    
     cloudformation_client = boto3.client("cloudformation")
-    cloudformation_client.update_stack(
-        StackName = stack_id,
-        TemplateURL = "https://s3.amazonaws.com/{}/{}".format(
-            s3_bucket_name,
-            s3_template_upload_key
-        ),
-        UsePreviousTemplate = False,
-        Capabilities = ["CAPABILITY_IAM"]
-    )
+    
+    try:
+        cloudformation_client.update_stack(
+            StackName = stack_id,
+            TemplateURL = "https://s3.amazonaws.com/{}/{}".format(
+                s3_bucket_name,
+                s3_template_upload_key
+            ),
+            UsePreviousTemplate = False,
+            Capabilities = ["CAPABILITY_IAM"]
+        )
+    except botocore.exceptions.ClientError as e:
+        if "No updates are to be performed" in e.response["Error"]["Message"]:
+            print("Stack already up to date.")
+            return
+        raise
 
-    last_status = "UPDATE_IN_PROGRESS"
+    wait_for_stack(stack_id, "UPDATE_COMPLETE", seen_event_ids)
 
-    while True:
-        response = cloudformation_client.describe_stacks(
-            StackName = stack_id
-        )
-    
-        this_stack = response["Stacks"][0]
-    
-        last_status = this_stack["StackStatus"]
+def update_lambda_function_code(stack_id, s3_bucket_name, function_names):
     
-        print(" > Stack status: {}".format(last_status))
+    '''
+        Points already deployed functions at their new packages, which the stack
+        can't tell have changed since they're always at the same key.
+    '''
     
-        if last_status not in ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"]:
-            break
+    cloudformation_client = boto3.client("cloudformation")
+    lambda_client = boto3.client("lambda")
     
-        time.sleep(10)
+    for each_function_name in function_names:
+        each_physical_resource_id = cloudformation_client.describe_stack_resource(
+            StackName = stack_id,
+            LogicalResourceId = each_function_name
+        )["StackResourceDetail"]["PhysicalResourceId"]
+        
+        print("Updating code of {}.".format(each_function_name))
+        
+        lambda_client.update_function_code(
+            FunctionName = each_physical_resource_id,
+            S3Bucket = s3_bucket_name,
+            S3Key = "{}{}.zip".format(s3_lambda_upload_prefix, each_function_name)
+        )
 
-    if last_status != "UPDATE_COMPLETE":
-        raise Exception("Stack reached unexpected status: {}".format(last_status))
+def file_sha256_hexdigest(fname):
+    hash_sha256 = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            hash_sha256.update(chunk)
+    
+    return hash_sha256.hexdigest()
 
 def file_sha256_checksum_for_lambda(fname):
     hash_sha256 = hashlib.sha256()
@@ -376,22 +738,31 @@ if __name__ == "__main__":
     
     verify_deploy_env()
     
-    function_source_dir_list = build_lambda_function_environments()
+    function_source_dir_list = build_lambda_function_environments(args.build_workers, args.slim)
     
     if args.build_lambda_functions_only:
         sys.exit(0)
         
-    import boto3, yaml
+    import boto3, botocore, yaml
     
     logging.getLogger('boto3').setLevel(logging.WARNING)
     logging.getLogger('botocore').setLevel(logging.WARNING)
     
     verify_aws_credentials_set()
     
-    stack_id, s3_bucket_name = create_base_cloudformation_stack(args.stack_name)
+    existing_stack = get_existing_stack(args.stack_name)
+    
+    if existing_stack is None:
+        stack_id, s3_bucket_name = create_base_cloudformation_stack(args.stack_name)
+    else:
+        stack_id, s3_bucket_name = existing_stack
     
-    upload_lambda_function_deployment_packages(s3_bucket_name, function_source_dir_list)
+    uploaded_function_names = upload_lambda_function_deployment_packages(s3_bucket_name, function_source_dir_list)
     
     update_base_stack_to_full_stack(stack_id, s3_bucket_name)
     
+    # New stacks were just created from these packages.
+    if existing_stack is not None:
+        update_lambda_function_code(stack_id, s3_bucket_name, uploaded_function_names)
+    
     print("Deploy complete.")
\ No newline at end of file
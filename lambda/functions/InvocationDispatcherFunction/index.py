@@ -0,0 +1,1190 @@
+from __future__ import print_function
+
+import os, json, time, threading, uuid, collections
+import boto3, botocore
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from lambda_scheduler import keys, records, segments, storage, payloads, recurrence, schedule_index, timing_wheel, rate_limits, leases
+
+# Each pointer costs a GET, an invoke, a COPY and a DELETE, so throughput is
+# mostly a function of how many of those are in flight at once.
+dispatch_max_workers = int(os.environ.get("DISPATCH_MAX_WORKERS", 64))
+
+# Scheduled once a minute, each invocation keeps ticking every second for this
+# long so due invocations don't wait for the next scheduled run.
+#
+# The stack reserves a concurrency of 1 for this function, so a schedule
+# delivered twice, or a run that's slow to finish, queues the next run behind
+# the current one rather than having two list and invoke the same pointers.
+# (Several dispatchers only share the queue through a lease store.) Even so,
+# delivery is at least once: a pointer is moved to dispatched/ after its
+# invoke, so one whose run dies in between is invoked again by the next.
+dispatch_run_seconds = int(os.environ.get("DISPATCH_RUN_SECONDS", 55))
+
+# How many minutes ahead pointers are listed into a timing wheel, so each is
+# fired on its second rather than after the tick that lists it. 0 lists due
+# pointers on each tick instead.
+#
+# Pointers can be written into a minute after it's been prefetched (anything
+# queued less than the horizon ahead), so the current minute is listed again
+# on every tick; that's when they're due. Everything else listed after its
+# minute was prefetched is only listed again every dispatch_rescan_seconds:
+# past-due pointers, which writers put in the previous minute's bucket, ones
+# whose invoke failed or was deferred, and what's left of segments.
+dispatch_prefetch_minutes = int(os.environ.get("DISPATCH_PREFETCH_MINUTES", 2))
+dispatch_rescan_seconds = int(os.environ.get("DISPATCH_RESCAN_SECONDS", 15))
+
+# Limits on how hard each target function is invoked (see rate_limits.py).
+# DISPATCH_TARGET_LIMITS holds limits by function name or ARN, e.g.
+# {"SendReminder": {"max-concurrency": 20, "rate-per-second": 100}}, and the
+# defaults apply to every other target (0 for no limit). A tick waits up to
+# dispatch_limit_wait_seconds for targets at their limits, then leaves what's
+# left for the next tick.
+dispatch_target_limits = json.loads(os.environ.get("DISPATCH_TARGET_LIMITS") or "{}")
+dispatch_default_limits = {
+    "max-concurrency": int(os.environ.get("DISPATCH_TARGET_MAX_CONCURRENCY", 0)) or None,
+    "rate-per-second": float(os.environ.get("DISPATCH_TARGET_RATE_PER_SECOND", 0)) or None
+}
+dispatch_limit_wait_seconds = float(os.environ.get("DISPATCH_LIMIT_WAIT_SECONDS", 1))
+
+# Pointers in buckets more than dispatch_catch_up_after_seconds old are
+# overdue (dispatch stopped for a while, say), and are drained oldest first in
+# catch-up mode: in batches of up to dispatch_catch_up_max_workers, for up to
+# dispatch_catch_up_tick_seconds of each second (at least a batch a tick),
+# leaving the rest of it to on-time work. 0 dispatches overdue pointers along
+# with everything else.
+dispatch_catch_up_after_seconds = int(os.environ.get("DISPATCH_CATCH_UP_AFTER_SECONDS", 120))
+dispatch_catch_up_max_workers = int(os.environ.get("DISPATCH_CATCH_UP_MAX_WORKERS", 16))
+dispatch_catch_up_tick_seconds = float(os.environ.get("DISPATCH_CATCH_UP_TICK_SECONDS", 0.5))
+
+# Pointers later than this (or their schedule's "max-staleness-seconds") aren't
+# invoked, but set aside under failed/. 0 invokes them however late.
+dispatch_max_staleness_seconds = int(os.environ.get("DISPATCH_MAX_STALENESS_SECONDS", 0))
+
+# Only used when migrating, and to name the partitions leased; new pointers
+# are sharded by the queuer.
+queue_shard_count = int(os.environ.get("QUEUE_SHARD_COUNT", keys.default_shard_count))
+
+# Set to have several dispatchers share the queue, each taking a share of its
+# shards through expiring leases in this store (see leases.py), e.g.
+# "sqlite:/mnt/shared/leases.db" or "file:/mnt/shared/leases". Unset, one
+# dispatcher handles every shard.
+dispatch_lease_store = os.environ.get("DISPATCH_LEASE_STORE", "")
+dispatch_lease_seconds = int(os.environ.get("DISPATCH_LEASE_SECONDS", 30))
+
+# Whether to keep draining pointers written under the original
+# queued/<execution-time>/ layout. Can be turned off once they've all been
+# dispatched or moved with a "migrate-legacy-pointers" event.
+dispatch_legacy_layout = os.environ.get("DISPATCH_LEGACY_LAYOUT", "true").lower() == "true"
+
+# Stored payloads larger than an asynchronous invoke accepts are handed over by
+# reference, and kept for payload_hold_seconds so the function can read them.
+invoke_payload_limit_bytes = int(os.environ.get("INVOKE_PAYLOAD_LIMIT_BYTES", 256 * 1000))
+payload_hold_seconds = int(os.environ.get("PAYLOAD_HOLD_SECONDS", 24 * 60 * 60))
+
+# How far ahead occurrences of recurring schedules are written. Each run expands
+# the series that are due, so this must be well over a minute.
+recurrence_horizon_seconds = int(os.environ.get("RECURRENCE_HORIZON_SECONDS", 15 * 60))
+
+boto3_clients = {}
+boto3_clients_lock = threading.Lock()
+
+def get_boto3_client(service_name):
+
+    if service_name not in boto3_clients:
+        with boto3_clients_lock:
+            if service_name not in boto3_clients:
+                boto3_clients[service_name] = boto3.client(
+                    service_name,
+                    config = Config(max_pool_connections=dispatch_max_workers)
+                )
+
+    return boto3_clients[service_name]
+
+# Stand in for the result of an invoke: one a tick ran out of time for, one
+# claimed by a worker that held the lease before, one whose lease was lost, and
+# one too late to be wanted.
+deferred = object()
+claimed_elsewhere = object()
+lease_lost = object()
+stale = object()
+
+# Overdue pointers are listed this many batches at a time, and progress
+# draining them is logged this often.
+catch_up_listed_batches = 8
+catch_up_report_seconds = 10
+
+def summarize_seconds(seconds):
+
+    sorted_seconds = sorted(seconds)
+
+    def percentile(p):
+        if len(sorted_seconds) == 0:
+            return None
+        return round(sorted_seconds[min(len(sorted_seconds) - 1, int(len(sorted_seconds) * p))], 3)
+
+    return {
+        "p50": percentile(0.5),
+        "p99": percentile(0.99),
+        "max": percentile(1.0)
+    }
+
+class DispatchStats(object):
+
+    def __init__(self):
+        self.dispatched_count = 0
+        self.failed_count = 0
+        self.stale_count = 0
+        self.lags = []
+        self.targets = {}
+        self.catch_up = None
+        self._lock = threading.Lock()
+
+    def record_dispatched(self, lag_seconds):
+        with self._lock:
+            self.dispatched_count += 1
+            self.lags.append(lag_seconds)
+
+    def record_failed(self):
+        with self._lock:
+            self.failed_count += 1
+
+    def record_stale(self):
+        with self._lock:
+            self.stale_count += 1
+
+    def record_catch_up(self, catch_up_summary):
+        with self._lock:
+            self.catch_up = catch_up_summary
+
+    def record_target(self, function_arn, queue_seconds=None, throttled=False, deferred=False):
+
+        '''
+            Records an invoke of function_arn (after queue_seconds waiting on
+            its limits), or one it throttled, or one deferred to the next tick.
+        '''
+
+        with self._lock:
+            target_stats = self.targets.setdefault(function_arn, {
+                "invoked-count": 0,
+                "throttled-count": 0,
+                "deferred-count": 0,
+                "queue-seconds": []
+            })
+
+            if throttled:
+                target_stats["throttled-count"] += 1
+            elif deferred:
+                target_stats["deferred-count"] += 1
+            else:
+                target_stats["invoked-count"] += 1
+                target_stats["queue-seconds"].append(queue_seconds)
+
+    def summary(self):
+
+        target_summaries = {}
+
+        for each_function_arn, each_target_stats in self.targets.items():
+            target_summaries[each_function_arn] = dict(each_target_stats)
+            target_summaries[each_function_arn]["queue-seconds"] = summarize_seconds(each_target_stats["queue-seconds"])
+
+        return {
+            "dispatched-count": self.dispatched_count,
+            "failed-count": self.failed_count,
+            "stale-count": self.stale_count,
+            "dispatch-lag-seconds": summarize_seconds(self.lags),
+            "targets": target_summaries,
+            "catch-up": self.catch_up
+        }
+
+class CatchUpProgress(object):
+
+    '''
+        How fast the backlog of overdue pointers is draining, and so roughly
+        how long what's left of it will take. What's left is estimated from the
+        overdue minutes not yet listed, at the keys per minute listed so far.
+    '''
+
+    def __init__(self, started):
+        self.started = started
+        self.reported = started
+        self.drained_count = 0
+        self.listed_count = 0
+        self.listed_minute_count = 0
+        self.unlisted_minute_count = 0
+        self.drained_through_epoch = None
+
+    def record_listed(self, listed_count, listed_minute_count, unlisted_minute_count):
+        self.listed_count += listed_count
+        self.listed_minute_count += listed_minute_count
+        self.unlisted_minute_count = unlisted_minute_count
+
+    def record_drained(self, drained_count, drained_through_epoch):
+        self.drained_count += drained_count
+        self.drained_through_epoch = drained_through_epoch
+
+    def overdue_count(self, queued_count):
+        return queued_count + int(self.unlisted_minute_count * self.listed_count / float(max(1, self.listed_minute_count)))
+
+    def estimated_drain_seconds(self, queued_count, now):
+
+        if self.drained_count == 0 or now <= self.started:
+            return None
+
+        return round(self.overdue_count(queued_count) / (self.drained_count / (now - self.started)), 1)
+
+    def summary(self, queued_count, now):
+        return {
+            "drained-count": self.drained_count,
+            "overdue-count": self.overdue_count(queued_count),
+            "behind-seconds": None if self.drained_through_epoch is None else round(now - self.drained_through_epoch, 1),
+            "estimated-drain-seconds": self.estimated_drain_seconds(queued_count, now)
+        }
+
+class LambdaHandler(object):
+
+    def __init__(self, context):
+        self._storage_lock = threading.Lock()
+        self.series_versions = {}
+        self.clock = timing_wheel.SystemClock()
+        self.deferred_pointer_contents = {}
+        self.worker_id = "{}".format(uuid.uuid4())
+        self.owned_partitions = None
+        self.catch_up_keys = collections.deque()
+        self.catch_up_progress = None
+
+    def handle_event(self, event, context):
+        print("Received event: {}".format(json.dumps(event)))
+
+        if "warming" in event:
+            get_boto3_client("s3")
+            get_boto3_client("lambda")
+
+            return {
+                "message": "Function warmed successfully."
+            }
+
+        if "migrate-legacy-pointers" in event:
+            migrated_count = self.migrate_legacy_pointers()
+            
+            return {
+                "message": "Migrated {} pointer(s) to the sharded layout.".format(migrated_count)
+            }
+
+        run_started = self.clock.time()
+        stats = DispatchStats()
+
+        # Pointers may have changed since a previous run deferred or listed them.
+        self.deferred_pointer_contents = {}
+        self.catch_up_keys = collections.deque()
+        self.catch_up_progress = None
+
+        try:
+            swept_count = self.get_payload_store().sweep(run_started)
+            if swept_count > 0:
+                print("Deleted {} released payload(s).".format(swept_count))
+        except Exception as e:
+            print("Error sweeping released payloads: {}".format(e))
+
+        try:
+            occurrence_count = recurrence.RecurrenceExpander(self.get_storage(), recurrence_horizon_seconds, queue_shard_count).expand_due(run_started)
+            if occurrence_count > 0:
+                print("Wrote {} occurrence(s) of recurring schedules.".format(occurrence_count))
+        except Exception as e:
+            print("Error expanding recurring schedules: {}".format(e))
+
+        try:
+            with ThreadPoolExecutor(max_workers=dispatch_max_workers) as executor:
+                if dispatch_prefetch_minutes > 0:
+                    self.run_timing_wheel(executor, stats, context, run_started)
+                else:
+                    self.run_polling(executor, stats, context, run_started)
+        finally:
+            self.release_leases()
+
+        summary = stats.summary()
+
+        print("Dispatch summary: {}".format(json.dumps(summary)))
+
+        summary["message"] = "Dispatched {} Lambda invocation(s).".format(stats.dispatched_count)
+
+        return summary
+
+    def is_run_over(self, context, run_started, now):
+        return now - run_started + 1 >= dispatch_run_seconds or context.get_remaining_time_in_millis() < 10000
+
+    def sleep_until_next_second(self):
+
+        # The next second boundary is the resolution of the keys.
+        self.clock.sleep(1 - (self.clock.time() % 1))
+
+    def run_polling(self, executor, stats, context, run_started):
+
+        while True:
+            tick_started = self.clock.time()
+
+            self.maintain_leases()
+            self.dispatch_due_invocations(executor, stats)
+            self.catch_up(executor, stats, int(tick_started) + dispatch_catch_up_tick_seconds)
+
+            if self.is_run_over(context, run_started, self.clock.time()):
+                break
+
+            self.sleep_until_next_second()
+
+    def run_timing_wheel(self, executor, stats, context, run_started):
+
+        '''
+            Fires the pointers in a timing wheel as each second comes round,
+            listing each minute into it as the horizon reaches it. Listing
+            happens after firing, so it doesn't hold up what's due.
+        '''
+
+        wheel = timing_wheel.TimingWheel(run_started, dispatch_prefetch_minutes)
+        prefetched_minute = None
+        rescanned = None
+
+        while True:
+
+            # Partitions taken on have to be listed over the whole horizon.
+            if self.maintain_leases():
+                prefetched_minute = None
+
+            now = self.clock.time()
+
+            self.dispatch_wheel_entries(wheel.advance(now), executor, stats, now)
+
+            now_minute = keys.epoch_to_minute_string(now)
+            horizon_minute = keys.epoch_to_minute_string(wheel.horizon_epoch)
+
+            if rescanned is None or int(now) - int(rescanned) >= dispatch_rescan_seconds:
+                rescanned = now
+                self.prefetch_pointer_keys(wheel, executor, self.catch_up_boundary_minute(now), now_minute, now)
+
+                if dispatch_legacy_layout:
+                    for each_key in self.list_due_legacy_pointer_keys(now):
+                        wheel.add(now, each_key)
+            else:
+                self.prefetch_pointer_keys(wheel, executor, keys.epoch_to_minute_string(now - 60), now_minute, now)
+
+            # Only the minutes that have come within the horizon since last time.
+            if prefetched_minute != horizon_minute:
+                self.prefetch_pointer_keys(wheel, executor, max(now_minute, prefetched_minute or now_minute), horizon_minute, now)
+                prefetched_minute = horizon_minute
+
+            # Anything listed that was already due.
+            now = self.clock.time()
+            self.dispatch_wheel_entries(wheel.advance(now), executor, stats, now)
+
+            self.catch_up(executor, stats, int(now) + dispatch_catch_up_tick_seconds)
+            now = self.clock.time()
+
+            if self.is_run_over(context, run_started, now):
+                break
+
+            self.sleep_until_next_second()
+
+    def catch_up_boundary_minute(self, now):
+
+        '''
+            The last minute whose bucket is overdue, and so left to catch-up
+            mode, or None if it's off.
+        '''
+
+        if dispatch_catch_up_after_seconds <= 0:
+            return None
+
+        return keys.epoch_to_minute_string(now - dispatch_catch_up_after_seconds)
+
+    def catch_up(self, executor, stats, deadline):
+
+        '''
+            Dispatches overdue pointers, oldest first, in batches of up to
+            dispatch_catch_up_max_workers until deadline. Returns how many were
+            dispatched.
+        '''
+
+        if dispatch_catch_up_after_seconds <= 0:
+            return 0
+
+        dispatched_count = 0
+        batch_count = 0
+        now = self.clock.time()
+
+        while batch_count == 0 or now < deadline:
+
+            if len(self.catch_up_keys) == 0:
+                self.list_overdue_pointer_keys(executor, now)
+
+            if len(self.catch_up_keys) == 0:
+                if self.catch_up_progress is not None:
+                    print("Caught up: dispatched {} overdue pointer(s) in {:.1f}s.".format(self.catch_up_progress.drained_count, now - self.catch_up_progress.started))
+                    self.catch_up_progress = None
+
+                break
+
+            batch_keys = list(self.catch_up_keys.popleft() for i in range(min(dispatch_catch_up_max_workers, len(self.catch_up_keys))))
+            dispatched_count += self.dispatch_pointer_keys(batch_keys, executor, stats, now)
+            batch_count += 1
+
+            now = self.clock.time()
+            self.catch_up_progress.record_drained(len(batch_keys), keys.parse_pointer_key(batch_keys[-1])["execution-epoch"])
+
+        if self.catch_up_progress is not None:
+            stats.record_catch_up(self.catch_up_progress.summary(len(self.catch_up_keys), now))
+
+            if now - self.catch_up_progress.reported >= catch_up_report_seconds:
+                self.catch_up_progress.reported = now
+                print("Catching up: {}".format(json.dumps(stats.catch_up)))
+
+        return dispatched_count
+
+    def list_overdue_pointer_keys(self, executor, now):
+
+        '''
+            Lists overdue buckets, oldest first, into catch_up_keys until it
+            holds a few batches.
+        '''
+
+        overdue_minutes = list(self.list_index_minutes(self.catch_up_boundary_minute(now)))
+        through_string = keys.epoch_to_datetime_string(now)
+
+        listed_count = 0
+        listed_minute_count = 0
+
+        for each_bucket_minute in overdue_minutes:
+            each_pointer_keys = self.list_pointer_keys(executor, [each_bucket_minute], through_string, now)
+            each_pointer_keys.sort(key=lambda x: keys.parse_pointer_key(x)["execution-time"])
+
+            self.catch_up_keys.extend(each_pointer_keys)
+            listed_count += len(each_pointer_keys)
+            listed_minute_count += 1
+
+            if len(self.catch_up_keys) >= dispatch_catch_up_max_workers * catch_up_listed_batches:
+                break
+
+        if listed_count == 0:
+            return
+
+        if self.catch_up_progress is None:
+            print("Catching up on overdue pointers from {} minute(s), starting with {}.".format(len(overdue_minutes), overdue_minutes[0]))
+            self.catch_up_progress = CatchUpProgress(now)
+
+        self.catch_up_progress.record_listed(listed_count, listed_minute_count, len(overdue_minutes) - listed_minute_count)
+
+    def is_stale(self, s3_pointer_content, execution_time_string, now):
+
+        max_staleness_seconds = s3_pointer_content.get("max-staleness-seconds", dispatch_max_staleness_seconds)
+
+        return max_staleness_seconds > 0 and now - keys.datetime_string_to_epoch(execution_time_string) > max_staleness_seconds
+
+    def maintain_leases(self):
+
+        '''
+            Renews and rebalances the worker's leases, if there's a lease store.
+            Returns whether the partitions it holds have changed.
+        '''
+
+        lease_manager = self.get_lease_manager()
+
+        if lease_manager is None:
+            return False
+
+        try:
+            owned_partitions = lease_manager.maintain(self.clock.time())
+        except Exception as e:
+            print("Error maintaining leases: {}".format(e))
+            return False
+
+        if owned_partitions == self.owned_partitions:
+            return False
+
+        print("Holding leases on {} partition(s): {}.".format(len(owned_partitions), ", ".join(owned_partitions)))
+        self.owned_partitions = owned_partitions
+
+        return True
+
+    def release_leases(self):
+
+        lease_manager = self.get_lease_manager()
+
+        if lease_manager is None:
+            return
+
+        try:
+            lease_manager.release_all()
+        except Exception as e:
+            print("Error releasing leases: {}".format(e))
+
+        self.owned_partitions = None
+
+    def owns_shard(self, shard, now):
+
+        lease_manager = self.get_lease_manager()
+
+        if lease_manager is None:
+            return True
+
+        # Pointers in the original layout belong to the first partition.
+        return lease_manager.lease_for(shard or lease_manager.partitions[0], now) is not None
+
+    def claim_records(self, shards, claim_keys, now):
+
+        '''
+            Claims records under the worker's leases on their shards. Returns,
+            for each, the lease it was claimed under, claimed_elsewhere, or
+            lease_lost.
+        '''
+
+        claims = list(lease_lost for x in claim_keys)
+        indexes_by_shard = collections.OrderedDict()
+
+        for i, each_shard in enumerate(shards):
+            indexes_by_shard.setdefault(each_shard or self.get_lease_manager().partitions[0], []).append(i)
+
+        for each_shard, each_indexes in indexes_by_shard.items():
+            try:
+                each_lease, each_claimed_keys = self.get_lease_manager().claim(each_shard, list(claim_keys[i] for i in each_indexes), now)
+            except Exception as e:
+                print("Error claiming {} record(s) on partition {}: {}".format(len(each_indexes), each_shard, e))
+                continue
+
+            if each_lease is None:
+                continue
+
+            each_claimed_keys = set(each_claimed_keys)
+
+            for i in each_indexes:
+                claims[i] = each_lease if claim_keys[i] in each_claimed_keys else claimed_elsewhere
+
+        return claims
+
+    def release_claims(self, claims, claim_keys, invoke_results):
+
+        '''
+            Releases the claims of records that weren't invoked, or are to be
+            retried.
+        '''
+
+        keys_by_lease = collections.OrderedDict()
+
+        for each_claim, each_claim_key, each_result in zip(claims, claim_keys, invoke_results):
+            if isinstance(each_claim, leases.Lease) and (each_result is deferred or isinstance(each_result, Exception)):
+                keys_by_lease.setdefault(each_claim, []).append(each_claim_key)
+
+        for each_lease, each_claim_keys in keys_by_lease.items():
+            try:
+                self.get_lease_manager().release_claims(each_lease, each_claim_keys)
+            except Exception as e:
+
+                # Taken as fired, so they won't be invoked.
+                print("Error releasing {} claim(s) on partition {}: {}".format(len(each_claim_keys), each_lease.partition, e))
+
+    def prefetch_pointer_keys(self, wheel, executor, after_minute, through_minute, now):
+
+        pointer_keys = self.list_pointer_keys(
+            executor,
+            self.list_index_minutes(through_minute, after_minute),
+            keys.epoch_to_datetime_string(wheel.horizon_epoch),
+            now
+        )
+
+        for each_key in pointer_keys:
+            wheel.add(keys.parse_pointer_key(each_key)["execution-epoch"], each_key)
+
+    def dispatch_wheel_entries(self, wheel_entries, executor, stats, now):
+
+        if len(wheel_entries) == 0:
+            return 0
+
+        return self.dispatch_pointer_keys(list(x.key for x in wheel_entries), executor, stats, now)
+
+    def dispatch_due_invocations(self, executor, stats, now=None):
+
+        if now is None:
+            now = self.clock.time()
+
+        pointer_keys = self.list_due_pointer_keys(executor, now)
+
+        if dispatch_legacy_layout:
+            pointer_keys.extend(self.list_due_legacy_pointer_keys(now))
+
+        return self.dispatch_pointer_keys(pointer_keys, executor, stats, now)
+
+    def dispatch_pointer_keys(self, pointer_keys, executor, stats, now):
+
+        # Versions of the recurring schedules seen this tick, by schedule ID.
+        self.series_versions = {}
+
+        # Only those in partitions this worker holds.
+        pointer_keys = list(x for x in pointer_keys if self.owns_shard(keys.parse_pointer_key(x)["shard"], now))
+
+        segment_keys = list(x for x in pointer_keys if keys.is_segment_key(x))
+        pointer_keys = list(x for x in pointer_keys if not keys.is_segment_key(x))
+
+        # Pointers and segments are read in parallel, then their due records are
+        # invoked together, within their targets' limits, then each is settled.
+        pointer_contents = list(executor.map(lambda x: self.read_pointer(x, stats), pointer_keys))
+
+        segment_dispatches = []
+        now_string = keys.epoch_to_datetime_string(now)
+        cancelled_schedule_ids = {}
+
+        for each_segment_key, each_segment_records in zip(segment_keys, executor.map(self.read_segment, segment_keys)):
+            if each_segment_records is None:
+                stats.record_failed()
+                continue
+
+            # Cancelled records are left out of what's written back.
+            each_bucket_minute = keys.parse_pointer_key(each_segment_key)["bucket-minute"]
+
+            if each_bucket_minute not in cancelled_schedule_ids:
+                cancelled_schedule_ids[each_bucket_minute] = self.get_schedule_index().list_cancelled(each_bucket_minute)
+
+            each_segment_records = list(x for x in each_segment_records if x["pointer-id"] not in cancelled_schedule_ids[each_bucket_minute])
+
+            due_records = list(x for x in each_segment_records if x["execution-time"] <= now_string)
+            later_records = list(x for x in each_segment_records if x["execution-time"] > now_string)
+
+            segment_dispatches.append((each_segment_key, due_records, later_records))
+
+        invoked_pointers = list((x, y) for x, y in zip(pointer_keys, pointer_contents) if y is not None)
+        invoked_records = list(x[1] for x in invoked_pointers) + list(y for x in segment_dispatches for y in x[1])
+        invoke_results = list(deferred for x in invoked_records)
+
+        if self.get_lease_manager() is not None:
+
+            # Each record is claimed under its partition's lease before it's invoked.
+            claim_keys = list(keys.parse_pointer_key(x[0])["pointer-id"] for x in invoked_pointers) + list(y["pointer-id"] for x in segment_dispatches for y in x[1])
+            shards = list(keys.parse_pointer_key(x[0])["shard"] for x in invoked_pointers) + list(keys.parse_pointer_key(x[0])["shard"] for x in segment_dispatches for y in x[1])
+
+            claims = self.claim_records(shards, claim_keys, self.clock.time())
+            invoke_results = list(deferred if isinstance(x, leases.Lease) else x for x in claims)
+
+        # Too late to be wanted, so set aside rather than invoked.
+        execution_times = list(keys.parse_pointer_key(x[0])["execution-time"] for x in invoked_pointers) + list(y["execution-time"] for x in segment_dispatches for y in x[1])
+
+        for i, each_execution_time in enumerate(execution_times):
+            if invoke_results[i] is deferred and self.is_stale(invoked_records[i], each_execution_time, now):
+                invoke_results[i] = stale
+
+        invoke_results = self.invoke_records(invoked_records, executor, stats, invoke_results)
+
+        if self.get_lease_manager() is not None:
+            self.release_claims(claims, claim_keys, invoke_results)
+
+        invoke_results = iter(invoke_results)
+        settle_futures = []
+
+        for each_pointer_key, each_pointer_content in invoked_pointers:
+            settle_futures.append(executor.submit(self.settle_pointer, each_pointer_key, each_pointer_content, next(invoke_results), stats))
+
+        for each_segment_key, due_records, later_records in segment_dispatches:
+            settle_futures.append(executor.submit(
+                self.settle_segment,
+                each_segment_key,
+                list(zip(due_records, (next(invoke_results) for x in due_records))),
+                later_records,
+                stats
+            ))
+
+        for each_future in settle_futures:
+            each_future.result()
+
+        return len(pointer_keys) + sum(len(x[1]) for x in segment_dispatches)
+
+    def list_due_pointer_keys(self, executor, now):
+
+        '''
+            Finds due pointers through the per-minute index: one LIST for the due
+            minutes, one per minute for its shards, then the shards in parallel.
+        '''
+
+        return self.list_pointer_keys(
+            executor,
+            self.list_index_minutes(keys.epoch_to_minute_string(now), self.catch_up_boundary_minute(now)),
+            keys.epoch_to_datetime_string(now),
+            now
+        )
+
+    def list_pointer_keys(self, executor, bucket_minutes, through_string, now):
+
+        '''
+            Lists the pointers in bucket_minutes with execution times up to
+            through_string, removing the markers of closed buckets found empty.
+        '''
+
+        due_pointer_keys = []
+
+        for each_bucket_minute in bucket_minutes:
+
+            all_index_marker_keys = list(self.get_storage().list_keys(keys.index_marker_key(each_bucket_minute, "")))
+            index_marker_keys = list(x for x in all_index_marker_keys if self.owns_shard(x.split("/")[-1], now))
+            shard_prefixes = list(keys.shard_minute_prefix(x.split("/")[-1], each_bucket_minute) for x in index_marker_keys)
+
+            bucket_pointer_count = 0
+
+            for each_shard_keys in executor.map(lambda x: list(self.get_storage().list_keys(x)), shard_prefixes):
+                bucket_pointer_count += len(each_shard_keys)
+
+                for each_key in each_shard_keys:
+                    each_key_info = keys.parse_pointer_key(each_key)
+
+                    if each_key_info is not None and each_key_info["execution-time"] <= through_string:
+                        due_pointer_keys.append(each_key)
+
+            # Nothing is written to a closed bucket, so once it's empty its markers can go.
+            if bucket_pointer_count == 0 and keys.is_bucket_closed(each_bucket_minute, now):
+                try:
+
+                    # Cancellations are shared by the minute's shards, so they go with the last of its markers.
+                    if len(index_marker_keys) == len(all_index_marker_keys):
+                        self.get_storage().delete_objects(list(self.get_storage().list_keys(schedule_index.cancellation_minute_prefix(each_bucket_minute))))
+
+                    self.get_storage().delete_objects(index_marker_keys)
+
+                    # Segment records' index entries go with the last of their minutes.
+                    if len(index_marker_keys) == len(all_index_marker_keys):
+                        self.get_schedule_index().settle_minute(each_bucket_minute)
+                except Exception as e:
+                    print("Error removing index markers for {}: {}".format(each_bucket_minute, e))
+
+        return due_pointer_keys
+
+    def list_index_minutes(self, through_minute, after_minute=None):
+
+        # Minutes sort chronologically, so stop at the first one past through_minute.
+        for each_prefix in self.get_storage().list_prefixes(keys.index_prefix):
+            each_bucket_minute = each_prefix[len(keys.index_prefix):-1]
+
+            if each_bucket_minute > through_minute:
+                return
+
+            if after_minute is not None and each_bucket_minute <= after_minute:
+                continue
+
+            yield each_bucket_minute
+
+    def list_due_legacy_pointer_keys(self, now):
+
+        due_pointer_keys = []
+
+        for each_prefix in self.list_legacy_prefixes(now):
+            due_pointer_keys.extend(self.get_storage().list_keys(each_prefix))
+
+        return due_pointer_keys
+
+    def list_legacy_prefixes(self, now=None):
+
+        '''
+            Time-bucket prefixes of the original layout sort chronologically, so
+            listing stops at the first one in the future (when now is given).
+        '''
+
+        now_string = None if now is None else keys.epoch_to_datetime_string(now)
+
+        for each_prefix in self.get_storage().list_prefixes(keys.queued_prefix):
+
+            if not keys.is_legacy_time_prefix(each_prefix):
+                continue
+
+            if now_string is not None and each_prefix[len(keys.queued_prefix):-1] > now_string:
+                return
+
+            yield each_prefix
+
+    def migrate_legacy_pointers(self):
+
+        '''
+            Moves every pointer in the original layout (due or not) into the
+            sharded layout.
+        '''
+
+        def migrate_pointer(pointer_key):
+            pointer_key_info = keys.parse_pointer_key(pointer_key)
+
+            new_pointer_key, index_marker_key = keys.pointer_key(
+                pointer_key_info["execution-time"],
+                pointer_key_info["pointer-id"],
+                queue_shard_count
+            )
+
+            self.get_storage().put_object(index_marker_key, b"")
+            self.get_storage().move_object(pointer_key, new_pointer_key)
+
+        migrated_count = 0
+
+        with ThreadPoolExecutor(max_workers=dispatch_max_workers) as executor:
+            for each_prefix in self.list_legacy_prefixes():
+                pointer_keys = list(self.get_storage().list_keys(each_prefix))
+
+                for each_result in executor.map(migrate_pointer, pointer_keys):
+                    migrated_count += 1
+
+                print("Migrated {} pointer(s) from {}.".format(len(pointer_keys), each_prefix))
+
+        return migrated_count
+
+    def invoke_records(self, s3_pointer_contents, executor, stats, preset_results=None):
+
+        '''
+            Invokes each record within the limits of its target. Each target
+            gets its own few workers (as many as its limits allow), started
+            round-robin, so a burst for one target is spread across workers
+            without holding up the others. Returns a result per record: the
+            time it was fired, None if the function no longer exists, the
+            exception raised, or deferred if the tick ran out of time first.
+            Records with a result in preset_results other than deferred aren't
+            invoked.
+        '''
+
+        started = self.clock.time()
+        deadline = started + dispatch_limit_wait_seconds
+
+        results = list(preset_results or (deferred for x in s3_pointer_contents))
+        pending_by_limiter = collections.OrderedDict()
+
+        for i, each_content in enumerate(s3_pointer_contents):
+            if results[i] is not deferred:
+                continue
+
+            pending_by_limiter.setdefault(self.get_target_limits().limiter_for(each_content), collections.deque()).append(i)
+
+        def invoke_pending(limiter, pending):
+            while True:
+                try:
+                    i = pending.popleft()
+                except IndexError:
+                    return
+
+                wait_seconds = limiter.acquire(self.clock.time(), deadline)
+
+                if wait_seconds is None:
+                    pending.appendleft(i)
+                    return
+
+                self.clock.sleep(wait_seconds)
+
+                queue_seconds = self.clock.time() - started
+
+                try:
+                    results[i] = self.invoke_record(s3_pointer_contents[i])
+                except Exception as e:
+                    results[i] = e
+
+                    if rate_limits.is_throttle_error(e):
+                        limiter.throttled(self.clock.time())
+                        stats.record_target(limiter.function_arn, throttled=True)
+                        continue
+
+                limiter.succeeded()
+                stats.record_target(limiter.function_arn, queue_seconds)
+
+        worker_counts = list(x.worker_count(len(y), dispatch_max_workers) for x, y in pending_by_limiter.items())
+        futures = []
+
+        for each_round in range(max(worker_counts or [0])):
+            for (each_limiter, each_pending), each_worker_count in zip(pending_by_limiter.items(), worker_counts):
+                if each_round < each_worker_count:
+                    futures.append(executor.submit(invoke_pending, each_limiter, each_pending))
+
+        for each_future in futures:
+            each_future.result()
+
+        for each_limiter, each_pending in pending_by_limiter.items():
+            for i in each_pending:
+                stats.record_target(each_limiter.function_arn, deferred=True)
+
+        return results
+
+    def invoke_record(self, s3_pointer_content):
+
+        '''
+            Invokes the function for a pointer record. Returns the time it was
+            fired, or None if the function no longer exists.
+        '''
+
+        try:
+            get_boto3_client("lambda").invoke(
+                FunctionName = s3_pointer_content["function-arn"],
+                InvocationType = "Event",
+                Payload = self.get_invoke_payload(s3_pointer_content)
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                raise
+
+            print("Function \"{}\" not found.".format(s3_pointer_content["function-arn"]))
+            return None
+
+        return self.clock.time()
+
+    def get_invoke_payload(self, s3_pointer_content):
+
+        if "payload-ref" not in s3_pointer_content:
+            return json.dumps(s3_pointer_content["payload"])
+
+        if s3_pointer_content["payload-bytes"] > invoke_payload_limit_bytes:
+            return json.dumps({
+                "payload-location": {
+                    "bucket": self.get_s3_bucket_name(),
+                    "key": payloads.payload_key(s3_pointer_content["payload-ref"])
+                }
+            })
+
+        return self.get_payload_store().get_payload_body(s3_pointer_content["payload-ref"])
+
+    def release_payload(self, s3_pointer_content, pointer_id):
+
+        if "payload-ref" not in s3_pointer_content:
+            return
+
+        handed_over = s3_pointer_content["payload-bytes"] > invoke_payload_limit_bytes
+
+        try:
+            self.get_payload_store().release(
+                s3_pointer_content["payload-ref"],
+                pointer_id,
+                payload_hold_seconds if handed_over else None
+            )
+        except Exception as e:
+
+            # The payload is only kept longer than it needs to be.
+            print("Error releasing payload {} for {}: {}".format(s3_pointer_content["payload-ref"], pointer_id, e))
+
+    def read_pointer(self, pointer_key, stats):
+
+        '''
+            Returns a pointer's content, or None if it's not to be invoked now.
+        '''
+
+        try:
+            if pointer_key in self.deferred_pointer_contents:
+                s3_pointer_content = self.deferred_pointer_contents.pop(pointer_key)
+            else:
+                s3_pointer_content = records.decode_pointer_record(self.get_storage().get_object(pointer_key))
+
+            # Being invoked by the queuer that wrote it; only picked up if that never happens.
+            if s3_pointer_content.get("claimed-until", 0) > self.clock.time():
+                return None
+
+            if not self.is_current_occurrence(s3_pointer_content):
+                self.get_storage().delete_object(pointer_key)
+                return None
+        except Exception as e:
+
+            # Left in place, so it's picked up again on the next tick.
+            print("Error dispatching {}: {}".format(pointer_key, e))
+            stats.record_failed()
+            return None
+
+        return s3_pointer_content
+
+    def settle_pointer(self, pointer_key, s3_pointer_content, fired_time, stats):
+
+        # Now another worker's.
+        if fired_time is lease_lost:
+            return
+
+        # Left in place for the next tick, which needn't read it again.
+        if fired_time is deferred or rate_limits.is_throttle_error(fired_time):
+            self.deferred_pointer_contents[pointer_key] = s3_pointer_content
+            return
+
+        try:
+            if isinstance(fired_time, Exception):
+                raise fired_time
+
+            # Retrying a missing function won't help, nor invoking it this late,
+            # so set it aside rather than retrying every tick.
+            destination_prefix = keys.failed_prefix if fired_time is None or fired_time is stale else keys.dispatched_prefix
+
+            self.get_storage().move_object(pointer_key, keys.relocated_key(pointer_key, destination_prefix))
+        except Exception as e:
+
+            # Left in place, so it's picked up again on the next tick.
+            print("Error dispatching {}: {}".format(pointer_key, e))
+            stats.record_failed()
+            return
+
+        if s3_pointer_content.get("indexed"):
+            try:
+                self.get_schedule_index().delete(keys.parse_pointer_key(pointer_key)["pointer-id"])
+            except Exception as e:
+                print("Error removing schedule index entry for {}: {}".format(pointer_key, e))
+
+        if fired_time is stale:
+            stats.record_stale()
+            return
+
+        if fired_time is None:
+            stats.record_failed()
+            return
+
+        pointer_key_info = keys.parse_pointer_key(pointer_key)
+        self.release_payload(s3_pointer_content, pointer_key_info["pointer-id"])
+
+        # Fired by the worker that held the lease before; this one only settles it.
+        if fired_time is not claimed_elsewhere:
+            stats.record_dispatched(fired_time - pointer_key_info["execution-epoch"])
+
+    def is_current_occurrence(self, s3_pointer_content):
+
+        '''
+            Whether a pointer is still wanted: true unless it's an occurrence of
+            a recurring schedule that's since been updated or cancelled.
+        '''
+
+        if "schedule-id" not in s3_pointer_content:
+            return True
+
+        schedule_id = s3_pointer_content["schedule-id"]
+
+        if schedule_id not in self.series_versions:
+            series_body = self.get_storage().get_object_if_exists(recurrence.series_key(schedule_id))
+            self.series_versions[schedule_id] = None if series_body is None else json.loads(series_body.decode("utf-8"))["version"]
+
+        return self.series_versions[schedule_id] == s3_pointer_content["schedule-version"]
+
+    def read_segment(self, segment_key):
+
+        try:
+            segment_records = segments.iter_segment_records(self.get_storage().open_object(segment_key))
+            next(segment_records)
+
+            return list(segment_records)
+        except Exception as e:
+            print("Error reading segment {}: {}".format(segment_key, e))
+            return None
+
+    def settle_segment(self, segment_key, due_record_results, later_records, stats):
+
+        '''
+            Writes what's left of a segment (records not yet due, or whose invoke
+            failed) back to queued/, archives what was fired, and removes the
+            original.
+        '''
+
+        # Now another worker's.
+        if any(x[1] is lease_lost for x in due_record_results):
+            return
+
+        segment_key_info = keys.parse_pointer_key(segment_key)
+
+        remaining_records = list(later_records)
+        dispatched_records = []
+        failed_records = []
+
+        for each_record, each_result in due_record_results:
+            if each_result is deferred or isinstance(each_result, Exception):
+                remaining_records.append(each_record)
+            elif each_result is stale:
+                failed_records.append(each_record)
+                stats.record_stale()
+            elif each_result is None:
+                failed_records.append(each_record)
+                stats.record_failed()
+            else:
+                dispatched_records.append(each_record)
+
+                if each_result is not claimed_elsewhere:
+                    stats.record_dispatched(each_result - keys.datetime_string_to_epoch(each_record["execution-time"]))
+
+        try:
+            # Written before the original is removed, so the bucket is never seen empty.
+            if len(remaining_records) > 0:
+                remaining_segment_key, index_marker_key = keys.segment_key(
+                    segment_key_info["bucket-minute"],
+                    min(x["execution-time"] for x in remaining_records),
+                    "{}".format(uuid.uuid4()),
+                    None,
+                    shard = segment_key_info["shard"]
+                )
+
+                self.get_storage().put_object(remaining_segment_key, segments.encode_segment(remaining_records))
+
+            for each_prefix, each_records in [(keys.dispatched_prefix, dispatched_records), (keys.failed_prefix, failed_records)]:
+                if len(each_records) > 0:
+                    self.get_storage().put_object(keys.relocated_key(segment_key, each_prefix), segments.encode_segment(each_records))
+
+            self.get_storage().delete_object(segment_key)
+        except Exception as e:
+
+            # Left in place, so its records are picked up (and fired again) on the next tick.
+            print("Error settling segment {}: {}".format(segment_key, e))
+            return
+
+        for each_record in dispatched_records:
+            self.release_payload(each_record, each_record["pointer-id"])
+
+    def get_storage(self):
+
+        if not hasattr(self, "_storage"):
+            with self._storage_lock:
+                if not hasattr(self, "_storage"):
+                    self._storage = storage.create_storage_backend(
+                        self.get_s3_bucket_name,
+                        lambda: get_boto3_client("s3")
+                    )
+
+        return self._storage
+
+    def get_schedule_index(self):
+        return schedule_index.ScheduleIndex(self.get_storage())
+
+    def get_target_limits(self):
+
+        # Kept with the handler, so token buckets carry over from one run to the next.
+        if not hasattr(self, "_target_limits"):
+            with self._storage_lock:
+                if not hasattr(self, "_target_limits"):
+                    self._target_limits = rate_limits.TargetLimits(
+                        dict((x, rate_limits.validate_limits(y, "DISPATCH_TARGET_LIMITS")) for x, y in dispatch_target_limits.items()),
+                        dispatch_default_limits,
+                        self.clock
+                    )
+
+        return self._target_limits
+
+    def get_lease_manager(self):
+
+        if not dispatch_lease_store:
+            return None
+
+        if not hasattr(self, "_lease_manager"):
+            with self._storage_lock:
+                if not hasattr(self, "_lease_manager"):
+                    self._lease_manager = leases.LeaseManager(
+                        leases.create_lease_store(dispatch_lease_store),
+                        list("{:02x}".format(i) for i in range(queue_shard_count)),
+                        self.worker_id,
+                        dispatch_lease_seconds
+                    )
+
+        return self._lease_manager
+
+    def get_payload_store(self):
+
+        if not hasattr(self, "_payload_store"):
+            storage_backend = self.get_storage()
+
+            with self._storage_lock:
+                if not hasattr(self, "_payload_store"):
+
+                    # Payloads are only ever stored by the queuer.
+                    self._payload_store = payloads.PayloadStore(storage_backend, -1)
+
+        return self._payload_store
+
+    def get_s3_bucket_name(self):
+        return os.environ["SHARED_BUCKET"]
+
+
+handler_object = None
+def lambda_handler(event, context):
+    global handler_object
+
+    if handler_object is None:
+        handler_object = LambdaHandler(context)
+
+    return handler_object.handle_event(event, context)
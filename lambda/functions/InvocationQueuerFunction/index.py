@@ -1,30 +1,934 @@
 from __future__ import print_function
 
-import json, datetime, time
-import boto3, botocore
+import os, json, datetime, time, threading, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from lambda_scheduler import keys, records, segments, storage, metrics, event_logs, bulk_import, payloads, recurrence, schedule_index, idempotency, rate_limits
 
 datetime_string_format = "%Y-%m-%dT%H:%M:%SZ"
 
+# Upper bound on concurrent S3 writes when queuing a batch of invocations.
+batch_max_workers = 16
+
+queue_shard_count = int(os.environ.get("QUEUE_SHARD_COUNT", keys.default_shard_count))
+
+# In segment mode, a batch's pointers are written as one segment object per
+# bucket minute (split once a segment reaches the record / byte limit) rather
+# than one object each.
+segment_mode = os.environ.get("SEGMENT_MODE", "false").lower() == "true"
+segment_max_records = int(os.environ.get("SEGMENT_MAX_RECORDS", 1000))
+segment_max_bytes = int(os.environ.get("SEGMENT_MAX_BYTES", 4 * 1024 * 1024))
+
+# Payloads at least this large (serialized) are stored once under their hash
+# and referenced from each pointer. Negative to store every payload inline.
+payload_store_threshold_bytes = int(os.environ.get("PAYLOAD_STORE_THRESHOLD_BYTES", 16 * 1024))
+
+# Occurrences of recurring schedules are written this far ahead; the rest are
+# written as time passes, by the dispatcher.
+recurrence_horizon_seconds = int(os.environ.get("RECURRENCE_HORIZON_SECONDS", 15 * 60))
+
+# Bulk imports write pointers with this much concurrency, checkpointing after
+# each batch, and stop once less than bulk_import_reserved_millis remain.
+bulk_import_max_workers = int(os.environ.get("BULK_IMPORT_MAX_WORKERS", 32))
+bulk_import_batch_size = int(os.environ.get("BULK_IMPORT_BATCH_SIZE", 1000))
+bulk_import_reserved_millis = int(os.environ.get("BULK_IMPORT_RESERVED_MILLIS", 30000))
+
+# Idempotency keys are honoured for this long after they're first used (the
+# bucket's lifecycle rule removes their records once it's passed).
+idempotency_retention_seconds = int(os.environ.get("IDEMPOTENCY_RETENTION_DAYS", 7)) * 24 * 60 * 60
+
+# Invocations due within this many seconds (or already past due) are invoked
+# by the queuer itself, after holding them until they're due, rather than left
+# for the dispatcher's next pickup. Their pointers are still written, claimed
+# for near_term_claim_seconds past their execution time; the dispatcher leaves
+# a claimed pointer alone until then, in case the queuer never invokes it.
+# 0 to leave every invocation to the dispatcher.
+near_term_threshold_seconds = int(os.environ.get("NEAR_TERM_THRESHOLD_SECONDS", 5))
+near_term_claim_seconds = int(os.environ.get("NEAR_TERM_CLAIM_SECONDS", 30))
+
+# The queuer stops holding invocations once less than this is left to it.
+near_term_reserved_millis = 10000
+
+# The dispatcher's per-target limits and staleness limit. Invocations they
+# apply to are left to the dispatcher, which enforces them.
+dispatch_target_limits = json.loads(os.environ.get("DISPATCH_TARGET_LIMITS") or "{}")
+dispatch_max_staleness_seconds = int(os.environ.get("DISPATCH_MAX_STALENESS_SECONDS", 0))
+
+function_arn_cache_ttl_seconds = int(os.environ.get("FUNCTION_ARN_CACHE_TTL_SECONDS", 300))
+function_arn_cache_negative_ttl_seconds = int(os.environ.get("FUNCTION_ARN_CACHE_NEGATIVE_TTL_SECONDS", 30))
+function_arn_cache_max_size = int(os.environ.get("FUNCTION_ARN_CACHE_MAX_SIZE", 1024))
+
+# Shared by every handler in this container (and by batch worker threads, since 
+# clients--unlike resources--are thread safe), so a warm container never pays for 
+# client construction again.
+boto3_clients = {}
+boto3_clients_lock = threading.Lock()
+
+def get_boto3_client(service_name):
+    
+    if service_name not in boto3_clients:
+        with boto3_clients_lock:
+            if service_name not in boto3_clients:
+                
+                # Imported on first use rather than at module load, as it's most
+                # of the cold start and not every request needs it.
+                import boto3
+                
+                boto3_clients[service_name] = boto3.client(service_name)
+    
+    return boto3_clients[service_name]
+
+# Configured by LOG_LEVEL, LOG_EVENT_SAMPLE_RATE, LOG_PAYLOAD_MAX_BYTES and
+# LOG_PAYLOAD_HASH.
+event_logger = event_logs.create_event_logger()
+
+# Whether the next request is the first this container has handled.
+cold_start = True
+
+class FunctionArnCache(object):
+    
+    '''
+        In-container cache of function name -> ARN lookups.
+        
+        "Not found" results are cached too (as None), with their own (shorter) TTL, so 
+        repeated requests for a missing function don't each cost a get_function call. 
+        Least recently used entries are evicted once max_size is reached.
+    '''
+    
+    def __init__(self, ttl_seconds, negative_ttl_seconds, max_size):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, function_name):
+        
+        '''
+            Returns (True, arn_or_none) on a hit and (False, None) on a miss.
+        '''
+        
+        with self._lock:
+            entry = self._entries.pop(function_name, None)
+            
+            if entry is not None and entry[1] > time.time():
+                self._entries[function_name] = entry
+                self.hits += 1
+                return True, entry[0]
+            
+            self.misses += 1
+            return False, None
+    
+    def put(self, function_name, function_arn):
+        
+        ttl_seconds = self.ttl_seconds if function_arn is not None else self.negative_ttl_seconds
+        
+        if ttl_seconds <= 0 or self.max_size <= 0:
+            return
+        
+        with self._lock:
+            self._entries.pop(function_name, None)
+            self._entries[function_name] = (function_arn, time.time() + ttl_seconds)
+            
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
 class LambdaHandler(object):
 
     def __init__(self, context):
-        pass
+        self.function_arn_cache = FunctionArnCache(
+            function_arn_cache_ttl_seconds,
+            function_arn_cache_negative_ttl_seconds,
+            function_arn_cache_max_size
+        )
+        
+        # Index markers already written from this container, by bucket minute.
+        self.written_index_markers = {}
+        self.written_index_markers_lock = threading.Lock()
+        
+        # Replaced for each request; these cover methods called on their own.
+        self.phase_timer = metrics.PhaseTimer()
+        self.metric_properties = {}
 
     def handle_event(self, unvalidated_event, context):
-        print("Received event: {}".format(json.dumps(unvalidated_event)))
+        global cold_start
+        
+        self.phase_timer = metrics.PhaseTimer()
+        self.metric_properties = {
+            "ColdStart": cold_start,
+            "RequestId": context.aws_request_id
+        }
+        cold_start = False
         
         if "warming" in unvalidated_event:
+            
+            # Warming is a good time to pay for client construction.
+            get_boto3_client("s3")
+            get_boto3_client("lambda")
+            
             return {
                 "message": "Function warmed successfully."
             }
         
-        if not hasattr(self, "s3_bucket"):
-            self.s3_bucket = boto3.resource("s3").Bucket(self.get_s3_bucket_name())
+        event_logger.log_event("Received event", unvalidated_event)
         
-        event = self.validate_event(unvalidated_event)
+        try:
+            with self.phase_timer.phase("ConfigLoad"):
+                self.get_payload_store()
+            
+            if "invocations" in unvalidated_event:
+                return self.handle_batch_event(unvalidated_event, context)
+            
+            if "bulk-import" in unvalidated_event:
+                return self.handle_bulk_import_event(unvalidated_event, context)
+            
+            if "schedule-expression" in unvalidated_event:
+                return self.handle_recurring_event(unvalidated_event, context)
+            
+            if "update-schedule" in unvalidated_event:
+                return self.handle_update_schedule_event(unvalidated_event, context)
+            
+            if "cancel-schedule" in unvalidated_event:
+                return self.handle_cancel_schedule_event(unvalidated_event, context)
+            
+            if "get-schedule" in unvalidated_event:
+                return self.handle_get_schedule_event(unvalidated_event, context)
+            
+            if "reschedule-schedule" in unvalidated_event:
+                return self.handle_reschedule_event(unvalidated_event, context)
+            
+            return self.handle_single_event(unvalidated_event, context)
+        except Exception as e:
+            event_logger.log_error_event("Unable to queue event", unvalidated_event, e)
+            raise
+        finally:
+            print(metrics.embedded_metric_log_line(
+                {
+                    "FunctionName": context.function_name
+                },
+                self.phase_timer,
+                self.metric_properties,
+                {
+                    "PayloadBytes": "Bytes"
+                }
+            ))
 
-        print("Validated event: {}".format(json.dumps(event)))
+    def handle_single_event(self, unvalidated_event, context):
+        
+        with self.phase_timer.phase("Validation"):
+            event = self.validate_event(unvalidated_event)
+            idempotency_key = idempotency.validate_idempotency_key(unvalidated_event)
 
+        event_logger.debug("Validated event: {}".format(json.dumps(event)))
+        event_logger.debug("Function ARN cache: {}".format(json.dumps(self.function_arn_cache.stats())))
+        
+        schedule_id = context.aws_request_id
+        
+        if idempotency_key is not None:
+            with self.phase_timer.phase("IdempotencyCheck"):
+                idempotency_record = self.get_idempotency_store().get(idempotency_key, event)
+            
+            if idempotency_record is not None:
+                self.phase_timer.count("DuplicateCount")
+                
+                return {
+                    "message": "Lambda invocation already queued.",
+                    "schedule-id": idempotency_record["schedule-id"],
+                    "duplicate": True
+                }
+            
+            schedule_id = idempotency.schedule_id(idempotency_key)
+        
+        execution_epoch = keys.datetime_string_to_epoch(event["execution-time"])
+        lead_seconds = execution_epoch - time.time()
+        near_term = self.is_near_term(event, lead_seconds, context)
+        
+        pointer_key = self.put_pointer(
+            event,
+            context,
+            schedule_id,
+            execution_epoch + near_term_claim_seconds if near_term else None
+        )
+        
+        if idempotency_key is not None:
+            with self.phase_timer.phase("StorageWrite"):
+                self.get_idempotency_store().put(idempotency_key, event, schedule_id)
+        
+        self.phase_timer.count("InvocationCount")
+        
+        dispatch_path = "queued"
+        
+        if near_term:
+            dispatch_path = self.invoke_near_term(event, pointer_key, schedule_id, execution_epoch)
+        
+        # Which path was taken, and how far ahead it was asked for, for tuning the threshold.
+        self.phase_timer.count("{}Count".format(dispatch_path.capitalize()))
+        self.metric_properties["DispatchPath"] = dispatch_path
+        self.metric_properties["LeadSeconds"] = round(lead_seconds, 3)
+
+        return {
+            "message": "Lambda invocation queued successfully." if dispatch_path == "queued" else "Lambda invocation dispatched.",
+            "schedule-id": schedule_id,
+            "dispatch-path": dispatch_path
+        }
+    
+    def is_near_term(self, event, lead_seconds, context):
+        
+        '''
+            Whether an invocation is due soon enough for the queuer to invoke it
+            itself. Payloads that would be stored apart from their pointers are
+            always left to the dispatcher, as are invocations of rate-limited
+            targets and ones past their staleness limit.
+        '''
+        
+        if lead_seconds > near_term_threshold_seconds:
+            return False
+        
+        if "dispatch-limits" in event or event["function-arn"] in dispatch_target_limits or rate_limits.function_name_for_arn(event["function-arn"]) in dispatch_target_limits:
+            return False
+        
+        max_staleness_seconds = event.get("max-staleness-seconds", dispatch_max_staleness_seconds)
+        
+        if max_staleness_seconds > 0 and -lead_seconds > max_staleness_seconds:
+            return False
+        
+        if lead_seconds * 1000 > context.get_remaining_time_in_millis() - near_term_reserved_millis:
+            return False
+        
+        if payload_store_threshold_bytes >= 0 and len(json.dumps(event["payload"], separators=(",", ":"))) >= payload_store_threshold_bytes:
+            return False
+        
+        return True
+    
+    def invoke_near_term(self, event, pointer_key, schedule_id, execution_epoch):
+        
+        '''
+            Invokes a near-term invocation once it's due, and settles its pointer
+            as the dispatcher would have. Returns the path taken: "immediate",
+            "held", or "queued" if it's been left to the dispatcher after all.
+        '''
+        
+        hold_seconds = execution_epoch - time.time()
+        
+        if hold_seconds > 0:
+            with self.phase_timer.phase("NearTermHold"):
+                time.sleep(hold_seconds)
+        
+        try:
+            with self.phase_timer.phase("Invoke"):
+                get_boto3_client("lambda").invoke(
+                    FunctionName = event["function-arn"],
+                    InvocationType = "Event",
+                    Payload = json.dumps(event["payload"])
+                )
+        except Exception as e:
+            
+            # Its pointer is invoked by the dispatcher once the claim runs out.
+            event_logger.error("Unable to invoke near-term invocation {}; leaving it to the dispatcher: {}".format(schedule_id, e))
+            return "queued"
+        
+        self.metric_properties["InvokeLagSeconds"] = round(time.time() - execution_epoch, 3)
+        
+        try:
+            with self.phase_timer.phase("StorageWrite"):
+                self.get_storage().move_object(pointer_key, keys.relocated_key(pointer_key, keys.dispatched_prefix))
+                self.get_schedule_index().delete(schedule_id)
+        except Exception as e:
+            event_logger.error("Unable to settle pointer {}; it may be invoked again: {}".format(pointer_key, e))
+        
+        return "held" if hold_seconds > 0 else "immediate"
+
+    def handle_batch_event(self, unvalidated_event, context):
+        
+        unvalidated_invocations = unvalidated_event["invocations"]
+        
+        if not isinstance(unvalidated_invocations, list) or len(unvalidated_invocations) == 0:
+            raise Exception("Parameter \"{}\" must be specified as a non-empty list of invocations.".format("invocations"))
+        
+        # Look up each distinct function only once for the whole batch.
+        resolved_function_arns = {}
+        self.resolve_function_arns(unvalidated_invocations, resolved_function_arns)
+        
+        results = [None] * len(unvalidated_invocations)
+        validated_events = []
+        idempotency_keys = {}
+        
+        for i, each_invocation in enumerate(unvalidated_invocations):
+            try:
+                if not isinstance(each_invocation, dict):
+                    raise Exception("Each invocation must be specified as a JSON key/value struct (dictionary).")
+                with self.phase_timer.phase("Validation"):
+                    each_event = self.validate_event(each_invocation, resolved_function_arns)
+                    each_idempotency_key = idempotency.validate_idempotency_key(each_invocation)
+                validated_events.append((i, each_event))
+                if each_idempotency_key is not None:
+                    idempotency_keys[i] = each_idempotency_key
+            except Exception as e:
+                event_logger.log_error_event("Invalid invocation {} in batch".format(i), each_invocation, e)
+                results[i] = {
+                    "status": "failed",
+                    "error": "{}".format(e)
+                }
+        
+        event_logger.info("Validated {} of {} invocation(s) in batch.".format(len(validated_events), len(unvalidated_invocations)))
+        event_logger.debug("Function ARN cache: {}".format(json.dumps(self.function_arn_cache.stats())))
+        
+        def put_each_pointer(each_index_event_pair):
+            i, each_event = each_index_event_pair
+            each_schedule_id = "{}-{}".format(context.aws_request_id, i)
+            if i in idempotency_keys:
+                each_schedule_id = idempotency.schedule_id(idempotency_keys[i])
+            try:
+                self.put_pointer(
+                    each_event,
+                    context,
+                    each_schedule_id
+                )
+                return i, {
+                    "status": "queued",
+                    "schedule-id": each_schedule_id
+                }
+            except Exception as e:
+                event_logger.log_error_event("Unable to queue invocation {} in batch".format(i), each_event, e)
+                return i, {
+                    "status": "failed",
+                    "error": "{}".format(e)
+                }
+        
+        if len(validated_events) > 0:
+            
+            # Resolve shared state up front rather than racing for it in the workers.
+            self.get_storage()
+            
+            with ThreadPoolExecutor(max_workers=min(batch_max_workers, len(validated_events))) as executor:
+                repeated_keys = []
+                
+                if len(idempotency_keys) > 0:
+                    validated_events, repeated_keys = self.skip_duplicates(validated_events, idempotency_keys, executor, results)
+                
+                if len(validated_events) > 0:
+                    pointer_events = validated_events
+                    
+                    # Segments are written under new keys each time, so a retried keyed
+                    # invocation would be written twice; those get their own pointers.
+                    if segment_mode:
+                        pointer_events = list(x for x in validated_events if x[0] in idempotency_keys)
+                        segment_events = list(x for x in validated_events if x[0] not in idempotency_keys)
+                        
+                        if len(segment_events) > 0:
+                            self.put_segments(segment_events, context, executor, results)
+                    
+                    for i, each_result in executor.map(put_each_pointer, pointer_events):
+                        results[i] = each_result
+                
+                if len(idempotency_keys) > 0:
+                    self.record_idempotency_keys(validated_events, idempotency_keys, executor, results)
+                    self.answer_repeated_keys(repeated_keys, results)
+        
+        queued_count = len(list(x for x in results if x["status"] == "queued"))
+        duplicate_count = len(list(x for x in results if x.get("duplicate")))
+        
+        self.phase_timer.count("InvocationCount", queued_count - duplicate_count)
+        self.phase_timer.count("DuplicateCount", duplicate_count)
+        
+        return {
+            "message": "Queued {} of {} Lambda invocation(s).".format(queued_count, len(results)),
+            "queued-count": queued_count,
+            "failed-count": len(results) - queued_count,
+            "results": results
+        }
+    
+    def skip_duplicates(self, validated_events, idempotency_keys, executor, results):
+        
+        '''
+            Answers the invocations in a batch whose idempotency keys are
+            already recorded, and returns the rest along with the (index, first
+            index) of each invocation repeating a key used earlier in the batch.
+            Those are answered by answer_repeated_keys once the first is queued.
+        '''
+        
+        validated_events_by_index = dict(validated_events)
+        first_with_key = {}
+        repeated_keys = []
+        
+        for i in sorted(idempotency_keys.keys()):
+            each_first_index = first_with_key.setdefault(idempotency_keys[i], i)
+            
+            if each_first_index == i:
+                continue
+            
+            if idempotency.fingerprint(validated_events_by_index[i]) != idempotency.fingerprint(validated_events_by_index[each_first_index]):
+                results[i] = {
+                    "status": "failed",
+                    "error": "Idempotency key \"{}\" was already used for a different invocation.".format(idempotency_keys[i])
+                }
+            else:
+                repeated_keys.append((i, each_first_index))
+        
+        def check_each_key(i):
+            try:
+                with self.phase_timer.phase("IdempotencyCheck"):
+                    return i, self.get_idempotency_store().get(idempotency_keys[i], validated_events_by_index[i]), None
+            except Exception as e:
+                return i, None, e
+        
+        for i, each_record, each_error in executor.map(check_each_key, sorted(first_with_key.values())):
+            if each_error is not None:
+                results[i] = {
+                    "status": "failed",
+                    "error": "{}".format(each_error)
+                }
+            elif each_record is not None:
+                results[i] = {
+                    "status": "queued",
+                    "schedule-id": each_record["schedule-id"],
+                    "duplicate": True
+                }
+        
+        repeated_indexes = set(x[0] for x in repeated_keys)
+        
+        return list(x for x in validated_events if results[x[0]] is None and x[0] not in repeated_indexes), repeated_keys
+    
+    def record_idempotency_keys(self, queued_events, idempotency_keys, executor, results):
+        
+        '''
+            Records the idempotency keys of the invocations in a batch that
+            were queued. Only recorded once queued, so a failed write can be
+            retried.
+        '''
+        
+        def record_each_key(each_index_event_pair):
+            i, each_event = each_index_event_pair
+            try:
+                with self.phase_timer.phase("StorageWrite"):
+                    self.get_idempotency_store().put(idempotency_keys[i], each_event, results[i]["schedule-id"])
+            except Exception as e:
+                
+                # It's queued regardless; a retry of this request could queue it again.
+                event_logger.error("Unable to record idempotency key for invocation {} in batch: {}".format(i, e))
+        
+        list(executor.map(record_each_key, list(x for x in queued_events if x[0] in idempotency_keys and results[x[0]]["status"] == "queued")))
+    
+    def answer_repeated_keys(self, repeated_keys, results):
+        
+        for i, each_first_index in repeated_keys:
+            results[i] = dict(results[each_first_index])
+            
+            if results[i]["status"] == "queued":
+                results[i]["duplicate"] = True
+    
+    def handle_bulk_import_event(self, unvalidated_event, context):
+        
+        import_options = unvalidated_event["bulk-import"]
+        
+        if not isinstance(import_options, dict) or import_options.get("source") is None:
+            raise Exception("Parameter \"{}\" must be specified as a JSON key/value struct (dictionary) with a \"{}\".".format("bulk-import", "source"))
+        
+        # Checked up front: the queuer can only read sources under imports/ in the shared bucket.
+        source_key = bulk_import.source_key(import_options["source"], self.get_s3_bucket_name())
+        
+        # A new import unless the ID of an earlier one (to resume) is given.
+        import_id = import_options.get("import-id") or "{}".format(uuid.uuid4())
+        
+        storage_backend = self.get_storage()
+        resolved_function_arns = {}
+        
+        def import_record(line_number, unvalidated_record, batch_started):
+            try:
+                if not isinstance(unvalidated_record, dict):
+                    raise Exception("Each record must be specified as a JSON key/value struct (dictionary).")
+                
+                with self.phase_timer.phase("Validation"):
+                    event = self.validate_event(unvalidated_record, resolved_function_arns)
+                
+                self.put_pointer(event, context, "{}-{}".format(import_id, line_number), bucketed_at=batch_started)
+            except Exception as e:
+                event_logger.log_error_event("Unable to import line {}".format(line_number), unvalidated_record, e)
+                raise
+        
+        importer = bulk_import.BulkImporter(
+            storage_backend,
+            import_id,
+            import_options["source"],
+            lambda start_offset: storage_backend.open_object(source_key, start_offset),
+            import_record,
+            lambda x: self.resolve_function_arns(x, resolved_function_arns),
+            bulk_import_batch_size,
+            log = event_logger.info
+        )
+        
+        def should_stop():
+            return context.get_remaining_time_in_millis() < bulk_import_reserved_millis
+        
+        with ThreadPoolExecutor(max_workers=bulk_import_max_workers) as executor:
+            checkpoint = importer.run(executor, should_stop)
+        
+        self.phase_timer.count("InvocationCount", checkpoint["imported-count"])
+        
+        return {
+            "message": "Import complete." if checkpoint["complete"] else "Import incomplete; resume it with the same \"import-id\".",
+            "import-id": import_id,
+            "complete": checkpoint["complete"],
+            "imported-count": checkpoint["imported-count"],
+            "failed-count": checkpoint["failed-count"],
+            "errors": checkpoint["errors"]
+        }
+    
+    def handle_recurring_event(self, unvalidated_event, context):
+        
+        now = time.time()
+        
+        with self.phase_timer.phase("Validation"):
+            event = self.validate_recurring_event(unvalidated_event, now)
+        
+        series = {
+            "schedule-id": "{}".format(uuid.uuid4()),
+            "version": 1
+        }
+        series.update(event)
+        
+        first_occurrence = self.save_recurring_schedule(series, now)
+        
+        return {
+            "message": "Recurring schedule created.",
+            "schedule-id": series["schedule-id"],
+            "next-occurrence": first_occurrence
+        }
+    
+    def handle_update_schedule_event(self, unvalidated_event, context):
+        
+        now = time.time()
+        schedule_id = unvalidated_event["update-schedule"]
+        
+        series = self.get_recurrence_expander().load_series(schedule_id)
+        
+        if series is None:
+            raise Exception("Recurring schedule \"{}\" not found.".format(schedule_id))
+        
+        # Unchanged fields are taken from the series as it stands.
+        merged_event = {
+            "function-name": series["function-arn"],
+            "payload": series["payload"],
+            "schedule-expression": series["schedule-expression"],
+            "start-time": series["start-time"],
+            "end-time": series.get("end-time"),
+            "dispatch-limits": series.get("dispatch-limits"),
+            "max-staleness-seconds": series.get("max-staleness-seconds")
+        }
+        merged_event.update(dict((x, y) for x, y in unvalidated_event.items() if x != "update-schedule"))
+        
+        with self.phase_timer.phase("Validation"):
+            event = self.validate_recurring_event(merged_event, now, {series["function-arn"]: series["function-arn"]})
+        
+        # Limits left out of the update are cleared.
+        series.pop("dispatch-limits", None)
+        series.pop("max-staleness-seconds", None)
+        series.update(event)
+        series["version"] += 1
+        
+        next_occurrence = self.save_recurring_schedule(series, now)
+        
+        return {
+            "message": "Recurring schedule updated.",
+            "schedule-id": schedule_id,
+            "next-occurrence": next_occurrence
+        }
+    
+    def handle_cancel_schedule_event(self, unvalidated_event, context):
+        
+        schedule_id = "{}".format(unvalidated_event["cancel-schedule"])
+        
+        if self.get_storage().get_object_if_exists(recurrence.series_key(schedule_id)) is not None:
+            
+            # Pointers and markers already written are dropped once they find it gone.
+            self.get_storage().delete_object(recurrence.series_key(schedule_id))
+            
+            return {
+                "message": "Recurring schedule cancelled.",
+                "schedule-id": schedule_id
+            }
+        
+        location = self.find_schedule(schedule_id)
+        
+        # Read first, for the stored payload it holds a reference to (if any).
+        try:
+            s3_pointer_content = self.get_scheduled_pointer(schedule_id, location)
+        except Exception as e:
+            event_logger.warning("Unable to read schedule {} before cancelling it: {}".format(schedule_id, e))
+            s3_pointer_content = {}
+        
+        if "key" in location:
+            self.get_storage().delete_object(location["key"])
+            self.get_schedule_index().delete(schedule_id)
+        else:
+            self.get_schedule_index().cancel_segment_record(location["bucket-minute"], schedule_id)
+        
+        if "payload-ref" in s3_pointer_content:
+            self.get_payload_store().release(s3_pointer_content["payload-ref"], schedule_id)
+        
+        return {
+            "message": "Scheduled invocation cancelled.",
+            "schedule-id": schedule_id
+        }
+    
+    def handle_get_schedule_event(self, unvalidated_event, context):
+        
+        schedule_id = "{}".format(unvalidated_event["get-schedule"])
+        
+        series = self.get_recurrence_expander().load_series(schedule_id)
+        
+        if series is not None:
+            return {
+                "schedule-id": schedule_id,
+                "type": "recurring",
+                "function-arn": series["function-arn"],
+                "payload": series["payload"],
+                "schedule-expression": series["schedule-expression"],
+                "start-time": series["start-time"],
+                "end-time": series.get("end-time"),
+                "dispatch-limits": series.get("dispatch-limits"),
+                "max-staleness-seconds": series.get("max-staleness-seconds"),
+                "next-occurrence": None if series["next-occurrence"] is None else keys.epoch_to_datetime_string(series["next-occurrence"])
+            }
+        
+        s3_pointer_content = self.get_scheduled_pointer(schedule_id, self.find_schedule(schedule_id))
+        
+        response = {
+            "schedule-id": schedule_id,
+            "type": "one-time",
+            "function-arn": s3_pointer_content["function-arn"],
+            "execution-time": s3_pointer_content["execution-time"]
+        }
+        
+        if "payload" in s3_pointer_content:
+            response["payload"] = s3_pointer_content["payload"]
+        else:
+            response["payload-bytes"] = s3_pointer_content["payload-bytes"]
+        
+        for each_name in ["dispatch-limits", "max-staleness-seconds"]:
+            if each_name in s3_pointer_content:
+                response[each_name] = s3_pointer_content[each_name]
+        
+        return response
+    
+    def handle_reschedule_event(self, unvalidated_event, context):
+        
+        schedule_id = "{}".format(unvalidated_event["reschedule-schedule"])
+        
+        with self.phase_timer.phase("Validation"):
+            execution_time = self.validate_execution_time(unvalidated_event)
+        
+        location = self.find_schedule(schedule_id)
+        s3_pointer_content = self.get_scheduled_pointer(schedule_id, location)
+        
+        s3_pointer_content.pop("execution-time")
+        s3_pointer_content.pop("pointer-id", None)
+        s3_pointer_content.pop("claimed-until", None)
+        s3_pointer_content["indexed"] = True
+        
+        pointer_key, index_marker_key = keys.pointer_key(
+            execution_time,
+            schedule_id,
+            queue_shard_count
+        )
+        
+        # The new pointer goes in before the old one is removed.
+        self.get_schedule_index().put_pointer_location(schedule_id, pointer_key)
+        
+        with self.phase_timer.phase("StorageWrite"):
+            self.get_storage().put_object(pointer_key, records.encode_pointer_record(s3_pointer_content))
+        
+        self.put_index_marker(index_marker_key)
+        
+        if "key" not in location:
+            self.get_schedule_index().cancel_segment_record(location["bucket-minute"], schedule_id)
+        elif location["key"] != pointer_key:
+            self.get_storage().delete_object(location["key"])
+        
+        return {
+            "message": "Scheduled invocation rescheduled.",
+            "schedule-id": schedule_id,
+            "execution-time": execution_time
+        }
+    
+    def find_schedule(self, schedule_id):
+        
+        location = self.get_schedule_index().find(schedule_id)
+        
+        if location is None:
+            raise Exception("Schedule \"{}\" not found.".format(schedule_id))
+        
+        return location
+    
+    def get_scheduled_pointer(self, schedule_id, location):
+        
+        '''
+            Returns the pointer record for a one-time schedule, with its
+            "execution-time".
+        '''
+        
+        if "key" in location:
+            pointer_body = self.get_storage().get_object_if_exists(location["key"])
+            
+            if pointer_body is not None:
+                s3_pointer_content = records.decode_pointer_record(pointer_body)
+                s3_pointer_content["execution-time"] = keys.parse_pointer_key(location["key"])["execution-time"]
+                return s3_pointer_content
+        else:
+            
+            # Whichever shard's segments hold it; only these lookups pay for the scan.
+            for each_shard_number in range(queue_shard_count):
+                each_prefix = keys.shard_minute_prefix("{:02x}".format(each_shard_number), location["bucket-minute"])
+                
+                for each_key in self.get_storage().list_keys(each_prefix):
+                    if not keys.is_segment_key(each_key):
+                        continue
+                    
+                    each_segment_records = segments.iter_segment_records(self.get_storage().open_object(each_key))
+                    next(each_segment_records)
+                    
+                    for each_record in each_segment_records:
+                        if each_record["pointer-id"] == schedule_id:
+                            return each_record
+        
+        # Dispatched (or cancelled) after the index was read.
+        raise Exception("Schedule \"{}\" not found.".format(schedule_id))
+    
+    def save_recurring_schedule(self, series, now):
+        
+        '''
+            Saves a new or updated series and writes its occurrences up to the
+            horizon. Returns its first occurrence from now on.
+        '''
+        
+        expression = recurrence.parse_schedule_expression(series["schedule-expression"], series["start-time"])
+        
+        series["next-occurrence"] = expression.next_occurrence(now - 1)
+        
+        if series["next-occurrence"] is not None and series.get("end-time") is not None and series["next-occurrence"] > series["end-time"]:
+            series["next-occurrence"] = None
+        
+        if series["next-occurrence"] is None:
+            raise Exception("Schedule expression \"{}\" has no occurrences from now on.".format(series["schedule-expression"]))
+        
+        first_occurrence = series["next-occurrence"]
+        
+        with self.phase_timer.phase("StorageWrite"):
+            occurrence_count = self.get_recurrence_expander().expand(series, now)
+        
+        self.phase_timer.count("InvocationCount", occurrence_count)
+        
+        return keys.epoch_to_datetime_string(first_occurrence)
+    
+    def resolve_function_arns(self, unvalidated_invocations, resolved_function_arns):
+        
+        '''
+            Resolves the function names in unvalidated_invocations that aren't
+            already in resolved_function_arns, storing each ARN (or the exception
+            raised looking it up) there for validate_event.
+        '''
+        
+        for each_invocation in unvalidated_invocations:
+            if isinstance(each_invocation, dict) and each_invocation.get("function-name") is not None:
+                each_function_name = each_invocation["function-name"]
+                
+                if each_function_name in resolved_function_arns:
+                    continue
+                
+                try:
+                    resolved_function_arns[each_function_name] = self.get_function_arn(each_function_name)
+                except Exception as e:
+                    resolved_function_arns[each_function_name] = e
+    
+    def put_segments(self, validated_events, context, executor, results):
+        
+        def put_segment(bucket_minute, segment_records, record_lines):
+            
+            segment_key, index_marker_key = keys.segment_key(
+                bucket_minute,
+                min(x["execution-time"] for x in segment_records),
+                "{}".format(uuid.uuid4()),
+                queue_shard_count
+            )
+            
+            with self.phase_timer.phase("Serialization"):
+                segment_body = segments.serialize_segment(segment_records, record_lines)
+                self.phase_timer.count("PayloadBytes", len(segment_body))
+                segment_body = records.compress_body(segment_body)
+            
+            with self.phase_timer.phase("StorageWrite"):
+                self.get_storage().put_object(segment_key, segment_body)
+            
+            self.put_index_marker(index_marker_key)
+        
+        def on_flushed_callback(i):
+            def on_flushed(error):
+                if error is None:
+                    results[i] = {
+                        "status": "queued",
+                        "schedule-id": "{}-{}".format(context.aws_request_id, i)
+                    }
+                else:
+                    event_logger.error("Unable to write segment for invocation {} in batch: {}".format(i, error))
+                    results[i] = {
+                        "status": "failed",
+                        "error": "{}".format(error)
+                    }
+            return on_flushed
+        
+        segment_writer = segments.SegmentWriter(
+            put_segment,
+            segment_max_records,
+            segment_max_bytes
+        )
+        
+        futures = []
+        
+        # Indexed before any of them is written.
+        self.get_schedule_index().put_segment_locations(
+            context.aws_request_id,
+            dict((i, keys.bucket_minute_for_execution_time(x["execution-time"])) for i, x in validated_events)
+        )
+        
+        for i, each_event in validated_events:
+            s3_pointer_content = self.build_pointer_content(each_event, context)
+            s3_pointer_content["execution-time"] = each_event["execution-time"]
+            s3_pointer_content["pointer-id"] = "{}-{}".format(context.aws_request_id, i)
+            
+            # Before it's added, so the segment limits count what's written.
+            with self.phase_timer.phase("PayloadStore"):
+                s3_pointer_content = self.get_payload_store().externalize(s3_pointer_content, s3_pointer_content["pointer-id"])
+            
+            with self.phase_timer.phase("Serialization"):
+                full_buffers = segment_writer.add(
+                    keys.bucket_minute_for_execution_time(each_event["execution-time"]),
+                    s3_pointer_content,
+                    on_flushed_callback(i)
+                )
+            
+            for each_bucket_minute, each_entries in full_buffers:
+                futures.append(executor.submit(segment_writer.write, each_bucket_minute, each_entries))
+        
+        # Nothing is acknowledged until every segment holding it has been written.
+        segment_writer.flush(executor, flush_all=True)
+        
+        for each_future in futures:
+            each_future.result()
+    
+    def build_pointer_content(self, event, context):
+        
         s3_pointer_content = {
             "function-arn": event["function-arn"],
             "payload": event["payload"],
@@ -34,22 +938,85 @@ class LambdaHandler(object):
             "queued-log-group": context.log_group_name,
             "queued-log-stream": context.log_stream_name
         }
-
-        self.s3_bucket.put_object(
-            Body = json.dumps(s3_pointer_content, indent=4),
-            Key = "queued/{}/{}.json".format(
-                event["execution-time"],
-                context.aws_request_id
-            )
+        
+        for each_name in ["dispatch-limits", "max-staleness-seconds"]:
+            if each_name in event:
+                s3_pointer_content[each_name] = event[each_name]
+        
+        return s3_pointer_content
+    
+    def put_pointer(self, event, context, pointer_id, claimed_until=None, bucketed_at=None):
+        
+        '''
+            Writes an invocation's pointer, claimed by this queuer (and left alone
+            by the dispatcher) until claimed_until if given. Returns its key.
+            A past-due pointer is bucketed as of bucketed_at if given, so that
+            writing it again later puts it under the same key.
+        '''
+        
+        s3_pointer_content = self.build_pointer_content(event, context)
+        
+        if claimed_until is not None:
+            s3_pointer_content["claimed-until"] = int(claimed_until)
+        
+        with self.phase_timer.phase("PayloadStore"):
+            s3_pointer_content = self.get_payload_store().externalize(s3_pointer_content, pointer_id)
+        
+        pointer_key, index_marker_key = keys.pointer_key(
+            event["execution-time"],
+            pointer_id,
+            queue_shard_count,
+            now = bucketed_at
         )
+        
+        # Indexed before it's written, so there's never a pointer that can't be found.
+        with self.phase_timer.phase("StorageWrite"):
+            self.get_schedule_index().put_pointer_location(pointer_id, pointer_key)
+        
+        s3_pointer_content["indexed"] = True
+        
+        with self.phase_timer.phase("Serialization"):
+            pointer_body = records.serialize_pointer_record(s3_pointer_content)
+            self.phase_timer.count("PayloadBytes", len(pointer_body))
+            pointer_body = records.compress_body(pointer_body)
+        
+        with self.phase_timer.phase("StorageWrite"):
+            self.get_storage().put_object(pointer_key, pointer_body)
+        
+        self.put_index_marker(index_marker_key)
+        
+        return pointer_key
+    
+    def put_index_marker(self, index_marker_key):
+        
+        bucket_minute = index_marker_key.split("/")[1]
+        
+        with self.written_index_markers_lock:
+            if index_marker_key in self.written_index_markers.get(bucket_minute, set()):
+                return
+        
+        with self.phase_timer.phase("StorageWrite"):
+            self.get_storage().put_object(index_marker_key, b"")
+        
+        with self.written_index_markers_lock:
+            self.written_index_markers.setdefault(bucket_minute, set()).add(index_marker_key)
+            
+            # Writers never go back to a closed bucket, so its entries can go.
+            for each_bucket_minute in list(self.written_index_markers.keys()):
+                if keys.is_bucket_closed(each_bucket_minute):
+                    del self.written_index_markers[each_bucket_minute]
 
-        return {
-            "message": "Lambda invocation queued successfully."
-        }
-
-    def validate_event(self, unvalidated_event):
+    def validate_event(self, unvalidated_event, resolved_function_arns=None):
         clean_event = {}
 
+        clean_event["execution-time"] = self.validate_execution_time(unvalidated_event)
+        
+        clean_event.update(self.validate_target(unvalidated_event, resolved_function_arns))
+
+        return clean_event
+
+    def validate_execution_time(self, unvalidated_event):
+        
         execution_datetime = None
         execution_time_specified = unvalidated_event.get("execution-time")
         try:
@@ -61,7 +1028,40 @@ class LambdaHandler(object):
         if execution_datetime is None:
             raise Exception("Parameter \"{}\" must be specified as the number of seconds since UNIX epoch.".format("execution-time"))
 
-        clean_event["execution-time"] = execution_datetime.strftime(datetime_string_format)
+        return execution_datetime.strftime(datetime_string_format)
+
+    def validate_recurring_event(self, unvalidated_event, now, resolved_function_arns=None):
+        clean_event = {}
+        
+        for each_parameter_name, each_default in [("start-time", int(now)), ("end-time", None)]:
+            each_value = unvalidated_event.get(each_parameter_name, each_default)
+            
+            if each_value is not None:
+                try:
+                    each_value = int(each_value)
+                except:
+                    raise Exception("Parameter \"{}\" must be specified as the number of seconds since UNIX epoch.".format(each_parameter_name))
+            
+            clean_event[each_parameter_name] = each_value
+        
+        if clean_event["end-time"] is not None and clean_event["end-time"] < clean_event["start-time"]:
+            raise Exception("Parameter \"{}\" must not be before \"{}\".".format("end-time", "start-time"))
+        
+        recurrence.parse_schedule_expression(unvalidated_event.get("schedule-expression"), clean_event["start-time"])
+        
+        clean_event["schedule-expression"] = unvalidated_event["schedule-expression"]
+        
+        clean_event.update(self.validate_target(unvalidated_event, resolved_function_arns))
+        
+        return clean_event
+
+    def validate_target(self, unvalidated_event, resolved_function_arns=None):
+        
+        '''
+            Validates the function and payload of an event.
+        '''
+        
+        clean_event = {}
 
         lambda_function_arn = None
         lambda_function_specified = unvalidated_event.get("function-name")
@@ -69,19 +1069,12 @@ class LambdaHandler(object):
         if lambda_function_specified is None:
             raise Exception("Parameter \"{}\" must be specified as the name or ARN of a Lambda function.".format("function-name"))
 
-        lambda_client = boto3.client("lambda")
-
-        if lambda_function_specified is not None:
-            try:
-                response = lambda_client.get_function(
-                    FunctionName = lambda_function_specified
-                )
-                lambda_function_arn = response["Configuration"]["FunctionArn"]
-            except botocore.exceptions.ClientError as e:
-                if e.response["Error"]["Code"] == "ResourceNotFoundException":
-                    raise Exception("Function \"{}\" not found.".format(lambda_function_specified))
-                else:
-                    raise
+        if resolved_function_arns is not None and lambda_function_specified in resolved_function_arns:
+            lambda_function_arn = resolved_function_arns[lambda_function_specified]
+            if isinstance(lambda_function_arn, Exception):
+                raise lambda_function_arn
+        else:
+            lambda_function_arn = self.get_function_arn(lambda_function_specified)
 
         clean_event["function-arn"] = lambda_function_arn
 
@@ -98,17 +1091,59 @@ class LambdaHandler(object):
 
         clean_event["payload"] = lambda_payload
 
+        # Limits on how hard the dispatcher invokes the function for this schedule.
+        if unvalidated_event.get("dispatch-limits") is not None:
+            clean_event["dispatch-limits"] = rate_limits.validate_limits(unvalidated_event["dispatch-limits"])
+
+        # How late the dispatcher may still invoke it, after an outage.
+        if unvalidated_event.get("max-staleness-seconds") is not None:
+            try:
+                clean_event["max-staleness-seconds"] = int(unvalidated_event["max-staleness-seconds"])
+            except:
+                clean_event["max-staleness-seconds"] = 0
+
+            if clean_event["max-staleness-seconds"] <= 0:
+                raise Exception("Parameter \"{}\" must be specified as a positive whole number of seconds.".format("max-staleness-seconds"))
+
         return clean_event
 
+    def get_function_arn(self, lambda_function_specified):
+        
+        with self.phase_timer.phase("ArnResolution"):
+            return self.resolve_function_arn(lambda_function_specified)
+    
+    def resolve_function_arn(self, lambda_function_specified):
+        
+        cache_hit, lambda_function_arn = self.function_arn_cache.get(lambda_function_specified)
+        
+        if not cache_hit:
+            try:
+                response = get_boto3_client("lambda").get_function(
+                    FunctionName = lambda_function_specified
+                )
+                lambda_function_arn = response["Configuration"]["FunctionArn"]
+            except Exception as e:
+                if getattr(e, "response", {}).get("Error", {}).get("Code") == "ResourceNotFoundException":
+                    lambda_function_arn = None
+                else:
+                    raise
+            
+            self.function_arn_cache.put(lambda_function_specified, lambda_function_arn)
+        
+        if lambda_function_arn is None:
+            raise Exception("Function \"{}\" not found.".format(lambda_function_specified))
+        
+        return lambda_function_arn
+
     def get_own_cloudformation_metadata(self):
 
         if hasattr(self, "_own_cloudformation_metadata"):
             return self._own_cloudformation_metadata
 
-        caller_arn = boto3.client("sts").get_caller_identity()["Arn"]
+        caller_arn = get_boto3_client("sts").get_caller_identity()["Arn"]
         caller_role = caller_arn.split(":")[5].split("/")[1]
 
-        policy_response = boto3.client("iam").get_role_policy(
+        policy_response = get_boto3_client("iam").get_role_policy(
             RoleName = caller_role,
             PolicyName = "InvocationQueuerFunctionRoleActions"
         )
@@ -126,20 +1161,76 @@ class LambdaHandler(object):
         if this_stack_id is None:
             raise Exception("Unable to determine CloudFormation stack ID from IAM policy.")
         
-        response = boto3.client("cloudformation").describe_stack_resource(
+        response = get_boto3_client("cloudformation").describe_stack_resource(
             StackName = this_stack_id,
             LogicalResourceId = "InvocationQueuerFunction"
         )
 
         own_metadata = json.loads(response["StackResourceDetail"]["Metadata"])
 
-        print("Own CloudFormation metadata: {}".format(json.dumps(own_metadata)))
+        event_logger.info("Own CloudFormation metadata: {}".format(json.dumps(own_metadata)))
 
         self._own_cloudformation_metadata = own_metadata
 
         return own_metadata
 
+    def get_storage(self):
+        
+        if not hasattr(self, "_storage"):
+            self._storage = storage.create_storage_backend(
+                self.get_s3_bucket_name,
+                lambda: get_boto3_client("s3")
+            )
+        
+        return self._storage
+
+    def get_recurrence_expander(self):
+        
+        if not hasattr(self, "_recurrence_expander"):
+            self._recurrence_expander = recurrence.RecurrenceExpander(
+                self.get_storage(),
+                recurrence_horizon_seconds,
+                queue_shard_count
+            )
+        
+        return self._recurrence_expander
+    
+    def get_schedule_index(self):
+        
+        if not hasattr(self, "_schedule_index"):
+            self._schedule_index = schedule_index.ScheduleIndex(self.get_storage())
+        
+        return self._schedule_index
+    
+    def get_idempotency_store(self):
+        
+        if not hasattr(self, "_idempotency_store"):
+            self._idempotency_store = idempotency.IdempotencyStore(
+                self.get_storage(),
+                idempotency_retention_seconds
+            )
+        
+        return self._idempotency_store
+    
+    def get_payload_store(self):
+        
+        if not hasattr(self, "_payload_store"):
+            self._payload_store = payloads.PayloadStore(
+                self.get_storage(),
+                payload_store_threshold_bytes
+            )
+        
+        return self._payload_store
+    
     def get_s3_bucket_name(self):
+        
+        # Set by the stack template. The metadata lookup is only needed by 
+        # functions deployed before the environment variable existed.
+        s3_bucket_name = os.environ.get("SHARED_BUCKET")
+        
+        if s3_bucket_name:
+            return s3_bucket_name
+        
         return self.get_own_cloudformation_metadata()["SharedBucket"]
 
 
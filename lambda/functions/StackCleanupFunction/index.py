@@ -0,0 +1,201 @@
+from __future__ import print_function
+
+import os, json, time, threading
+import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from lambda_scheduler import storage, purge
+
+try:
+    from urllib2 import build_opener, HTTPHandler, Request
+except:
+    from urllib.request import build_opener, HTTPHandler, Request
+
+# Each worker lists and deletes its own part of the keyspace.
+purge_max_workers = int(os.environ.get("PURGE_MAX_WORKERS", 32))
+
+# Once less than this is left, the rest of a purge is handed to a new
+# invocation, up to purge_max_continuations times.
+purge_reserved_millis = int(os.environ.get("PURGE_RESERVED_MILLIS", 30000))
+purge_max_continuations = int(os.environ.get("PURGE_MAX_CONTINUATIONS", 10))
+
+# What a retention sweep deletes, unless its event says otherwise.
+retention_sweep_prefixes = ["dispatched/", "failed/"]
+
+boto3_clients = {}
+boto3_clients_lock = threading.Lock()
+
+def get_boto3_client(service_name):
+
+    if service_name not in boto3_clients:
+        with boto3_clients_lock:
+            if service_name not in boto3_clients:
+                boto3_clients[service_name] = boto3.client(
+                    service_name,
+                    config = Config(max_pool_connections=purge_max_workers)
+                )
+
+    return boto3_clients[service_name]
+
+def send_cfn_response(event, context, response_status):
+
+    '''
+        Reports a custom resource's outcome to CloudFormation (what the
+        cfnresponse module does for functions defined inline).
+    '''
+
+    response_body = json.dumps({
+        "Status": response_status,
+        "Reason": "See CloudWatch Logs: {}".format(context.log_stream_name),
+        "PhysicalResourceId": event.get("PhysicalResourceId") or context.log_stream_name,
+        "StackId": event["StackId"],
+        "RequestId": event["RequestId"],
+        "LogicalResourceId": event["LogicalResourceId"],
+        "Data": {}
+    }).encode("utf-8")
+
+    request = Request(event["ResponseURL"], data=response_body)
+    request.add_header("Content-Type", "")
+    request.add_header("Content-Length", "{}".format(len(response_body)))
+    request.get_method = lambda: "PUT"
+
+    build_opener(HTTPHandler).open(request)
+
+class LambdaHandler(object):
+
+    def __init__(self, context):
+        pass
+
+    def handle_event(self, event, context):
+        print("Received event: {}".format(json.dumps(event)))
+
+        if "retention-sweep" in event:
+            return self.handle_retention_sweep_event(event, context)
+
+        if event.get("RequestType") == "Delete":
+
+            #
+            # Make sure the STACK is being deleted (and not just this resource).
+            #
+            # This avoids someone who's just tinkering with the template from wiping out
+            # the whole bucket.
+            #
+            if "purge-continuation" in event or boto3.resource("cloudformation").Stack(event["StackId"]).stack_status == "DELETE_IN_PROGRESS":
+                try:
+                    result = self.handle_cleanup_event(event, context)
+                except Exception as e:
+                    print("Error emptying bucket: {}".format(e))
+
+                    # Retried by a continuation from the last totals, or reported as failed once they've run out.
+                    continuation = event.get("purge-continuation", {})
+                    result = {
+                        "complete": False,
+                        "total-deleted-count": continuation.get("total-deleted-count", 0)
+                    }
+
+                # The stack waits for the invocation that finishes, and is told
+                # it failed if the bucket couldn't be emptied in time.
+                if not result["complete"]:
+                    if self.continue_purge(event, context, result):
+                        return result
+
+                    send_cfn_response(event, context, "FAILED")
+
+                    return {}
+
+        send_cfn_response(event, context, "SUCCESS")
+
+        return {}
+
+    def handle_cleanup_event(self, event, context):
+
+        storage_backend = self.get_storage(event["ResourceProperties"]["SharedBucket"])
+
+        return self.purge(storage_backend, [""], event, context)
+
+    def handle_retention_sweep_event(self, event, context):
+
+        sweep_options = event["retention-sweep"]
+
+        # Fixed when the sweep starts, so continuations delete the same records.
+        if "cutoff-epoch" not in sweep_options:
+            sweep_options["cutoff-epoch"] = int(time.time() - int(sweep_options["retention-days"]) * 24 * 60 * 60)
+
+        storage_backend = self.get_storage(os.environ["SHARED_BUCKET"])
+
+        expired_prefixes = []
+
+        for each_prefix in sweep_options.get("prefixes", retention_sweep_prefixes):
+            expired_prefixes.extend(purge.expired_prefixes(storage_backend, each_prefix, sweep_options["cutoff-epoch"]))
+
+        result = self.purge(storage_backend, expired_prefixes, event, context)
+
+        if not result["complete"]:
+            self.continue_purge(event, context, result)
+
+        return result
+
+    def purge(self, storage_backend, prefixes, event, context):
+
+        def should_stop():
+            return context.get_remaining_time_in_millis() < purge_reserved_millis
+
+        with ThreadPoolExecutor(max_workers=purge_max_workers) as executor:
+            result = purge.Purger(storage_backend).purge(prefixes, executor, should_stop)
+
+        # Totals across continuations.
+        continuation = event.get("purge-continuation", {})
+        result["total-deleted-count"] = continuation.get("total-deleted-count", 0) + result["deleted-count"]
+
+        print("Purge result: {}".format(json.dumps(result)))
+
+        return result
+
+    def continue_purge(self, event, context, result):
+
+        '''
+            Hands the rest of a purge to a new invocation of this function.
+            Returns False once purge_max_continuations have been used.
+        '''
+
+        continuation_count = event.get("purge-continuation", {}).get("count", 0) + 1
+
+        if continuation_count > purge_max_continuations:
+            print("Purge incomplete after {} continuation(s); giving up.".format(purge_max_continuations))
+            return False
+
+        continued_event = dict(event)
+        continued_event["purge-continuation"] = {
+            "count": continuation_count,
+            "total-deleted-count": result["total-deleted-count"]
+        }
+
+        get_boto3_client("lambda").invoke(
+            FunctionName = context.invoked_function_arn,
+            InvocationType = "Event",
+            Payload = json.dumps(continued_event)
+        )
+
+        print("Purge continued in invocation {}.".format(continuation_count))
+
+        return True
+
+    def get_storage(self, s3_bucket_name):
+
+        if not hasattr(self, "_storage"):
+            self._storage = storage.create_storage_backend(
+                lambda: s3_bucket_name,
+                lambda: get_boto3_client("s3")
+            )
+
+        return self._storage
+
+
+handler_object = None
+def lambda_handler(event, context):
+    global handler_object
+
+    if handler_object is None:
+        handler_object = LambdaHandler(context)
+
+    return handler_object.handle_event(event, context)
@@ -0,0 +1,239 @@
+'''
+    Streaming bulk import of newline-delimited schedule records (one JSON
+    object per line, in the same form as a single queuer request).
+
+    The source is streamed, never read whole, and imported in batches. After
+    each batch, the byte offset reached is saved as a checkpoint, so an
+    interrupted import resumes from its last completed batch. Records are
+    imported with ids derived from the import id and their line number, and a
+    batch's pointers are bucketed as of the time the batch was first started
+    (saved in the checkpoint), so a batch that's imported again overwrites its
+    earlier pointers rather than duplicating them.
+
+    Sources have to be under imports/ in the shared bucket, the only place the
+    queuer can read them from.
+'''
+
+from __future__ import print_function
+
+import json, time
+
+checkpoint_format_version = 1
+
+# Errors kept in the checkpoint; the rest are only counted.
+checkpoint_max_errors = 100
+
+source_prefix = "imports/"
+
+def checkpoint_key(import_id):
+    return "{}{}/checkpoint.json".format(source_prefix, import_id)
+
+def source_key(source, shared_bucket_name):
+
+    '''
+        Returns the key of an import source given as "s3://<bucket>/<key>" or a
+        key, raising if it isn't under imports/ in the shared bucket.
+    '''
+
+    key = source
+
+    if source.startswith("s3://"):
+        bucket_name, key = (source[len("s3://"):].split("/", 1) + [""])[:2]
+
+        if bucket_name != shared_bucket_name:
+            raise Exception("Import source \"{}\" must be in the shared bucket (\"{}\"); copy it to s3://{}/{}.".format(source, shared_bucket_name, shared_bucket_name, source_prefix))
+
+    if not key.startswith(source_prefix) or key.endswith("/checkpoint.json") or len(key) == len(source_prefix):
+        raise Exception("Import source \"{}\" must be a file under \"{}\" in the shared bucket.".format(source, source_prefix))
+
+    return key
+
+def iter_lines(fileobj, start_offset=0, chunk_size=64 * 1024):
+
+    '''
+        Yields (line, end_offset) for each non-empty line read from fileobj,
+        which starts start_offset bytes into its source. end_offset is where
+        the next line starts.
+    '''
+
+    offset = start_offset
+    pending = b""
+
+    while True:
+        chunk = fileobj.read(chunk_size)
+
+        if not chunk:
+            break
+
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+
+        for each_line in lines:
+            offset += len(each_line) + 1
+            if each_line.strip():
+                yield each_line, offset
+
+    if pending.strip():
+        yield pending, offset + len(pending)
+
+class BulkImporter(object):
+
+    '''
+        Imports a source in batches of batch_size records. For each batch,
+        prepare_batch(records) is called once (e.g. to resolve function names),
+        then import_record(line_number, record, batch_started) for each record
+        through the executor, where batch_started is when the batch was first
+        started (the same if it's imported again after an interruption).
+        import_record raises if the record can't be imported.
+
+        Stops early (with the checkpoint saved) once should_stop() is true.
+    '''
+
+    def __init__(self, storage_backend, import_id, source, open_source, import_record, prepare_batch=None, batch_size=1000, progress_interval_seconds=10, log=print):
+        self.storage_backend = storage_backend
+        self.import_id = import_id
+        self.source = source
+        self.open_source = open_source
+        self.import_record = import_record
+        self.prepare_batch = prepare_batch
+        self.batch_size = batch_size
+        self.progress_interval_seconds = progress_interval_seconds
+        self.log = log
+
+    def load_checkpoint(self):
+
+        checkpoint_body = self.storage_backend.get_object_if_exists(checkpoint_key(self.import_id))
+
+        if checkpoint_body is None:
+            return {
+                "checkpoint-format-version": checkpoint_format_version,
+                "import-id": self.import_id,
+                "source": self.source,
+                "offset": 0,
+                "line-count": 0,
+                "imported-count": 0,
+                "failed-count": 0,
+                "errors": [],
+                "batch-started": None,
+                "complete": False
+            }
+
+        checkpoint = json.loads(checkpoint_body.decode("utf-8"))
+
+        if checkpoint["source"] != self.source:
+            raise Exception("Import \"{}\" was started from a different source: \"{}\".".format(self.import_id, checkpoint["source"]))
+
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        self.storage_backend.put_object(
+            checkpoint_key(self.import_id),
+            json.dumps(checkpoint, separators=(",", ":")).encode("utf-8")
+        )
+
+    def run(self, executor, should_stop=lambda: False):
+
+        '''
+            Imports from the last checkpoint onwards and returns the checkpoint
+            reached.
+        '''
+
+        checkpoint = self.load_checkpoint()
+
+        if checkpoint["complete"]:
+            return checkpoint
+
+        started = time.time()
+        last_reported = started
+        started_line_count = checkpoint["line-count"]
+
+        source_lines = iter_lines(
+            self.open_source(checkpoint["offset"]),
+            checkpoint["offset"]
+        )
+
+        while True:
+            batch = []
+            end_offset = checkpoint["offset"]
+
+            for each_line, each_end_offset in source_lines:
+                batch.append((checkpoint["line-count"] + len(batch) + 1, each_line))
+                end_offset = each_end_offset
+
+                if len(batch) >= self.batch_size:
+                    break
+
+            if len(batch) == 0:
+                checkpoint["complete"] = True
+                break
+
+            # Saved first, so that an interrupted batch is imported again as it was.
+            if checkpoint.get("batch-started") is None:
+                checkpoint["batch-started"] = int(time.time())
+                self.save_checkpoint(checkpoint)
+
+            self.import_batch(batch, executor, checkpoint)
+
+            checkpoint["offset"] = end_offset
+            checkpoint["line-count"] += len(batch)
+            checkpoint["batch-started"] = None
+            self.save_checkpoint(checkpoint)
+
+            if time.time() - last_reported >= self.progress_interval_seconds:
+                last_reported = time.time()
+                self.log_progress(checkpoint, checkpoint["line-count"] - started_line_count, last_reported - started)
+
+            if should_stop():
+                break
+
+        self.save_checkpoint(checkpoint)
+        self.log_progress(checkpoint, checkpoint["line-count"] - started_line_count, time.time() - started)
+
+        return checkpoint
+
+    def import_batch(self, batch, executor, checkpoint):
+
+        parsed_batch = []
+
+        for each_line_number, each_line in batch:
+            try:
+                parsed_batch.append((each_line_number, json.loads(each_line.decode("utf-8"))))
+            except Exception as e:
+                self.record_error(checkpoint, each_line_number, "Invalid JSON: {}".format(e))
+
+        if self.prepare_batch is not None:
+            self.prepare_batch(list(x[1] for x in parsed_batch))
+
+        def import_each_record(each_line_number_record_pair):
+            each_line_number, each_record = each_line_number_record_pair
+            try:
+                self.import_record(each_line_number, each_record, checkpoint["batch-started"])
+                return each_line_number, None
+            except Exception as e:
+                return each_line_number, e
+
+        for each_line_number, each_error in executor.map(import_each_record, parsed_batch):
+            if each_error is None:
+                checkpoint["imported-count"] += 1
+            else:
+                self.record_error(checkpoint, each_line_number, "{}".format(each_error))
+
+    def record_error(self, checkpoint, line_number, error):
+
+        checkpoint["failed-count"] += 1
+
+        if len(checkpoint["errors"]) < checkpoint_max_errors:
+            checkpoint["errors"].append({
+                "line-number": line_number,
+                "error": error
+            })
+
+    def log_progress(self, checkpoint, line_count, elapsed_seconds):
+        self.log("Import {}: {} record(s) imported, {} failed, {:.1f} record(s)/sec.{}".format(
+            self.import_id,
+            checkpoint["imported-count"],
+            checkpoint["failed-count"],
+            line_count / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+            " Complete." if checkpoint["complete"] else ""
+        ))
@@ -0,0 +1,146 @@
+'''
+    Request logging with levels, sampled event dumps and payload truncation.
+
+    Dumping every event in full costs a serialization of the payload and a
+    CloudWatch Logs line as large as the payload itself. Instead, a sample of
+    events (event_sample_rate) is dumped with each payload cut to
+    payload_max_bytes and tagged with its size and SHA-256 hash, and the rest
+    are logged as a summary that never serializes the payload. Errors are
+    always logged with the complete offending event.
+'''
+
+from __future__ import print_function
+
+import os, json, random, hashlib
+
+levels = {
+    "DEBUG": 10,
+    "INFO": 20,
+    "WARNING": 30,
+    "ERROR": 40
+}
+
+class EventLogger(object):
+
+    def __init__(self, level="INFO", event_sample_rate=1.0, payload_max_bytes=1024, payload_hash=True, random_source=random.random):
+
+        if level.upper() not in levels:
+            raise Exception("Unknown log level: \"{}\".".format(level))
+
+        self.level = levels[level.upper()]
+        self.event_sample_rate = event_sample_rate
+        self.payload_max_bytes = payload_max_bytes
+        self.payload_hash = payload_hash
+        self.random_source = random_source
+
+    def enabled(self, level):
+        return levels[level] >= self.level
+
+    def log(self, level, message):
+        if self.enabled(level):
+            print("[{}] {}".format(level, message))
+
+    def debug(self, message):
+        self.log("DEBUG", message)
+
+    def info(self, message):
+        self.log("INFO", message)
+
+    def warning(self, message):
+        self.log("WARNING", message)
+
+    def error(self, message):
+        self.log("ERROR", message)
+
+    def log_event(self, message, event):
+
+        '''
+            Logs an event at INFO: in full (with payloads truncated) if it's
+            sampled, otherwise as a summary. At DEBUG, every event is logged in
+            full, untruncated.
+        '''
+
+        if self.enabled("DEBUG"):
+            self.debug("{}: {}".format(message, json.dumps(event)))
+        elif not self.enabled("INFO"):
+            return
+        elif self.event_sample_rate > 0 and self.random_source() < self.event_sample_rate:
+            self.info("{}: {}".format(message, json.dumps(self.truncated_event(event))))
+        else:
+            self.info("{} (summary): {}".format(message, json.dumps(event_summary(event))))
+
+    def log_error_event(self, message, event, error):
+
+        '''
+            Logs an event that caused an error, complete, whatever the sampling.
+        '''
+
+        self.error("{}: {}. Event: {}".format(message, error, json.dumps(event)))
+
+    def truncated_event(self, event):
+
+        if not isinstance(event, dict):
+            return event
+
+        truncated_event = dict(event)
+
+        if "payload" in truncated_event:
+            truncated_event["payload"] = self.truncated_payload(truncated_event["payload"])
+
+        if isinstance(truncated_event.get("invocations"), list):
+            truncated_event["invocations"] = list(self.truncated_event(x) for x in truncated_event["invocations"])
+
+        return truncated_event
+
+    def truncated_payload(self, payload):
+
+        payload_json = json.dumps(payload, separators=(",", ":"))
+
+        if len(payload_json) <= self.payload_max_bytes:
+            return payload
+
+        truncated_payload = {
+            "truncated": payload_json[:self.payload_max_bytes],
+            "bytes": len(payload_json)
+        }
+
+        if self.payload_hash:
+            truncated_payload["sha256"] = hashlib.sha256(payload_json.encode("utf-8")).hexdigest()
+
+        return truncated_payload
+
+def event_summary(event):
+
+    '''
+        Returns what identifies an event without serializing its payload.
+    '''
+
+    if not isinstance(event, dict):
+        return {"type": type(event).__name__}
+
+    summary = {
+        "keys": sorted(event.keys())
+    }
+
+    for each_key in ["function-name", "function-arn", "execution-time"]:
+        if each_key in event:
+            summary[each_key] = event[each_key]
+
+    if isinstance(event.get("invocations"), list):
+        summary["invocation-count"] = len(event["invocations"])
+
+    return summary
+
+def create_event_logger():
+
+    '''
+        Returns a logger configured by the LOG_LEVEL, LOG_EVENT_SAMPLE_RATE,
+        LOG_PAYLOAD_MAX_BYTES and LOG_PAYLOAD_HASH environment variables.
+    '''
+
+    return EventLogger(
+        os.environ.get("LOG_LEVEL", "INFO"),
+        float(os.environ.get("LOG_EVENT_SAMPLE_RATE", 1.0)),
+        int(os.environ.get("LOG_PAYLOAD_MAX_BYTES", 1024)),
+        os.environ.get("LOG_PAYLOAD_HASH", "true").lower() == "true"
+    )
@@ -0,0 +1,154 @@
+'''
+    Client-supplied idempotency keys, so a retried request queues its
+    invocation once.
+
+    A request with an "idempotency-key" is queued under a schedule ID derived
+    from the key, and then recorded:
+
+        idempotency/<sha256 of the key>.json
+
+    holding the schedule ID, a fingerprint of the invocation and when it was
+    queued. A request whose key is already recorded is answered from the record
+    without writing anything. The pointer is written before the record, so a
+    retry after a failure in between writes the same pointer again (it has the
+    same ID) rather than a second one. For that, keyed invocations are always
+    written as individual pointers, even in segment mode: a segment is written
+    under a new key each time.
+
+    Records are kept for retention_seconds (and removed by the bucket's
+    lifecycle rule after that), well after their pointer is dispatched, so a
+    late retry isn't invoked again either. Keys recorded from this container are
+    remembered for memo_seconds, so retries landing on a warm container don't
+    read the record.
+'''
+
+from __future__ import print_function
+
+import json, time, hashlib, threading
+from collections import OrderedDict
+
+record_prefix = "idempotency/"
+
+def key_hash(idempotency_key):
+    return hashlib.sha256("{}".format(idempotency_key).encode("utf-8")).hexdigest()
+
+def record_key(idempotency_key):
+    return "{}{}.json".format(record_prefix, key_hash(idempotency_key))
+
+def schedule_id(idempotency_key):
+    return "key-{}".format(key_hash(idempotency_key)[:32])
+
+def fingerprint(event):
+
+    '''
+        Identifies what an event asks for, so a key reused for a different
+        invocation can be told apart from a retry.
+    '''
+
+    return hashlib.sha256(json.dumps(
+        [event["execution-time"], event["function-arn"], event["payload"]],
+        separators=(",", ":"),
+        sort_keys=True
+    ).encode("utf-8")).hexdigest()
+
+def validate_idempotency_key(unvalidated_event):
+
+    '''
+        Returns the event's idempotency key, or None if it hasn't one.
+    '''
+
+    idempotency_key = unvalidated_event.get("idempotency-key")
+
+    if idempotency_key is None:
+        return None
+
+    if not isinstance(idempotency_key, (type(u""), str)) or not 0 < len(idempotency_key) <= 256:
+        raise Exception("Parameter \"{}\" must be specified as a string of 1 to 256 characters.".format("idempotency-key"))
+
+    return idempotency_key
+
+class IdempotencyStore(object):
+
+    def __init__(self, storage_backend, retention_seconds, memo_seconds=300, memo_max_size=10000):
+
+        if memo_seconds >= retention_seconds:
+            raise Exception("Idempotency keys must be remembered for less than they're retained.")
+
+        self.storage_backend = storage_backend
+        self.retention_seconds = retention_seconds
+        self.memo_seconds = memo_seconds
+        self.memo_max_size = memo_max_size
+        self.memo_hits = 0
+
+        # Key hash to (record, when it was remembered), least recently used first.
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, idempotency_key, event):
+
+        '''
+            Returns the record for a key already used for this event, or None
+            if the key is unused (or its record has expired). Raises if the key
+            was used for a different invocation.
+        '''
+
+        now = time.time()
+        hashed_key = key_hash(idempotency_key)
+
+        with self._lock:
+            memo_entry = self._memo.pop(hashed_key, None)
+
+            if memo_entry is not None and now - memo_entry[1] < self.memo_seconds:
+                self._memo[hashed_key] = memo_entry
+                self.memo_hits += 1
+                record = memo_entry[0]
+            else:
+                record = None
+
+        if record is None:
+            record_body = self.storage_backend.get_object_if_exists(record_key(idempotency_key))
+
+            if record_body is None:
+                return None
+
+            record = json.loads(record_body.decode("utf-8"))
+
+            if now - record["queued-timestamp"] >= self.retention_seconds:
+                return None
+
+            self.remember(hashed_key, record, now)
+
+        if record["fingerprint"] != fingerprint(event):
+            raise Exception("Idempotency key \"{}\" was already used for a different invocation.".format(idempotency_key))
+
+        return record
+
+    def put(self, idempotency_key, event, schedule_id):
+
+        record = {
+            "schedule-id": schedule_id,
+            "execution-time": event["execution-time"],
+            "fingerprint": fingerprint(event),
+            "queued-timestamp": int(time.time())
+        }
+
+        self.storage_backend.put_object(
+            record_key(idempotency_key),
+            json.dumps(record, separators=(",", ":")).encode("utf-8")
+        )
+
+        self.remember(key_hash(idempotency_key), record, time.time())
+
+        return record
+
+    def remember(self, hashed_key, record, now):
+
+        if self.memo_seconds <= 0 or self.memo_max_size <= 0:
+            return
+
+        with self._lock:
+            self._memo.pop(hashed_key, None)
+            self._memo[hashed_key] = (record, now)
+
+            while len(self._memo) > self.memo_max_size:
+                self._memo.popitem(last=False)
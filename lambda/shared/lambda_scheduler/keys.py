@@ -0,0 +1,166 @@
+'''
+    S3 key layout for queued invocation pointers.
+
+    Pointers are written to:
+
+        queued/<shard>/<bucket-minute>/<execution-time>/<pointer-id>.json
+
+    The shard is a hash of the pointer ID, which spreads writes for the same
+    moment across key prefixes. For each (bucket-minute, shard) that has work, an
+    empty marker is written to:
+
+        index/<bucket-minute>/<shard>
+
+    so a reader finds all of a minute's work with one LIST of the index followed
+    by one LIST per marked shard (in parallel), rather than one LIST per second.
+
+    Writers never place a pointer in a bucket more than late_write_minutes before
+    the current minute (a past-due pointer goes into that bucket but keeps its real
+    execution time), so once a bucket is older than index_close_minutes and empty,
+    its markers can be deleted without racing a writer. (The exception is a bulk
+    import batch imported again after an interruption, which keeps the buckets
+    it was first given; catch-up still lists any minute with markers.)
+
+    Segments (see segments.py) are stored the same way, keyed by the earliest
+    execution time they hold and with a ".seg" suffix.
+
+    Pointers written before this layout (queued/<execution-time>/<id>.json) are
+    still recognized by parse_pointer_key.
+'''
+
+from __future__ import print_function
+
+import re, time, calendar, hashlib
+
+datetime_string_format = "%Y-%m-%dT%H:%M:%SZ"
+minute_string_format = "%Y-%m-%dT%H:%MZ"
+
+queued_prefix = "queued/"
+index_prefix = "index/"
+dispatched_prefix = "dispatched/"
+failed_prefix = "failed/"
+
+default_shard_count = 16
+late_write_minutes = 1
+index_close_minutes = 3
+
+legacy_time_prefix_pattern = re.compile(r"^queued/\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z/$")
+
+def datetime_string_to_epoch(datetime_string):
+    return calendar.timegm(time.strptime(datetime_string, datetime_string_format))
+
+def epoch_to_datetime_string(epoch_seconds):
+    return time.strftime(datetime_string_format, time.gmtime(epoch_seconds))
+
+def epoch_to_minute_string(epoch_seconds):
+    return time.strftime(minute_string_format, time.gmtime(epoch_seconds))
+
+def minute_string_to_epoch(minute_string):
+    return calendar.timegm(time.strptime(minute_string, minute_string_format))
+
+def shard_for_pointer_id(pointer_id, shard_count):
+    digest = hashlib.md5(pointer_id.encode("utf-8")).hexdigest()
+    return "{:02x}".format(int(digest[:8], 16) % shard_count)
+
+def bucket_minute_for_execution_time(execution_time_string, now=None):
+
+    '''
+        Returns the bucket minute for a pointer, clamped so that nothing is
+        written into a bucket the dispatcher may already have closed.
+    '''
+
+    if now is None:
+        now = time.time()
+
+    execution_epoch = datetime_string_to_epoch(execution_time_string)
+    earliest_epoch = now - (late_write_minutes * 60)
+
+    return epoch_to_minute_string(max(execution_epoch, earliest_epoch))
+
+def pointer_key(execution_time_string, pointer_id, shard_count, now=None):
+
+    '''
+        Returns (pointer key, index marker key) for a new pointer.
+    '''
+
+    shard = shard_for_pointer_id(pointer_id, shard_count)
+    bucket_minute = bucket_minute_for_execution_time(execution_time_string, now)
+
+    return (
+        "{}{}/{}/{}/{}.json".format(queued_prefix, shard, bucket_minute, execution_time_string, pointer_id),
+        index_marker_key(bucket_minute, shard)
+    )
+
+def segment_key(bucket_minute, first_execution_time_string, segment_id, shard_count, shard=None):
+
+    '''
+        Returns (segment key, index marker key) for a segment in a bucket minute
+        chosen with bucket_minute_for_execution_time. The shard is derived from
+        the segment ID unless given.
+    '''
+
+    if shard is None:
+        shard = shard_for_pointer_id(segment_id, shard_count)
+
+    return (
+        "{}{}/{}/{}/{}.seg".format(queued_prefix, shard, bucket_minute, first_execution_time_string, segment_id),
+        index_marker_key(bucket_minute, shard)
+    )
+
+def is_segment_key(key):
+    return key.endswith(".seg")
+
+def index_marker_key(bucket_minute, shard):
+    return "{}{}/{}".format(index_prefix, bucket_minute, shard)
+
+def shard_minute_prefix(shard, bucket_minute):
+    return "{}{}/{}/".format(queued_prefix, shard, bucket_minute)
+
+def is_legacy_time_prefix(prefix):
+    return legacy_time_prefix_pattern.match(prefix) is not None
+
+def is_bucket_closed(bucket_minute, now=None):
+
+    if now is None:
+        now = time.time()
+
+    return minute_string_to_epoch(bucket_minute) < minute_string_to_epoch(epoch_to_minute_string(now)) - (index_close_minutes * 60)
+
+def parse_pointer_key(key):
+
+    '''
+        Returns a dict describing a pointer key in either layout, or None if the
+        key isn't a pointer key.
+    '''
+
+    if not key.startswith(queued_prefix) or not (key.endswith(".json") or is_segment_key(key)):
+        return None
+
+    key_parts = key[len(queued_prefix):].split("/")
+
+    if len(key_parts) == 2:
+        execution_time_string, file_name = key_parts
+        shard = None
+        bucket_minute = None
+    elif len(key_parts) == 4:
+        shard, bucket_minute, execution_time_string, file_name = key_parts
+    else:
+        return None
+
+    return {
+        "shard": shard,
+        "bucket-minute": bucket_minute,
+        "execution-time": execution_time_string,
+        "execution-epoch": datetime_string_to_epoch(execution_time_string),
+        "pointer-id": file_name.rsplit(".", 1)[0],
+        "segment": is_segment_key(key)
+    }
+
+def relocated_key(key, destination_prefix):
+
+    '''
+        Returns the equivalent of a queued/ key under another top-level prefix
+        (e.g. dispatched/).
+    '''
+
+    return "{}{}".format(destination_prefix, key[len(queued_prefix):])
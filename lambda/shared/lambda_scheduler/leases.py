@@ -0,0 +1,567 @@
+'''
+    Expiring leases on partitions of the queue (its shards), so several
+    dispatchers can share it.
+
+    Each worker heartbeats, and holds leases on its fair share of the
+    partitions: as many as there are partitions per live worker, rounded up.
+    A worker over its share (say, once another joins) lets the extra ones go;
+    one under it takes partitions that are free or whose lease has expired
+    (say, once a worker leaves or crashes). Leases are renewed on each tick.
+
+    Every time a partition changes hands, its lease gets a new fencing token,
+    one higher than the last. Before invoking anything, a worker claims it in
+    the lease store under its token. A claim only succeeds while that token's
+    lease is current, and only once per record, so a worker that has lost a
+    lease (without noticing) can't fire what the new holder does, and nothing
+    is fired twice. A record claimed but never invoked (the worker crashed in
+    between) is taken as fired; claims for invokes that are to be retried are
+    released.
+
+    The lease store is pluggable: SQLiteLeaseStore and FileLeaseStore keep it
+    in a local file or directory, which is enough for workers on one machine
+    (or sharing a file system with working locks).
+'''
+
+from __future__ import print_function
+
+import os, json, math, errno, hashlib, threading, contextlib, sqlite3
+
+# Leases are only used while they have this much of their time left, so a
+# slow tick doesn't run past the end of one.
+lease_safety_fraction = 1 / 3.0
+
+# Claims are kept for this long, well after what they claimed is settled.
+claim_retention_seconds = 24 * 60 * 60
+
+class LeaseLostError(Exception):
+    pass
+
+class Lease(object):
+
+    __slots__ = ("partition", "worker_id", "token", "expires_epoch")
+
+    def __init__(self, partition, worker_id, token, expires_epoch):
+        self.partition = partition
+        self.worker_id = worker_id
+        self.token = token
+        self.expires_epoch = expires_epoch
+
+class LeaseStore(object):
+
+    def acquire(self, partition, worker_id, now, lease_seconds):
+
+        '''
+            Returns a lease on partition for worker_id, or None if another
+            worker holds one that hasn't expired. An expired or free lease is
+            given a new fencing token; the worker's own current lease is renewed.
+        '''
+
+        raise NotImplementedError()
+
+    def renew(self, lease, now, lease_seconds):
+
+        '''
+            Returns the lease extended, or None if it has expired or changed
+            hands.
+        '''
+
+        raise NotImplementedError()
+
+    def release(self, lease):
+        raise NotImplementedError()
+
+    def list_leases(self, now):
+
+        '''
+            Returns the current (unexpired) leases.
+        '''
+
+        raise NotImplementedError()
+
+    def heartbeat(self, worker_id, now, lease_seconds):
+        raise NotImplementedError()
+
+    def remove_worker(self, worker_id):
+        raise NotImplementedError()
+
+    def list_live_workers(self, now):
+        raise NotImplementedError()
+
+    def claim(self, lease, claim_keys, now):
+
+        '''
+            Claims each of claim_keys under lease, returning those not already
+            claimed. Raises LeaseLostError if lease isn't current.
+        '''
+
+        raise NotImplementedError()
+
+    def release_claims(self, lease, claim_keys):
+
+        '''
+            Releases claims made under lease, so they can be claimed again.
+        '''
+
+        raise NotImplementedError()
+
+    def prune_claims(self, before_epoch):
+        raise NotImplementedError()
+
+class SQLiteLeaseStore(LeaseStore):
+
+    '''
+        Keeps leases, workers and claims in a SQLite database. Every change is
+        made in an immediate transaction, which SQLite serializes across
+        processes with its own file locks.
+    '''
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self._local = threading.local()
+
+        with self.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (partition_id TEXT PRIMARY KEY, worker_id TEXT, token INTEGER, expires_epoch REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, expires_epoch REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS claims (claim_key TEXT PRIMARY KEY, partition_id TEXT, token INTEGER, claimed_epoch REAL)")
+
+    def connection(self):
+
+        # Connections can't be shared between threads.
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect(self.database_path, timeout=60, isolation_level=None)
+
+        return self._local.connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            yield connection
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+
+    def acquire(self, partition, worker_id, now, lease_seconds):
+
+        with self.transaction() as connection:
+            row = connection.execute("SELECT worker_id, token, expires_epoch FROM leases WHERE partition_id = ?", (partition,)).fetchone()
+
+            if row is not None and row[2] > now:
+                if row[0] != worker_id:
+                    return None
+
+                token = row[1]
+            else:
+                token = (row[1] if row is not None else 0) + 1
+
+            connection.execute(
+                "INSERT OR REPLACE INTO leases (partition_id, worker_id, token, expires_epoch) VALUES (?, ?, ?, ?)",
+                (partition, worker_id, token, now + lease_seconds)
+            )
+
+        return Lease(partition, worker_id, token, now + lease_seconds)
+
+    def renew(self, lease, now, lease_seconds):
+
+        with self.transaction() as connection:
+            updated_count = connection.execute(
+                "UPDATE leases SET expires_epoch = ? WHERE partition_id = ? AND token = ? AND expires_epoch > ?",
+                (now + lease_seconds, lease.partition, lease.token, now)
+            ).rowcount
+
+        if updated_count == 0:
+            return None
+
+        return Lease(lease.partition, lease.worker_id, lease.token, now + lease_seconds)
+
+    def release(self, lease):
+
+        # The row is kept, so the next token is still higher.
+        with self.transaction() as connection:
+            connection.execute("UPDATE leases SET expires_epoch = 0 WHERE partition_id = ? AND token = ?", (lease.partition, lease.token))
+
+    def list_leases(self, now):
+        rows = self.connection().execute("SELECT partition_id, worker_id, token, expires_epoch FROM leases WHERE expires_epoch > ?", (now,)).fetchall()
+        return list(Lease(*x) for x in rows)
+
+    def heartbeat(self, worker_id, now, lease_seconds):
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO workers (worker_id, expires_epoch) VALUES (?, ?)", (worker_id, now + lease_seconds))
+
+    def remove_worker(self, worker_id):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def list_live_workers(self, now):
+        rows = self.connection().execute("SELECT worker_id FROM workers WHERE expires_epoch > ?", (now,)).fetchall()
+        return list(x[0] for x in rows)
+
+    def claim(self, lease, claim_keys, now):
+
+        claimed_keys = []
+
+        with self.transaction() as connection:
+            row = connection.execute("SELECT token, expires_epoch FROM leases WHERE partition_id = ?", (lease.partition,)).fetchone()
+
+            if row is None or row[0] != lease.token or row[1] <= now:
+                raise LeaseLostError("Lease on partition {} (token {}) is no longer current.".format(lease.partition, lease.token))
+
+            for each_key in claim_keys:
+                if connection.execute(
+                    "INSERT OR IGNORE INTO claims (claim_key, partition_id, token, claimed_epoch) VALUES (?, ?, ?, ?)",
+                    (each_key, lease.partition, lease.token, now)
+                ).rowcount == 1:
+                    claimed_keys.append(each_key)
+
+        return claimed_keys
+
+    def release_claims(self, lease, claim_keys):
+        with self.transaction() as connection:
+            connection.executemany(
+                "DELETE FROM claims WHERE claim_key = ? AND partition_id = ? AND token = ?",
+                list((x, lease.partition, lease.token) for x in claim_keys)
+            )
+
+    def prune_claims(self, before_epoch):
+        with self.transaction() as connection:
+            return connection.execute("DELETE FROM claims WHERE claimed_epoch < ?", (before_epoch,)).rowcount
+
+class FileLeaseStore(LeaseStore):
+
+    '''
+        Keeps leases and workers as JSON files in a directory, and each claim
+        as a file of its own. Every change is made while holding an exclusive
+        lock (flock) on the directory's lock file.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        self.claims_dir = os.path.join(self.store_dir, "claims")
+
+        try:
+            os.makedirs(self.claims_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @contextlib.contextmanager
+    def locked(self):
+
+        import fcntl
+
+        with open(os.path.join(self.store_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_state(self, name):
+        try:
+            with open(os.path.join(self.store_dir, name)) as f:
+                return json.loads(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+    def write_state(self, name, state):
+
+        temp_path = os.path.join(self.store_dir, ".{}.tmp".format(name))
+
+        with open(temp_path, "w") as f:
+            f.write(json.dumps(state))
+
+        os.rename(temp_path, os.path.join(self.store_dir, name))
+
+    def claim_path(self, claim_key):
+        return os.path.join(self.claims_dir, hashlib.sha1(claim_key.encode("utf-8")).hexdigest())
+
+    def acquire(self, partition, worker_id, now, lease_seconds):
+
+        with self.locked():
+            leases = self.read_state("leases.json")
+            current = leases.get(partition)
+
+            if current is not None and current["expires-epoch"] > now:
+                if current["worker-id"] != worker_id:
+                    return None
+
+                token = current["token"]
+            else:
+                token = (current["token"] if current is not None else 0) + 1
+
+            leases[partition] = {
+                "worker-id": worker_id,
+                "token": token,
+                "expires-epoch": now + lease_seconds
+            }
+
+            self.write_state("leases.json", leases)
+
+        return Lease(partition, worker_id, token, now + lease_seconds)
+
+    def renew(self, lease, now, lease_seconds):
+
+        with self.locked():
+            leases = self.read_state("leases.json")
+            current = leases.get(lease.partition)
+
+            if current is None or current["token"] != lease.token or current["expires-epoch"] <= now:
+                return None
+
+            current["expires-epoch"] = now + lease_seconds
+            self.write_state("leases.json", leases)
+
+        return Lease(lease.partition, lease.worker_id, lease.token, now + lease_seconds)
+
+    def release(self, lease):
+
+        with self.locked():
+            leases = self.read_state("leases.json")
+            current = leases.get(lease.partition)
+
+            if current is not None and current["token"] == lease.token:
+                current["expires-epoch"] = 0
+                self.write_state("leases.json", leases)
+
+    def list_leases(self, now):
+
+        with self.locked():
+            leases = self.read_state("leases.json")
+
+        return list(
+            Lease(x, y["worker-id"], y["token"], y["expires-epoch"])
+            for x, y in sorted(leases.items()) if y["expires-epoch"] > now
+        )
+
+    def heartbeat(self, worker_id, now, lease_seconds):
+
+        with self.locked():
+            workers = self.read_state("workers.json")
+            workers[worker_id] = now + lease_seconds
+
+            # Workers long gone are dropped.
+            for each_worker_id, each_expires_epoch in list(workers.items()):
+                if each_expires_epoch < now - claim_retention_seconds:
+                    del workers[each_worker_id]
+
+            self.write_state("workers.json", workers)
+
+    def remove_worker(self, worker_id):
+
+        with self.locked():
+            workers = self.read_state("workers.json")
+            workers.pop(worker_id, None)
+            self.write_state("workers.json", workers)
+
+    def list_live_workers(self, now):
+
+        with self.locked():
+            workers = self.read_state("workers.json")
+
+        return sorted(x for x, y in workers.items() if y > now)
+
+    def claim(self, lease, claim_keys, now):
+
+        claimed_keys = []
+
+        with self.locked():
+            current = self.read_state("leases.json").get(lease.partition)
+
+            if current is None or current["token"] != lease.token or current["expires-epoch"] <= now:
+                raise LeaseLostError("Lease on partition {} (token {}) is no longer current.".format(lease.partition, lease.token))
+
+            for each_key in claim_keys:
+                try:
+                    file_descriptor = os.open(self.claim_path(each_key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    continue
+
+                with os.fdopen(file_descriptor, "w") as f:
+                    f.write(json.dumps([lease.partition, lease.token]))
+
+                claimed_keys.append(each_key)
+
+        return claimed_keys
+
+    def release_claims(self, lease, claim_keys):
+
+        with self.locked():
+            for each_key in claim_keys:
+                each_path = self.claim_path(each_key)
+
+                try:
+                    with open(each_path) as f:
+                        each_claim = json.loads(f.read())
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+
+                if each_claim == [lease.partition, lease.token]:
+                    os.remove(each_path)
+
+    def prune_claims(self, before_epoch):
+
+        pruned_count = 0
+
+        with self.locked():
+            for each_name in os.listdir(self.claims_dir):
+                each_path = os.path.join(self.claims_dir, each_name)
+
+                if os.path.getmtime(each_path) < before_epoch:
+                    os.remove(each_path)
+                    pruned_count += 1
+
+        return pruned_count
+
+def create_lease_store(lease_store_spec):
+
+    '''
+        Returns the store named by a spec like "sqlite:<database path>" or
+        "file:<directory>", or None for an empty spec (no leases: a single
+        dispatcher handles every partition).
+    '''
+
+    if not lease_store_spec:
+        return None
+
+    store_type, _, location = lease_store_spec.partition(":")
+
+    if store_type == "sqlite":
+        return SQLiteLeaseStore(location)
+
+    if store_type == "file":
+        return FileLeaseStore(location)
+
+    raise Exception("Unknown lease store: \"{}\".".format(lease_store_spec))
+
+class LeaseManager(object):
+
+    '''
+        Holds one worker's leases: takes and gives up partitions to keep to its
+        fair share, and claims records under them.
+    '''
+
+    def __init__(self, lease_store, partitions, worker_id, lease_seconds, log=print):
+        self.lease_store = lease_store
+        self.partitions = list(partitions)
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.log = log
+        self.leases = {}
+        self.claims_pruned = 0
+        self._lock = threading.Lock()
+
+        # Workers start looking for free partitions at different places.
+        offset = int(hashlib.md5(worker_id.encode("utf-8")).hexdigest()[:8], 16) % max(1, len(self.partitions))
+        self.search_order = self.partitions[offset:] + self.partitions[:offset]
+
+    def maintain(self, now):
+
+        '''
+            Renews the worker's leases and rebalances them. Returns the
+            partitions it holds.
+        '''
+
+        self.lease_store.heartbeat(self.worker_id, now, self.lease_seconds)
+
+        with self._lock:
+            for each_partition, each_lease in list(self.leases.items()):
+                renewed_lease = self.lease_store.renew(each_lease, now, self.lease_seconds)
+
+                if renewed_lease is None:
+                    self.log("Lost lease on partition {} (token {}).".format(each_partition, each_lease.token))
+                    del self.leases[each_partition]
+                else:
+                    self.leases[each_partition] = renewed_lease
+
+            live_worker_count = max(1, len(self.lease_store.list_live_workers(now)))
+            fair_share = int(math.ceil(len(self.partitions) / float(live_worker_count)))
+
+            for each_partition in sorted(self.leases.keys())[fair_share:]:
+                self.lease_store.release(self.leases.pop(each_partition))
+
+            if len(self.leases) < fair_share:
+                held_partitions = set(x.partition for x in self.lease_store.list_leases(now))
+
+                for each_partition in self.search_order:
+                    if len(self.leases) >= fair_share:
+                        break
+
+                    if each_partition in held_partitions:
+                        continue
+
+                    each_lease = self.lease_store.acquire(each_partition, self.worker_id, now, self.lease_seconds)
+
+                    if each_lease is not None:
+                        self.leases[each_partition] = each_lease
+
+            if now - self.claims_pruned > 60 * 60:
+                self.claims_pruned = now
+                self.lease_store.prune_claims(now - claim_retention_seconds)
+
+            return sorted(self.leases.keys())
+
+    def lease_for(self, partition, now):
+
+        '''
+            Returns the worker's lease on partition, if it has one with enough
+            time left to use.
+        '''
+
+        with self._lock:
+            lease = self.leases.get(partition)
+
+        if lease is None or lease.expires_epoch - now < self.lease_seconds * lease_safety_fraction:
+            return None
+
+        return lease
+
+    def claim(self, partition, claim_keys, now):
+
+        '''
+            Returns the lease claim_keys were claimed under and those that were
+            claimed, or (None, None) if the worker no longer holds partition.
+        '''
+
+        lease = self.lease_for(partition, now)
+
+        if lease is None:
+            return None, None
+
+        try:
+            return lease, self.lease_store.claim(lease, claim_keys, now)
+        except LeaseLostError as e:
+            self.log("{}".format(e))
+
+            with self._lock:
+                if self.leases.get(partition) is lease:
+                    del self.leases[partition]
+
+            return None, None
+
+    def release_claims(self, lease, claim_keys):
+
+        # Released even once the lease is lost, so the new holder invokes them.
+        if len(claim_keys) > 0:
+            self.lease_store.release_claims(lease, claim_keys)
+
+    def release_all(self):
+
+        with self._lock:
+            for each_lease in self.leases.values():
+                self.lease_store.release(each_lease)
+
+            self.leases = {}
+
+        self.lease_store.remove_worker(self.worker_id)
@@ -0,0 +1,106 @@
+'''
+    Request timing, logged in CloudWatch embedded metric format so that metrics
+    come from the log line itself, with no PutMetricData calls.
+'''
+
+from __future__ import print_function
+
+import json, time, threading
+
+metric_namespace = "LambdaScheduler"
+
+class PhaseTimer(object):
+
+    '''
+        Accumulates time spent in named phases across a request (including its
+        worker threads). Phases may nest; time is charged to the innermost phase
+        only. Time in worker threads is summed, so for concurrent work a phase
+        measures work done rather than elapsed time.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.durations = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def phase(self, phase_name):
+        return _Phase(self, phase_name)
+
+    def add(self, phase_name, seconds):
+        with self._lock:
+            self.durations[phase_name] = self.durations.get(phase_name, 0) + seconds
+
+    def count(self, count_name, value=1):
+        with self._lock:
+            self.counts[count_name] = self.counts.get(count_name, 0) + value
+
+    def stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+class _Phase(object):
+
+    __slots__ = ["timer", "phase_name", "started", "child_seconds"]
+
+    def __init__(self, timer, phase_name):
+        self.timer = timer
+        self.phase_name = phase_name
+
+    def __enter__(self):
+        self.started = time.time()
+        self.child_seconds = 0
+        self.timer.stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.started
+
+        stack = self.timer.stack()
+        stack.pop()
+
+        if len(stack) > 0:
+            stack[-1].child_seconds += elapsed
+
+        self.timer.add(self.phase_name, elapsed - self.child_seconds)
+
+def embedded_metric_log_line(dimensions, phase_timer, properties=None, counts_units=None):
+
+    '''
+        Returns one CloudWatch embedded metric format log line with a
+        "<Phase>Time" metric (in milliseconds) for each phase, a "TotalTime"
+        metric, and one metric per count (with its unit from counts_units,
+        "Count" by default).
+    '''
+
+    counts_units = counts_units or {}
+
+    log_object = dict(dimensions)
+    metric_definitions = []
+
+    for each_phase_name, each_seconds in phase_timer.durations.items():
+        metric_name = "{}Time".format(each_phase_name)
+        log_object[metric_name] = round(each_seconds * 1000, 3)
+        metric_definitions.append({"Name": metric_name, "Unit": "Milliseconds"})
+
+    log_object["TotalTime"] = round((time.time() - phase_timer.started) * 1000, 3)
+    metric_definitions.append({"Name": "TotalTime", "Unit": "Milliseconds"})
+
+    for each_count_name, each_value in phase_timer.counts.items():
+        log_object[each_count_name] = each_value
+        metric_definitions.append({"Name": each_count_name, "Unit": counts_units.get(each_count_name, "Count")})
+
+    log_object.update(properties or {})
+
+    log_object["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": metric_namespace,
+            "Dimensions": [sorted(dimensions.keys())],
+            "Metrics": metric_definitions
+        }]
+    }
+
+    return json.dumps(log_object, separators=(",", ":"))
@@ -0,0 +1,225 @@
+'''
+    Content-addressed storage for large payloads.
+
+    A payload of at least threshold_bytes (serialized) is stored once, at
+
+        payloads/<sha256>
+
+    and the pointer record carries "payload-ref" (the hash) and "payload-bytes"
+    instead of "payload". Each pointer using a payload holds a reference:
+
+        payload-refs/<sha256>/<pointer-id>
+
+    written before the pointer itself. Once a pointer is dispatched, its
+    reference is deleted and a release marker is written to
+
+        payload-releases/<minute>/<sha256>
+
+    A sweep picks up release markers once they're release_grace_minutes old and
+    deletes the payload if it has no references left. Queuers remember which
+    payloads they've stored for stored_memo_seconds and skip storing them again
+    meanwhile. So each store also holds a reference until the memo runs out
+    (see below), and a queuer that skips storing a payload can't find it swept
+    from under it, however old a release marker the sweep is handling.
+
+    Payloads larger than an asynchronous invoke accepts are handed to the
+    function by reference instead ({"payload-location": {"bucket", "key"}}).
+    Their reference is held until hold_seconds after the hand-over, so the
+    function has time to read the payload.
+'''
+
+from __future__ import print_function
+
+import json, time, zlib, hashlib, threading
+
+from lambda_scheduler import keys, records
+
+payload_prefix = "payloads/"
+reference_prefix = "payload-refs/"
+release_prefix = "payload-releases/"
+
+held_reference_prefix = "held-"
+
+def payload_key(payload_hash):
+    return "{}{}".format(payload_prefix, payload_hash)
+
+def reference_key(payload_hash, pointer_id):
+    return "{}{}/{}".format(reference_prefix, payload_hash, pointer_id)
+
+def held_reference_key(payload_hash, pointer_id, held_until):
+    return "{}{}/{}{}-{}".format(reference_prefix, payload_hash, held_reference_prefix, int(held_until), pointer_id)
+
+def release_key(release_minute, payload_hash):
+    return "{}{}/{}".format(release_prefix, release_minute, payload_hash)
+
+class PayloadStore(object):
+
+    def __init__(self, storage_backend, threshold_bytes, stored_memo_seconds=300, release_grace_minutes=10, cache_max_bytes=8 * 1024 * 1024):
+
+        if stored_memo_seconds >= release_grace_minutes * 60:
+            raise Exception("Stored payloads must be remembered for less than the release grace period.")
+
+        self.storage_backend = storage_backend
+        self.threshold_bytes = threshold_bytes
+        self.stored_memo_seconds = stored_memo_seconds
+        self.release_grace_minutes = release_grace_minutes
+        self.cache_max_bytes = cache_max_bytes
+
+        # Payload hash to when it was last stored from here.
+        self._stored = {}
+
+        # Payload hash to body, for dispatching the same payload many times.
+        self._cache = {}
+        self._cache_bytes = 0
+
+        self._lock = threading.Lock()
+
+    def externalize(self, record, pointer_id):
+
+        '''
+            Returns the record to store for pointer_id: as given, or with a large
+            payload replaced by a reference to its stored copy.
+        '''
+
+        if self.threshold_bytes < 0 or "payload" not in record:
+            return record
+
+        payload_body = json.dumps(record["payload"], separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+        if len(payload_body) < self.threshold_bytes:
+            return record
+
+        payload_hash = hashlib.sha256(payload_body).hexdigest()
+
+        self.storage_backend.put_object(reference_key(payload_hash, pointer_id), b"")
+
+        now = time.time()
+
+        with self._lock:
+            stored_recently = now - self._stored.get(payload_hash, 0) < self.stored_memo_seconds
+
+        if not stored_recently:
+            self.hold(payload_hash, "stored", int(now) + self.stored_memo_seconds + 1)
+            self.storage_backend.put_object(payload_key(payload_hash), records.compress_body(payload_body))
+
+            with self._lock:
+                self._stored[payload_hash] = now
+
+                for each_hash in list(self._stored.keys()):
+                    if now - self._stored[each_hash] >= self.stored_memo_seconds:
+                        del self._stored[each_hash]
+
+        externalized_record = dict(record)
+        del externalized_record["payload"]
+        externalized_record["payload-ref"] = payload_hash
+        externalized_record["payload-bytes"] = len(payload_body)
+
+        return externalized_record
+
+    def get_payload_body(self, payload_hash):
+
+        '''
+            Returns a stored payload's serialized JSON.
+        '''
+
+        with self._lock:
+            if payload_hash in self._cache:
+                return self._cache[payload_hash]
+
+        payload_body = self.storage_backend.get_object(payload_key(payload_hash))
+
+        if payload_body[:2] == records.gzip_magic_bytes:
+            payload_body = zlib.decompress(payload_body, records.gzip_wbits)
+
+        with self._lock:
+            if self._cache_bytes + len(payload_body) > self.cache_max_bytes:
+                self._cache.clear()
+                self._cache_bytes = 0
+
+            if len(payload_body) <= self.cache_max_bytes:
+                self._cache[payload_hash] = payload_body
+                self._cache_bytes += len(payload_body)
+
+        return payload_body
+
+    def release(self, payload_hash, pointer_id, hold_seconds=None, now=None):
+
+        '''
+            Releases pointer_id's reference, either now or (with hold_seconds)
+            once that long has passed.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        if hold_seconds is not None:
+            self.hold(payload_hash, pointer_id, now + hold_seconds)
+        else:
+            self.storage_backend.put_object(release_key(keys.epoch_to_minute_string(now), payload_hash), b"")
+
+        self.storage_backend.delete_object(reference_key(payload_hash, pointer_id))
+
+    def hold(self, payload_hash, holder_id, held_until):
+
+        '''
+            Holds a reference until held_until, and marks the payload to be
+            swept once that's passed.
+        '''
+
+        self.storage_backend.put_object(held_reference_key(payload_hash, holder_id, held_until), b"")
+        self.storage_backend.put_object(release_key(keys.epoch_to_minute_string(held_until), payload_hash), b"")
+
+    def sweep(self, now=None):
+
+        '''
+            Deletes payloads released at least release_grace_minutes ago that
+            have no references left. Returns how many were deleted.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        deleted_count = 0
+
+        for each_prefix in self.storage_backend.list_prefixes(release_prefix):
+            each_release_minute = each_prefix[len(release_prefix):-1]
+
+            if keys.minute_string_to_epoch(each_release_minute) + self.release_grace_minutes * 60 > now:
+                break
+
+            release_marker_keys = list(self.storage_backend.list_keys(each_prefix))
+
+            for each_release_marker_key in release_marker_keys:
+                if self.sweep_payload(each_release_marker_key.split("/")[-1], now):
+                    deleted_count += 1
+
+            self.storage_backend.delete_objects(release_marker_keys)
+
+        return deleted_count
+
+    def sweep_payload(self, payload_hash, now):
+
+        live_reference_count = 0
+
+        for each_reference_key in list(self.storage_backend.list_keys("{}{}/".format(reference_prefix, payload_hash))):
+            each_reference_name = each_reference_key.split("/")[-1]
+
+            if each_reference_name.startswith(held_reference_prefix):
+                held_until = int(each_reference_name[len(held_reference_prefix):].split("-", 1)[0])
+
+                if held_until <= now:
+                    self.storage_backend.delete_object(each_reference_key)
+                    continue
+
+            live_reference_count += 1
+
+        if live_reference_count > 0:
+            return False
+
+        self.storage_backend.delete_object(payload_key(payload_hash))
+
+        with self._lock:
+            if payload_hash in self._cache:
+                self._cache_bytes -= len(self._cache.pop(payload_hash))
+
+        return True
@@ -0,0 +1,158 @@
+'''
+    Parallel deletion of everything under a set of key prefixes: emptying the
+    bucket when the stack is deleted, and retention sweeps of old records.
+
+    Each prefix is split into the prefixes split_depth levels below it (e.g.
+    each queued/<shard>/<bucket-minute>/), and workers list and delete those
+    at the same time. Keys are deleted in batches of up to 1,000. Keys that a
+    batch fails to delete are retried, with backoff, up to max_attempts times.
+    Once the split prefixes are done, the original prefixes are listed once
+    more to catch keys that weren't under any of them.
+
+    A purge stops early once should_stop() is true. Deleting is its own
+    progress, so resuming one is purging the same prefixes again, which lists
+    only what's left.
+'''
+
+from __future__ import print_function
+
+import time, threading
+
+from lambda_scheduler import keys
+
+# Failures kept in the result; the rest are only counted.
+purge_max_errors = 100
+
+def expired_prefixes(storage_backend, prefix, cutoff_epoch):
+
+    '''
+        Yields the prefixes of the bucket minutes under a relocated prefix
+        (e.g. dispatched/<shard>/<bucket-minute>/) from before cutoff_epoch,
+        and those of legacy execution times (dispatched/<execution-time>/).
+    '''
+
+    cutoff_minute = keys.epoch_to_minute_string(cutoff_epoch)
+
+    for each_prefix in storage_backend.list_prefixes(prefix):
+        each_name = each_prefix[len(prefix):-1]
+
+        if len(each_name) == 2:
+            for each_minute_prefix in storage_backend.list_prefixes(each_prefix):
+                if each_minute_prefix[len(each_prefix):-1] >= cutoff_minute:
+                    break
+
+                yield each_minute_prefix
+
+        # Legacy execution times, minus their seconds, are minute strings.
+        elif "{}Z".format(each_name[:16]) < cutoff_minute:
+            yield each_prefix
+
+class Purger(object):
+
+    def __init__(self, storage_backend, batch_size=1000, max_attempts=5, retry_delay_seconds=0.5, split_depth=2, log=print):
+        self.storage_backend = storage_backend
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self.split_depth = split_depth
+        self.log = log
+
+    def split_prefixes(self, prefixes):
+
+        split = list(prefixes)
+
+        for _ in range(self.split_depth):
+            next_split = []
+
+            for each_prefix in split:
+                each_subprefixes = list(self.storage_backend.list_prefixes(each_prefix))
+                next_split.extend(each_subprefixes if len(each_subprefixes) > 0 else [each_prefix])
+
+            split = next_split
+
+        return split
+
+    def purge(self, prefixes, executor, should_stop=lambda: False):
+
+        '''
+            Deletes every key under prefixes, a split prefix per worker of the
+            executor. Returns the deleted and failed
+            counts, the first few failures, and whether it's complete (stopped
+            neither early nor with keys left that couldn't be deleted).
+        '''
+
+        result = {
+            "deleted-count": 0,
+            "failed-count": 0,
+            "errors": [],
+            "complete": False
+        }
+
+        result_lock = threading.Lock()
+        started = time.time()
+
+        def purge_each_prefix(each_prefix):
+            batch = []
+
+            for each_key in self.storage_backend.list_keys(each_prefix):
+                batch.append(each_key)
+
+                if len(batch) >= self.batch_size:
+                    self.delete_batch(batch, result, result_lock)
+                    batch = []
+
+                    if should_stop():
+                        return False
+
+            if len(batch) > 0:
+                self.delete_batch(batch, result, result_lock)
+
+            return not should_stop()
+
+        split = self.split_prefixes(prefixes)
+
+        self.log("Purging {} prefix(es), split into {}.".format(len(prefixes), len(split)))
+
+        finished = all(list(executor.map(purge_each_prefix, split)))
+
+        if finished:
+            finished = all(list(executor.map(purge_each_prefix, prefixes)))
+
+        result["complete"] = finished and result["failed-count"] == 0
+
+        elapsed_seconds = time.time() - started
+
+        self.log("Deleted {} object(s) ({:.1f}/sec), {} failed.{}".format(
+            result["deleted-count"],
+            result["deleted-count"] / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+            result["failed-count"],
+            " Complete." if result["complete"] else ""
+        ))
+
+        return result
+
+    def delete_batch(self, batch, result, result_lock):
+
+        batch_size = len(batch)
+        failures = []
+
+        for each_attempt in range(self.max_attempts):
+            if each_attempt > 0:
+                time.sleep(self.retry_delay_seconds * (2 ** (each_attempt - 1)))
+
+            failures = self.storage_backend.try_delete_objects(batch)
+
+            if len(failures) == 0:
+                break
+
+            batch = list(x[0] for x in failures)
+
+        with result_lock:
+            result["deleted-count"] += batch_size - len(failures)
+            result["failed-count"] += len(failures)
+
+            for each_key, each_error in failures[:purge_max_errors - len(result["errors"])]:
+                result["errors"].append({
+                    "key": each_key,
+                    "error": each_error
+                })
@@ -0,0 +1,187 @@
+'''
+    Per-target limits on how hard the dispatcher invokes a function:
+
+        max-concurrency  invokes in flight at once
+        rate-per-second  invokes per second, on average
+        burst            invokes allowed at once above that rate (a token
+                         bucket of this size; by default, a second's worth)
+
+    Limits are taken, in order of precedence, from the schedule
+    ("dispatch-limits" in the queued event), from the target's entry in the
+    per-target limits (by function name or ARN), and from the defaults.
+    Records with the same target and limits share a limiter, and so a token
+    bucket, for as long as the dispatcher's container lives.
+
+    A target that throttles an invoke is backed off, doubling up to
+    throttle_max_backoff_seconds, until an invoke succeeds.
+'''
+
+from __future__ import print_function
+
+import math, threading
+
+limit_names = ["max-concurrency", "rate-per-second", "burst"]
+
+throttle_error_codes = ["TooManyRequestsException", "ThrottlingException"]
+throttle_backoff_seconds = 0.5
+throttle_max_backoff_seconds = 8
+
+def validate_limits(unvalidated_limits, parameter_name="dispatch-limits"):
+
+    '''
+        Returns the limits with their values as numbers, raising if they aren't
+        a dictionary of positive numbers keyed by limit_names.
+    '''
+
+    if not isinstance(unvalidated_limits, dict) or len(set(unvalidated_limits.keys()) - set(limit_names)) > 0:
+        raise Exception("Parameter \"{}\" must be specified as a JSON key/value struct (dictionary) with any of \"{}\".".format(parameter_name, "\", \"".join(limit_names)))
+
+    clean_limits = {}
+
+    for each_name, each_value in unvalidated_limits.items():
+        try:
+            each_value = float(each_value) if each_name == "rate-per-second" else int(each_value)
+        except:
+            each_value = None
+
+        if each_value is None or each_value <= 0:
+            raise Exception("Parameter \"{}\" must be specified as a positive number in \"{}\".".format(each_name, parameter_name))
+
+        clean_limits[each_name] = each_value
+
+    return clean_limits
+
+def function_name_for_arn(function_arn):
+    return function_arn.split(":")[6] if function_arn.count(":") >= 6 else function_arn
+
+def is_throttle_error(error):
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in throttle_error_codes
+
+class TokenBucket(object):
+
+    '''
+        Tokens are reserved ahead: taking one from an empty bucket returns how
+        long until it's refilled, so concurrent takers queue up in order.
+    '''
+
+    def __init__(self, rate_per_second, burst, now):
+        self.rate_per_second = rate_per_second
+        self.capacity = burst or max(1, int(math.ceil(rate_per_second)))
+        self.tokens = float(self.capacity)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+            self.updated = now
+
+    def reserve(self, now):
+        self.refill(now)
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate_per_second)
+
+    def unreserve(self):
+        self.tokens += 1
+
+    def drain(self, now):
+        self.refill(now)
+        self.tokens = min(self.tokens, 0)
+
+class TargetLimiter(object):
+
+    def __init__(self, function_arn, limits, now):
+        self.function_arn = function_arn
+        self.limits = limits
+        self.max_concurrency = limits.get("max-concurrency")
+        self.token_bucket = None
+        self.backoff_until = 0
+        self.consecutive_throttle_count = 0
+        self._lock = threading.Lock()
+
+        if limits.get("rate-per-second") is not None:
+            self.token_bucket = TokenBucket(limits["rate-per-second"], limits.get("burst"), now)
+
+    def worker_count(self, pending_count, max_workers):
+
+        '''
+            How many workers to invoke pending_count records with: enough to
+            keep up with the rate, but no more than max-concurrency.
+        '''
+
+        worker_count = min(pending_count, max_workers)
+
+        if self.max_concurrency is not None:
+            worker_count = min(worker_count, self.max_concurrency)
+
+        if self.token_bucket is not None:
+            worker_count = min(worker_count, max(1, int(math.ceil(self.token_bucket.rate_per_second))))
+
+        return max(1, worker_count)
+
+    def acquire(self, now, deadline):
+
+        '''
+            Returns how long to wait before the next invoke, or None if that
+            would be after deadline.
+        '''
+
+        with self._lock:
+            wait_seconds = max(0, self.backoff_until - now)
+
+            if self.token_bucket is not None:
+                wait_seconds = max(wait_seconds, self.token_bucket.reserve(now))
+
+            if now + wait_seconds > deadline:
+                if self.token_bucket is not None:
+                    self.token_bucket.unreserve()
+
+                return None
+
+            return wait_seconds
+
+    def succeeded(self):
+        with self._lock:
+            self.consecutive_throttle_count = 0
+
+    def throttled(self, now):
+        with self._lock:
+            backoff_seconds = min(throttle_max_backoff_seconds, throttle_backoff_seconds * (2 ** self.consecutive_throttle_count))
+
+            self.consecutive_throttle_count += 1
+            self.backoff_until = max(self.backoff_until, now + backoff_seconds)
+
+            if self.token_bucket is not None:
+                self.token_bucket.drain(now)
+
+class TargetLimits(object):
+
+    def __init__(self, target_limits, default_limits, clock):
+        self.target_limits = target_limits
+        self.default_limits = default_limits
+        self.clock = clock
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    def limits_for(self, s3_pointer_content):
+
+        function_arn = s3_pointer_content["function-arn"]
+
+        limits = dict((x, y) for x, y in self.default_limits.items() if y is not None)
+        limits.update(self.target_limits.get(function_name_for_arn(function_arn), {}))
+        limits.update(self.target_limits.get(function_arn, {}))
+        limits.update(s3_pointer_content.get("dispatch-limits", {}))
+
+        return limits
+
+    def limiter_for(self, s3_pointer_content):
+
+        function_arn = s3_pointer_content["function-arn"]
+        limits = self.limits_for(s3_pointer_content)
+        limiter_key = (function_arn, tuple(sorted(limits.items())))
+
+        with self._lock:
+            if limiter_key not in self.limiters:
+                self.limiters[limiter_key] = TargetLimiter(function_arn, limits, self.clock.time())
+
+            return self.limiters[limiter_key]
@@ -0,0 +1,82 @@
+'''
+    Encoding of the pointer records stored for each queued invocation.
+
+    Version 1 (implicit; no "format-version" field) was indented JSON carrying
+    the full queuing metadata. Version 2 is compact JSON that leaves out what can
+    be derived (the queuer's log group), and is gzipped once it reaches
+    compression_threshold_bytes. Gzipped records are recognized by their magic
+    bytes, so decode_pointer_record reads every version.
+'''
+
+from __future__ import print_function
+
+import os, json, zlib
+
+record_format_version = 2
+
+compression_threshold_bytes = int(os.environ.get("RECORD_COMPRESSION_THRESHOLD_BYTES", 4096))
+
+gzip_magic_bytes = b"\x1f\x8b"
+
+# zlib window bits for a gzip header and trailer.
+gzip_wbits = 16 + zlib.MAX_WBITS
+
+def encode_pointer_record(record, threshold_bytes=None):
+
+    '''
+        Returns the bytes to store for a pointer record (a dict in the version 1
+        shape). A negative threshold_bytes disables compression.
+    '''
+
+    return compress_body(serialize_pointer_record(record), threshold_bytes)
+
+def serialize_pointer_record(record):
+
+    '''
+        Returns a pointer record as uncompressed version 2 bytes.
+    '''
+
+    compact_record = dict(record)
+    compact_record.pop("queued-log-group", None)
+    compact_record["format-version"] = record_format_version
+
+    return json.dumps(compact_record, separators=(",", ":")).encode("utf-8")
+
+def compress_body(body, threshold_bytes=None):
+
+    '''
+        Gzips body if it reaches threshold_bytes (by default,
+        compression_threshold_bytes). A negative threshold_bytes disables
+        compression.
+    '''
+
+    if threshold_bytes is None:
+        threshold_bytes = compression_threshold_bytes
+
+    if threshold_bytes >= 0 and len(body) >= threshold_bytes:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, gzip_wbits)
+        body = compressor.compress(body) + compressor.flush()
+
+    return body
+
+def decode_pointer_record(body):
+
+    '''
+        Returns a pointer record (in the version 1 shape) from stored bytes of
+        any version.
+    '''
+
+    if body[:2] == gzip_magic_bytes:
+        body = zlib.decompress(body, gzip_wbits)
+
+    record = json.loads(body.decode("utf-8"))
+
+    format_version = record.pop("format-version", 1)
+
+    if format_version > record_format_version:
+        raise Exception("Unsupported pointer record format version: {}.".format(format_version))
+
+    if "queued-log-group" not in record and "queued-function" in record:
+        record["queued-log-group"] = "/aws/lambda/{}".format(record["queued-function"])
+
+    return record
@@ -0,0 +1,325 @@
+'''
+    Recurring schedules, expanded into ordinary pointers a short horizon ahead.
+
+    A series is one record:
+
+        recurring/<schedule-id>.json
+
+    holding the function, payload, schedule expression ("rate(5 minutes)" or a
+    six-field "cron(...)", as in CloudWatch Events), optional start and end
+    times, a version, and the next occurrence not yet written. An expansion
+    marker:
+
+        expansions/<minute>/<schedule-id>.<version>
+
+    says when the series next needs expanding, so the expander only reads the
+    series that are due rather than every series. Expanding writes a pointer for
+    each occurrence up to horizon_seconds ahead, with an ID derived from the
+    series and the occurrence time, so writing one again replaces it.
+
+    Updating a series writes its record with a new version; cancelling deletes
+    it. Either way, that's one write, however long the series runs. Pointers
+    already written for an older version (or a cancelled series) carry the
+    version they were written for, and are dropped by the dispatcher rather than
+    invoked. Markers for an older version are dropped by the expander.
+'''
+
+from __future__ import print_function
+
+import re, json, time, calendar, datetime
+
+from lambda_scheduler import keys, records
+
+series_prefix = "recurring/"
+expansion_prefix = "expansions/"
+
+# Kept past a finished series' last occurrence, so it's still current when
+# that occurrence is dispatched.
+finished_series_retention_seconds = 60 * 60
+
+rate_pattern = re.compile(r"^rate\((\d+) (minute|minutes|hour|hours|day|days)\)$")
+cron_pattern = re.compile(r"^cron\(([^)]*)\)$")
+
+rate_unit_seconds = {
+    "minute": 60,
+    "hour": 60 * 60,
+    "day": 24 * 60 * 60
+}
+
+month_names = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+day_of_week_names = ["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"]
+
+# (minimum, maximum, names) for each cron field, in order.
+cron_fields = [
+    (0, 59, None),
+    (0, 23, None),
+    (1, 31, None),
+    (1, 12, month_names),
+    (1, 7, day_of_week_names),
+    (1970, 2199, None)
+]
+
+def series_key(schedule_id):
+    return "{}{}.json".format(series_prefix, schedule_id)
+
+def expansion_marker_key(minute, schedule_id, version):
+    return "{}{}/{}.{}".format(expansion_prefix, minute, schedule_id, version)
+
+def occurrence_pointer_id(schedule_id, occurrence_epoch):
+    return "{}-{}".format(schedule_id, int(occurrence_epoch))
+
+class RateExpression(object):
+
+    def __init__(self, period_seconds, start_epoch):
+        self.period_seconds = period_seconds
+        self.start_epoch = start_epoch
+
+    def next_occurrence(self, after_epoch):
+
+        if after_epoch < self.start_epoch:
+            return self.start_epoch
+
+        return self.start_epoch + (int((after_epoch - self.start_epoch) // self.period_seconds) + 1) * self.period_seconds
+
+class CronExpression(object):
+
+    def __init__(self, field_values, start_epoch):
+        self.minutes, self.hours, self.days_of_month, self.months, self.days_of_week, self.years = field_values
+        self.start_epoch = start_epoch
+
+    def next_occurrence(self, after_epoch):
+
+        after_epoch = max(after_epoch, self.start_epoch - 1)
+
+        # The first whole minute after after_epoch.
+        after = datetime.datetime.utcfromtimestamp((int(after_epoch) // 60 + 1) * 60)
+        day = after.date()
+
+        while day.year <= cron_fields[5][1]:
+
+            if day.year not in self.years:
+                day = datetime.date(day.year + 1, 1, 1)
+                continue
+
+            if day.month not in self.months:
+                day = datetime.date(day.year + (day.month // 12), day.month % 12 + 1, 1)
+                continue
+
+            # Python's Monday is 0; cron's Sunday is 1.
+            if day.day in self.days_of_month and (day.weekday() + 1) % 7 + 1 in self.days_of_week:
+                for each_hour in self.hours:
+                    for each_minute in self.minutes:
+                        each_occurrence = datetime.datetime(day.year, day.month, day.day, each_hour, each_minute)
+
+                        if each_occurrence >= after:
+                            return calendar.timegm(each_occurrence.timetuple())
+
+            day += datetime.timedelta(days=1)
+
+        return None
+
+def parse_cron_field(field, minimum, maximum, names):
+
+    if field in ["*", "?"]:
+        return list(range(minimum, maximum + 1))
+
+    values = set()
+
+    def parse_value(value):
+        if names is not None and value.upper() in names:
+            return names.index(value.upper()) + minimum
+        return int(value)
+
+    for each_item in field.split(","):
+        each_range, step = (each_item.split("/", 1) + ["1"])[:2]
+
+        if each_range == "*":
+            low, high = minimum, maximum
+        elif "-" in each_range:
+            low, high = (parse_value(x) for x in each_range.split("-", 1))
+        else:
+            low = parse_value(each_range)
+            high = maximum if "/" in each_item else low
+
+        if low < minimum or high > maximum or low > high or int(step) < 1:
+            raise ValueError(each_item)
+
+        values.update(range(low, high + 1, int(step)))
+
+    return sorted(values)
+
+def parse_schedule_expression(expression, start_epoch):
+
+    '''
+        Returns an object whose next_occurrence(after_epoch) gives the first
+        occurrence after after_epoch (and not before start_epoch), or None.
+    '''
+
+    rate_match = rate_pattern.match(expression or "")
+
+    if rate_match is not None:
+        period_seconds = int(rate_match.group(1)) * rate_unit_seconds[rate_match.group(2).rstrip("s")]
+
+        if period_seconds == 0:
+            raise Exception("Schedule expression \"{}\" must have a rate of at least 1 minute.".format(expression))
+
+        return RateExpression(period_seconds, start_epoch)
+
+    cron_match = cron_pattern.match(expression or "")
+
+    if cron_match is not None:
+        fields = cron_match.group(1).split()
+
+        if len(fields) != len(cron_fields):
+            raise Exception("Schedule expression \"{}\" must have {} fields.".format(expression, len(cron_fields)))
+
+        try:
+            field_values = list(parse_cron_field(x, *y) for x, y in zip(fields, cron_fields))
+        except ValueError as e:
+            raise Exception("Schedule expression \"{}\" has an invalid field: \"{}\".".format(expression, e))
+
+        return CronExpression(field_values, start_epoch)
+
+    raise Exception("Schedule expression \"{}\" must be a rate(...) or cron(...) expression.".format(expression))
+
+class RecurrenceExpander(object):
+
+    '''
+        Writes the pointers for series occurrences up to horizon_seconds ahead,
+        at most max_occurrences per series each time it's expanded.
+    '''
+
+    def __init__(self, storage_backend, horizon_seconds, shard_count, max_occurrences=1000):
+        self.storage_backend = storage_backend
+        self.horizon_seconds = horizon_seconds
+        self.shard_count = shard_count
+        self.max_occurrences = max_occurrences
+
+    def load_series(self, schedule_id):
+
+        series_body = self.storage_backend.get_object_if_exists(series_key(schedule_id))
+
+        if series_body is None:
+            return None
+
+        return json.loads(series_body.decode("utf-8"))
+
+    def save_series(self, series):
+        self.storage_backend.put_object(
+            series_key(series["schedule-id"]),
+            json.dumps(series, separators=(",", ":")).encode("utf-8")
+        )
+
+    def expand_due(self, now=None):
+
+        '''
+            Expands every series whose expansion marker is due. Returns the
+            number of occurrences written.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        now_minute = keys.epoch_to_minute_string(now)
+        occurrence_count = 0
+
+        for each_prefix in self.storage_backend.list_prefixes(expansion_prefix):
+
+            if each_prefix[len(expansion_prefix):-1] > now_minute:
+                break
+
+            for each_marker_key in list(self.storage_backend.list_keys(each_prefix)):
+                occurrence_count += self.expand_marker(each_marker_key, now)
+
+        return occurrence_count
+
+    def expand_marker(self, marker_key, now):
+
+        schedule_id, version = marker_key.split("/")[-1].rsplit(".", 1)
+
+        series = self.load_series(schedule_id)
+        occurrence_count = 0
+
+        if series is not None and "{}".format(series["version"]) == version:
+            if series["next-occurrence"] is None:
+
+                # Finished, and its last occurrence is long gone.
+                self.storage_backend.delete_object(series_key(schedule_id))
+            else:
+                occurrence_count = self.expand(series, now)
+
+        self.storage_backend.delete_object(marker_key)
+
+        return occurrence_count
+
+    def expand(self, series, now=None):
+
+        '''
+            Writes the pointers for the series' occurrences up to the horizon,
+            then saves the series and marks when it's next due. Returns the
+            number of occurrences written.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        expression = parse_schedule_expression(series["schedule-expression"], series["start-time"])
+
+        occurrence_epoch = series["next-occurrence"]
+        last_occurrence_epoch = None
+        written_index_marker_keys = set()
+        occurrence_count = 0
+
+        while occurrence_epoch is not None and occurrence_epoch <= now + self.horizon_seconds and occurrence_count < self.max_occurrences:
+
+            if series.get("end-time") is not None and occurrence_epoch > series["end-time"]:
+                occurrence_epoch = None
+                break
+
+            pointer_key, index_marker_key = keys.pointer_key(
+                keys.epoch_to_datetime_string(occurrence_epoch),
+                occurrence_pointer_id(series["schedule-id"], occurrence_epoch),
+                self.shard_count,
+                now
+            )
+
+            s3_pointer_content = {
+                "function-arn": series["function-arn"],
+                "payload": series["payload"],
+                "schedule-id": series["schedule-id"],
+                "schedule-version": series["version"],
+                "queued-timestamp": int(now)
+            }
+
+            for each_name in ["dispatch-limits", "max-staleness-seconds"]:
+                if each_name in series:
+                    s3_pointer_content[each_name] = series[each_name]
+
+            self.storage_backend.put_object(pointer_key, records.encode_pointer_record(s3_pointer_content))
+
+            if index_marker_key not in written_index_marker_keys:
+                self.storage_backend.put_object(index_marker_key, b"")
+                written_index_marker_keys.add(index_marker_key)
+
+            last_occurrence_epoch = occurrence_epoch
+            occurrence_epoch = expression.next_occurrence(occurrence_epoch)
+            occurrence_count += 1
+
+        if occurrence_epoch is not None and series.get("end-time") is not None and occurrence_epoch > series["end-time"]:
+            occurrence_epoch = None
+
+        series["next-occurrence"] = occurrence_epoch
+        self.save_series(series)
+
+        if occurrence_epoch is not None:
+            # Topped up once half the horizon is left, rather than every minute.
+            next_expansion_epoch = max(now + 60, occurrence_epoch - self.horizon_seconds // 2)
+        else:
+            next_expansion_epoch = max(now, last_occurrence_epoch or now) + finished_series_retention_seconds
+
+        self.storage_backend.put_object(
+            expansion_marker_key(keys.epoch_to_minute_string(next_expansion_epoch), series["schedule-id"], series["version"]),
+            b""
+        )
+
+        return occurrence_count
@@ -0,0 +1,157 @@
+'''
+    Index from schedule IDs to where their pointers are stored, so one can be
+    found, cancelled or rescheduled without listing queued/.
+
+    An individually stored pointer is indexed by its own entry:
+
+        schedules/<schedule-id>.json        {"key": <pointer key>}
+
+    Records written as segments are indexed by one entry per request, keyed by
+    the request's ID (their schedule IDs are "<request-id>-<n>"):
+
+        schedules/<request-id>.json         {"segments": {<n>: <bucket minute>}}
+
+    with a reference from each bucket minute it has records in:
+
+        schedules/by-minute/<bucket-minute>/<request-id>
+
+    A record in a segment can't be deleted on its own, so it's cancelled with a
+    marker that the dispatcher checks when it reads that minute's segments:
+
+        cancellations/<bucket-minute>/<schedule-id>
+
+    Entries for individual pointers are removed once they're dispatched, and
+    cancellation markers once their minute's index markers are. Then so are the
+    minute's references, and the entries of requests with none of their minutes
+    left. A record is only found while its minute's index markers remain.
+'''
+
+from __future__ import print_function
+
+import json
+
+from lambda_scheduler import keys
+
+index_prefix = "schedules/"
+minute_reference_prefix = "schedules/by-minute/"
+cancellation_prefix = "cancellations/"
+
+def index_key(schedule_id):
+    return "{}{}.json".format(index_prefix, schedule_id)
+
+def minute_reference_key(bucket_minute, request_id):
+    return "{}{}/{}".format(minute_reference_prefix, bucket_minute, request_id)
+
+def cancellation_minute_prefix(bucket_minute):
+    return "{}{}/".format(cancellation_prefix, bucket_minute)
+
+def cancellation_key(bucket_minute, schedule_id):
+    return "{}{}".format(cancellation_minute_prefix(bucket_minute), schedule_id)
+
+class ScheduleIndex(object):
+
+    def __init__(self, storage_backend):
+        self.storage_backend = storage_backend
+
+    def put_pointer_location(self, schedule_id, pointer_key):
+        self.put_entry(schedule_id, {
+            "key": pointer_key
+        })
+
+    def put_segment_locations(self, request_id, bucket_minutes):
+
+        '''
+            Indexes the records a request wrote as segments, given the bucket
+            minute of each (by the n of its "<request-id>-<n>" schedule ID).
+        '''
+
+        # Referenced first, so an entry is never left where nothing will remove it.
+        for each_bucket_minute in sorted(set(bucket_minutes.values())):
+            self.storage_backend.put_object(minute_reference_key(each_bucket_minute, request_id), b"")
+
+        self.put_entry(request_id, {
+            "segments": dict(("{}".format(x), y) for x, y in bucket_minutes.items())
+        })
+
+    def put_entry(self, entry_id, entry):
+        self.storage_backend.put_object(
+            index_key(entry_id),
+            json.dumps(entry, separators=(",", ":")).encode("utf-8")
+        )
+
+    def find(self, schedule_id):
+
+        '''
+            Returns {"key": <pointer key>} for an individually stored pointer,
+            {"bucket-minute": <minute>} for a record in a segment, or None.
+        '''
+
+        entry = self.get_entry(schedule_id)
+
+        if entry is not None and "key" in entry:
+            return entry
+
+        if "-" not in schedule_id:
+            return None
+
+        request_id, record_number = schedule_id.rsplit("-", 1)
+        entry = self.get_entry(request_id)
+
+        if entry is None or record_number not in entry.get("segments", {}):
+            return None
+
+        bucket_minute = entry["segments"][record_number]
+
+        # Dispatched, once the minute's been settled.
+        if not self.is_minute_queued(bucket_minute):
+            return None
+
+        if self.storage_backend.get_object_if_exists(cancellation_key(bucket_minute, schedule_id)) is not None:
+            return None
+
+        return {
+            "bucket-minute": bucket_minute
+        }
+
+    def is_minute_queued(self, bucket_minute):
+        return next(iter(self.storage_backend.list_keys(keys.index_marker_key(bucket_minute, ""))), None) is not None
+
+    def settle_minute(self, bucket_minute):
+
+        '''
+            Removes a minute's references once its index markers are gone, and
+            the entries of requests with none of their minutes left.
+        '''
+
+        for each_reference_key in list(self.storage_backend.list_keys("{}{}/".format(minute_reference_prefix, bucket_minute))):
+            each_request_id = each_reference_key.split("/")[-1]
+            each_entry = self.get_entry(each_request_id)
+
+            if each_entry is not None and not any(self.is_minute_queued(x) for x in set(each_entry.get("segments", {}).values())):
+                self.delete(each_request_id)
+
+            self.storage_backend.delete_object(each_reference_key)
+
+    def get_entry(self, entry_id):
+
+        entry_body = self.storage_backend.get_object_if_exists(index_key(entry_id))
+
+        if entry_body is None:
+            return None
+
+        return json.loads(entry_body.decode("utf-8"))
+
+    def delete(self, schedule_id):
+        self.storage_backend.delete_object(index_key(schedule_id))
+
+    def cancel_segment_record(self, bucket_minute, schedule_id):
+        self.storage_backend.put_object(cancellation_key(bucket_minute, schedule_id), b"")
+
+    def list_cancelled(self, bucket_minute):
+
+        '''
+            Returns the schedule IDs of the cancelled segment records in a
+            bucket minute.
+        '''
+
+        return set(x.split("/")[-1] for x in self.storage_backend.list_keys(cancellation_minute_prefix(bucket_minute)))
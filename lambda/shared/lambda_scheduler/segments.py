@@ -0,0 +1,204 @@
+'''
+    Segment files: many pointer records for the same bucket minute stored as one
+    S3 object, so a batch costs one PUT per segment rather than one per
+    invocation (and the dispatcher one GET).
+
+    A segment is a header line followed by one compact pointer record per line,
+    each carrying its own "execution-time" and "pointer-id", sorted by execution
+    time. Segments over records.compression_threshold_bytes are gzipped as a
+    whole; iter_segment_records streams either form without reading the whole
+    object into memory.
+'''
+
+from __future__ import print_function
+
+import json, time, zlib, threading
+
+from lambda_scheduler import records
+
+segment_format_version = 1
+
+def encode_segment(segment_records):
+    return records.compress_body(serialize_segment(segment_records))
+
+def serialize_segment(segment_records, record_lines=None):
+
+    '''
+        Returns a segment as uncompressed bytes. record_lines are the records
+        already serialized (in the same order), if they have been.
+    '''
+
+    if record_lines is None:
+        record_lines = list(records.serialize_pointer_record(x) for x in segment_records)
+
+    sorted_pairs = sorted(zip(segment_records, record_lines), key=lambda x: x[0]["execution-time"])
+
+    header = {
+        "segment-format-version": segment_format_version,
+        "record-count": len(sorted_pairs),
+        "first-execution-time": sorted_pairs[0][0]["execution-time"],
+        "last-execution-time": sorted_pairs[-1][0]["execution-time"]
+    }
+
+    lines = [json.dumps(header, separators=(",", ":")).encode("utf-8")]
+    lines.extend(x[1] for x in sorted_pairs)
+
+    return b"\n".join(lines) + b"\n"
+
+def iter_segment_lines(fileobj, chunk_size=64 * 1024):
+
+    decompressor = None
+    pending = b""
+    first_chunk = True
+
+    while True:
+        chunk = fileobj.read(chunk_size)
+
+        if first_chunk:
+            first_chunk = False
+            if chunk[:2] == records.gzip_magic_bytes:
+                decompressor = zlib.decompressobj(records.gzip_wbits)
+
+        if not chunk:
+            if decompressor is not None:
+                pending += decompressor.flush()
+            break
+
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+
+        for each_line in lines:
+            if each_line:
+                yield each_line
+
+    if pending:
+        yield pending
+
+def iter_segment_records(fileobj):
+
+    '''
+        Yields the header and then each pointer record of a segment, read from a
+        file-like object (e.g. an S3 StreamingBody).
+    '''
+
+    segment_lines = iter_segment_lines(fileobj)
+
+    header = json.loads(next(segment_lines).decode("utf-8"))
+
+    if header.get("segment-format-version", 0) > segment_format_version:
+        raise Exception("Unsupported segment format version: {}.".format(header["segment-format-version"]))
+
+    yield header
+
+    for each_line in segment_lines:
+        yield records.decode_pointer_record(each_line)
+
+class SegmentWriter(object):
+
+    '''
+        Buffers pointer records by bucket minute and writes each minute's buffer
+        as a segment once it reaches max_records / max_bytes (counted as the
+        serialized records), or when flushed. A long-lived writer that flushes
+        periodically can give a max_age_seconds, after which a buffer is written
+        by the next flush even if it isn't full.
+
+        Records are serialized as they're added, and written as they were then
+        (so anything like externalizing a payload has to be done first):
+        put_segment(bucket_minute, segment_records, record_lines) gets both.
+
+        Callers are told a record is queued (through its on_flushed callback) only
+        after the segment holding it has been written.
+    '''
+
+    def __init__(self, put_segment, max_records, max_bytes, max_age_seconds=None):
+        self.put_segment = put_segment
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, bucket_minute, record, on_flushed):
+
+        '''
+            Buffers a record. on_flushed(error) is called once its segment has
+            been written (error is None) or has failed to be.
+        '''
+
+        record_line = records.serialize_pointer_record(record)
+
+        with self._lock:
+            buffer = self._buffers.get(bucket_minute)
+
+            if buffer is None:
+                buffer = self._buffers[bucket_minute] = {
+                    "created": time.time(),
+                    "bytes": 0,
+                    "entries": []
+                }
+
+            # As written in the segment, with its newline.
+            buffer["entries"].append((record, record_line, on_flushed))
+            buffer["bytes"] += len(record_line) + 1
+
+            if len(buffer["entries"]) < self.max_records and buffer["bytes"] < self.max_bytes:
+                return []
+
+            del self._buffers[bucket_minute]
+
+        return [(bucket_minute, buffer["entries"])]
+
+    def take_due(self, now=None, flush_all=False):
+
+        '''
+            Removes and returns the buffers that should be written now.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        due_buffers = []
+
+        with self._lock:
+            for each_bucket_minute in list(self._buffers.keys()):
+                each_buffer = self._buffers[each_bucket_minute]
+
+                if flush_all or (self.max_age_seconds is not None and now - each_buffer["created"] >= self.max_age_seconds):
+                    due_buffers.append((each_bucket_minute, each_buffer["entries"]))
+                    del self._buffers[each_bucket_minute]
+
+        return due_buffers
+
+    def write(self, bucket_minute, entries):
+
+        try:
+            self.put_segment(bucket_minute, list(x[0] for x in entries), list(x[1] for x in entries))
+            error = None
+        except Exception as e:
+            error = e
+
+        for each_record, each_record_line, each_on_flushed in entries:
+            each_on_flushed(error)
+
+    def flush(self, executor=None, now=None, flush_all=False, full_buffers=None):
+
+        '''
+            Writes full_buffers (as returned by add) and any buffers that are due,
+            concurrently if an executor is given.
+        '''
+
+        due_buffers = list(full_buffers or []) + self.take_due(now, flush_all)
+
+        if executor is None:
+            for each_bucket_minute, each_entries in due_buffers:
+                self.write(each_bucket_minute, each_entries)
+            return
+
+        futures = list(executor.submit(self.write, x, y) for x, y in due_buffers)
+
+        for each_future in futures:
+            each_future.result()
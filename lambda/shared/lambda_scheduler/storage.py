@@ -0,0 +1,366 @@
+'''
+    Storage backends for pointers, segments and index markers.
+
+    S3StorageBackend is what's deployed. LocalStorageBackend keeps the same
+    layout in a local directory, so the queuer and dispatcher can run (and be
+    profiled) on one machine without AWS.
+
+    Keys are always "/"-separated, and listings are returned in key order, as S3
+    returns them.
+'''
+
+from __future__ import print_function
+
+import os, io, errno, shutil, tempfile
+
+class StorageBackend(object):
+
+    def put_object(self, key, body):
+        raise NotImplementedError()
+
+    def get_object(self, key):
+
+        '''
+            Returns the object's content as bytes.
+        '''
+
+        return self.open_object(key).read()
+
+    def get_object_if_exists(self, key):
+
+        '''
+            Returns the object's content as bytes, or None if there's no such
+            object.
+        '''
+
+        try:
+            return self.get_object(key)
+        except KeyError:
+            return None
+
+    def open_object(self, key, start_offset=0):
+
+        '''
+            Returns a file-like object for streaming the object's content, from
+            start_offset bytes in.
+        '''
+
+        raise NotImplementedError()
+
+    def list_keys(self, prefix):
+
+        '''
+            Yields every key starting with prefix, in key order.
+        '''
+
+        raise NotImplementedError()
+
+    def list_prefixes(self, prefix):
+
+        '''
+            Yields the distinct "<prefix><name>/" prefixes directly under prefix,
+            in key order.
+        '''
+
+        raise NotImplementedError()
+
+    def move_object(self, key, destination_key):
+        raise NotImplementedError()
+
+    def delete_object(self, key):
+        raise NotImplementedError()
+
+    def delete_objects(self, keys):
+
+        failures = self.try_delete_objects(keys)
+
+        if len(failures) > 0:
+            raise Exception("Unable to delete {} object(s), e.g. {}: {}.".format(
+                len(failures),
+                failures[0][0],
+                failures[0][1]
+            ))
+
+    def try_delete_objects(self, keys):
+
+        '''
+            Deletes what it can, and returns (key, error message) for each key
+            it couldn't.
+        '''
+
+        failures = []
+
+        for each_key in keys:
+            try:
+                self.delete_object(each_key)
+            except Exception as e:
+                failures.append((each_key, "{}".format(e)))
+
+        return failures
+
+class S3StorageBackend(StorageBackend):
+
+    def __init__(self, bucket_name, s3_client):
+        self.bucket_name = bucket_name
+        self.s3_client = s3_client
+
+    def put_object(self, key, body):
+        self.s3_client.put_object(
+            Bucket = self.bucket_name,
+            Body = body,
+            Key = key
+        )
+
+    def open_object(self, key, start_offset=0):
+        return open_s3_object(self.s3_client, self.bucket_name, key, start_offset)
+
+    def get_object_if_exists(self, key):
+        try:
+            return self.get_object(key)
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ["NoSuchKey", "404"]:
+                return None
+            raise
+
+    def list_keys(self, prefix):
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+
+        for each_list_response in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for each_item in each_list_response.get("Contents", []):
+                yield each_item["Key"]
+
+    def list_prefixes(self, prefix):
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+
+        for each_list_response in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter="/"):
+            for each_common_prefix in each_list_response.get("CommonPrefixes", []):
+                yield each_common_prefix["Prefix"]
+
+    def move_object(self, key, destination_key):
+
+        # S3 has no rename, so this is a copy and a delete.
+        self.s3_client.copy_object(
+            Bucket = self.bucket_name,
+            Key = destination_key,
+            CopySource = {
+                "Bucket": self.bucket_name,
+                "Key": key
+            }
+        )
+
+        self.delete_object(key)
+
+    def delete_object(self, key):
+        self.s3_client.delete_object(
+            Bucket = self.bucket_name,
+            Key = key
+        )
+
+    def try_delete_objects(self, keys):
+
+        keys = list(keys)
+        failures = []
+
+        # delete_objects takes at most 1,000 keys per request.
+        for i in range(0, len(keys), 1000):
+            try:
+                response = self.s3_client.delete_objects(
+                    Bucket = self.bucket_name,
+                    Delete = {
+                        "Objects": list({"Key": x} for x in keys[i:i + 1000]),
+                        "Quiet": True
+                    }
+                )
+            except Exception as e:
+
+                # e.g. throttled; none of this request's keys were deleted.
+                failures.extend((x, "{}".format(e)) for x in keys[i:i + 1000])
+                continue
+
+            failures.extend((x["Key"], x.get("Message")) for x in response.get("Errors", []))
+
+        return failures
+
+class LocalStorageBackend(StorageBackend):
+
+    '''
+        Stores each object as a file under root_dir. Writes go through a
+        temporary file and a rename, so readers never see a partial object, and
+        empty directories are removed so listings match S3's.
+    '''
+
+    def __init__(self, root_dir):
+        self.root_dir = os.path.abspath(root_dir)
+
+        if not os.path.isdir(self.root_dir):
+            os.makedirs(self.root_dir)
+
+    def path_for_key(self, key):
+        return os.path.join(self.root_dir, *key.split("/"))
+
+    def put_object(self, key, body):
+
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+
+        object_path = self.path_for_key(key)
+
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.root_dir, prefix=".tmp-")
+
+        with os.fdopen(file_descriptor, "wb") as f:
+            f.write(body)
+
+        self.rename_into_place(temp_path, object_path)
+
+    def rename_into_place(self, source_path, destination_path):
+
+        # Another thread may prune the (empty) parent directory in between.
+        for attempt in range(5):
+            try:
+                os.makedirs(os.path.dirname(destination_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            try:
+                os.rename(source_path, destination_path)
+                return
+            except OSError as e:
+                if e.errno != errno.ENOENT or attempt == 4:
+                    raise
+
+    def open_object(self, key, start_offset=0):
+        try:
+            fileobj = io.open(self.path_for_key(key), "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+        fileobj.seek(start_offset)
+
+        return fileobj
+
+    def list_keys(self, prefix):
+
+        # Start from the deepest directory the prefix fully names.
+        prefix_dir = prefix.rsplit("/", 1)[0] + "/" if "/" in prefix else ""
+
+        for each_key in self.walk_keys(prefix_dir):
+            if each_key.startswith(prefix):
+                yield each_key
+
+    def walk_keys(self, dir_key):
+
+        dir_path = self.path_for_key(dir_key.rstrip("/")) if dir_key else self.root_dir
+
+        try:
+            names = os.listdir(dir_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        # Sorting as "<name>/" for directories keeps the order S3 would return.
+        entries = []
+        for each_name in names:
+            if each_name.startswith(".tmp-"):
+                continue
+
+            if os.path.isdir(os.path.join(dir_path, each_name)):
+                entries.append(("{}{}/".format(dir_key, each_name), True))
+            else:
+                entries.append(("{}{}".format(dir_key, each_name), False))
+
+        for each_key, is_dir in sorted(entries):
+            if is_dir:
+                for each_child_key in self.walk_keys(each_key):
+                    yield each_child_key
+            else:
+                yield each_key
+
+    def list_prefixes(self, prefix):
+
+        dir_path = self.path_for_key(prefix.rstrip("/")) if prefix.rstrip("/") else self.root_dir
+
+        try:
+            names = os.listdir(dir_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        for each_name in sorted(names):
+            if os.path.isdir(os.path.join(dir_path, each_name)):
+                yield "{}{}/".format(prefix, each_name)
+
+    def move_object(self, key, destination_key):
+        try:
+            self.rename_into_place(self.path_for_key(key), self.path_for_key(destination_key))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+        self.prune_empty_dirs(key)
+
+    def delete_object(self, key):
+        try:
+            os.unlink(self.path_for_key(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self.prune_empty_dirs(key)
+
+    def prune_empty_dirs(self, key):
+
+        key_parts = key.split("/")[:-1]
+
+        while len(key_parts) > 0:
+            try:
+                os.rmdir(os.path.join(self.root_dir, *key_parts))
+            except OSError:
+                break
+
+            key_parts.pop()
+
+    def clear(self):
+        shutil.rmtree(self.root_dir)
+        os.makedirs(self.root_dir)
+
+def open_s3_object(s3_client, bucket_name, key, start_offset=0):
+
+    get_object_kwargs = {
+        "Bucket": bucket_name,
+        "Key": key
+    }
+
+    if start_offset > 0:
+        get_object_kwargs["Range"] = "bytes={}-".format(start_offset)
+
+    try:
+        return s3_client.get_object(**get_object_kwargs)["Body"]
+    except Exception as e:
+
+        # A range starting at the end of the object is "unsatisfiable".
+        if start_offset > 0 and getattr(e, "response", {}).get("Error", {}).get("Code") == "InvalidRange":
+            return io.BytesIO(b"")
+        raise
+
+def create_storage_backend(s3_bucket_name_getter, s3_client_getter):
+
+    '''
+        Returns the backend selected by the STORAGE_BACKEND environment variable:
+        "s3" (the default) or "local", which stores under LOCAL_STORAGE_DIR.
+    '''
+
+    backend_name = os.environ.get("STORAGE_BACKEND", "s3").lower()
+
+    if backend_name == "local":
+        return LocalStorageBackend(os.environ.get("LOCAL_STORAGE_DIR", os.path.join(tempfile.gettempdir(), "lambda-scheduler")))
+
+    if backend_name == "s3":
+        return S3StorageBackend(s3_bucket_name_getter(), s3_client_getter())
+
+    raise Exception("Unknown storage backend: \"{}\".".format(backend_name))
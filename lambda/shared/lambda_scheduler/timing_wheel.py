@@ -0,0 +1,143 @@
+'''
+    A hierarchical timing wheel holding the pointers due in the next few
+    minutes, so each one is fired on its own second instead of whenever a
+    poller next gets round to listing it.
+
+    The inner wheel has a slot for each second of the current minute, and the
+    outer wheel a slot for each minute after that, up to horizon_minutes ahead.
+    When a minute comes round, its outer slot is cascaded into the inner wheel.
+    Entries past the horizon are refused (they're added once the horizon
+    reaches them), so memory is bounded by what's due in the look-ahead window.
+
+    Times are whole seconds, the resolution of execution times. The clocks
+    below let the same loop run against real time or a simulated clock.
+'''
+
+from __future__ import print_function
+
+import time, random, threading
+
+class WheelEntry(object):
+
+    __slots__ = ("due_epoch", "key")
+
+    def __init__(self, due_epoch, key):
+        self.due_epoch = due_epoch
+        self.key = key
+
+class TimingWheel(object):
+
+    def __init__(self, now, horizon_minutes):
+        self.current_second = int(now)
+        self.horizon_minutes = horizon_minutes
+        self.second_slots = list([] for i in range(60))
+        self.minute_slots = list([] for i in range(horizon_minutes + 1))
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    @property
+    def horizon_epoch(self):
+
+        '''
+            The last second an entry can be added for: the end of the minute
+            horizon_minutes after the current one.
+        '''
+
+        return (self.current_second // 60 + self.horizon_minutes + 1) * 60 - 1
+
+    def add(self, due_epoch, key):
+
+        '''
+            Adds key to be fired at due_epoch (or on the next advance, if that's
+            already passed). Returns False if it's past the horizon. Keys already
+            held aren't added twice.
+        '''
+
+        due_epoch = max(int(due_epoch), self.current_second)
+
+        if due_epoch > self.horizon_epoch:
+            return False
+
+        if key in self.keys:
+            return True
+
+        self.keys.add(key)
+
+        entry = WheelEntry(due_epoch, key)
+
+        if due_epoch // 60 == self.current_second // 60:
+            self.second_slots[due_epoch % 60].append(entry)
+        else:
+            self.minute_slots[(due_epoch // 60) % len(self.minute_slots)].append(entry)
+
+        return True
+
+    def advance(self, now):
+
+        '''
+            Moves the wheel on to now, returning the entries due by then in the
+            order they were due.
+        '''
+
+        due_entries = []
+
+        while self.current_second <= int(now):
+
+            if self.current_second % 60 == 0:
+                minute_slot_index = (self.current_second // 60) % len(self.minute_slots)
+
+                for each_entry in self.minute_slots[minute_slot_index]:
+                    self.second_slots[each_entry.due_epoch % 60].append(each_entry)
+
+                self.minute_slots[minute_slot_index] = []
+
+            second_slot_index = self.current_second % 60
+
+            due_entries.extend(self.second_slots[second_slot_index])
+            self.second_slots[second_slot_index] = []
+
+            self.current_second += 1
+
+        for each_entry in due_entries:
+            self.keys.discard(each_entry.key)
+
+        return due_entries
+
+class SystemClock(object):
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(max(0, seconds))
+
+class SimulatedClock(object):
+
+    '''
+        A clock whose sleeps return at once. Time spent working still passes,
+        as does any latency charged with advance(), so firing skew measured
+        against it reflects the work done without waiting out the sleeps. Each
+        sleep may also oversleep by up to max_oversleep_seconds, as a real one
+        can.
+    '''
+
+    def __init__(self, now, max_oversleep_seconds=0, seed=None):
+        self.offset = now - time.time()
+        self.max_oversleep_seconds = max_oversleep_seconds
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return time.time() + self.offset
+
+    def sleep(self, seconds):
+        self.advance(max(0, seconds) + self.random.uniform(0, self.max_oversleep_seconds))
+
+    def advance(self, seconds):
+        with self._lock:
+            self.offset += seconds
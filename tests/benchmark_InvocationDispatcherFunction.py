@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+'''
+    Firing skew of the InvocationDispatcherFunction: how long after its
+    execution time each pointer is invoked, with due pointers listed on each
+    tick (polling) and prefetched into a timing wheel. Then the timing wheel
+    again, with a backlog of BENCHMARK_BACKLOG_COUNT pointers left over from an
+    hour-long outage, drained along with everything else and in catch-up mode;
+    skew there is only that of the pointers due during the run.
+
+    Runs a dispatch loop against a simulated clock, so several minutes of
+    dispatching take well under a minute: sleeps between ticks are skipped, but
+    time spent working still passes. Storage is the local backend, with each
+    LIST taking BENCHMARK_LIST_LATENCY_MS longer (as one to S3 would; LISTs
+    made in parallel overlap) and each sleep oversleeping by up to
+    BENCHMARK_OVERSLEEP_MS. Invokes are stubbed.
+
+    Like the tests, this runs against the build directory:
+
+    $ python deploy.py --build-lambda-functions-only
+    $ cd tests && python benchmark_InvocationDispatcherFunction.py
+'''
+
+from __future__ import print_function
+
+import os, sys, json, time, random, shutil, tempfile, unittest
+
+from local_helpers import LambdaFunctionTestCase, generate_lambda_context
+from benchmark_InvocationQueuerFunction import stdout_discarded
+
+benchmark_pointer_count = int(os.environ.get("BENCHMARK_POINTER_COUNT", 2000))
+benchmark_run_seconds = int(os.environ.get("BENCHMARK_RUN_SECONDS", 150))
+benchmark_list_latency_seconds = int(os.environ.get("BENCHMARK_LIST_LATENCY_MS", 40)) / 1000.0
+benchmark_oversleep_seconds = int(os.environ.get("BENCHMARK_OVERSLEEP_MS", 5)) / 1000.0
+benchmark_backlog_count = int(os.environ.get("BENCHMARK_BACKLOG_COUNT", 5000))
+
+function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+benchmark_start_epoch = 1476316810.5
+
+class LongRunningContext(object):
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+class Benchmark(LambdaFunctionTestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(Benchmark, self).__init__(*args, **kwargs)
+        self.function_name = "InvocationDispatcherFunction"
+
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = self.storage_dir
+        os.environ["SHARED_BUCKET"] = "lambda-scheduler-benchmark"
+
+        super(Benchmark, self).setUp()
+
+    def tearDown(self):
+        super(Benchmark, self).tearDown()
+
+        for each_name in ["STORAGE_BACKEND", "LOCAL_STORAGE_DIR", "SHARED_BUCKET"]:
+            del os.environ[each_name]
+
+        shutil.rmtree(self.storage_dir)
+
+    def write_pointers(self, storage_backend, backlog_count):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+
+        storage_backend.clear()
+
+        random_offsets = random.Random(0)
+
+        for i in range(benchmark_pointer_count + backlog_count):
+            if i < benchmark_pointer_count:
+                execution_epoch = int(benchmark_start_epoch) + random_offsets.randint(1, benchmark_run_seconds - 5)
+                written_epoch = benchmark_start_epoch
+            else:
+                execution_epoch = int(benchmark_start_epoch) - random_offsets.randint(180, 3600)
+                written_epoch = execution_epoch
+
+            pointer_key, index_marker_key = keys.pointer_key(
+                keys.epoch_to_datetime_string(execution_epoch),
+                "{}".format(i),
+                self.lambda_function.queue_shard_count,
+                now = written_epoch
+            )
+
+            storage_backend.put_object(pointer_key, records.encode_pointer_record({
+                "function-arn": function_arn,
+                "payload": {"execution-epoch": execution_epoch, "backlog": i >= benchmark_pointer_count}
+            }))
+            storage_backend.put_object(index_marker_key, b"")
+
+    def run_scenario(self, prefetch_minutes, backlog_count=0, catch_up_after_seconds=0):
+
+        timing_wheel = self.lambda_function.timing_wheel
+        storage = self.lambda_function.storage
+
+        class SlowListingStorageBackend(storage.LocalStorageBackend):
+
+            def list_keys(self, prefix):
+                time.sleep(benchmark_list_latency_seconds)
+                return super(SlowListingStorageBackend, self).list_keys(prefix)
+
+            def list_prefixes(self, prefix):
+                time.sleep(benchmark_list_latency_seconds)
+                return super(SlowListingStorageBackend, self).list_prefixes(prefix)
+
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        handler_object._storage = SlowListingStorageBackend(self.storage_dir)
+
+        on_time_lags = []
+        backlog_fired_count = [0]
+
+        def invoke_record(s3_pointer_content):
+            fired_time = clock.time()
+
+            if s3_pointer_content["payload"]["backlog"]:
+                backlog_fired_count[0] += 1
+            else:
+                on_time_lags.append(fired_time - s3_pointer_content["payload"]["execution-epoch"])
+
+            return fired_time
+
+        handler_object.invoke_record = invoke_record
+
+        self.write_pointers(handler_object._storage, backlog_count)
+
+        # Started once the pointers are written, so writing them isn't counted as skew.
+        clock = timing_wheel.SimulatedClock(benchmark_start_epoch, benchmark_oversleep_seconds, seed=0)
+        handler_object.clock = clock
+
+        original_settings = (self.lambda_function.dispatch_prefetch_minutes, self.lambda_function.dispatch_run_seconds, self.lambda_function.dispatch_catch_up_after_seconds)
+
+        self.lambda_function.dispatch_prefetch_minutes = prefetch_minutes
+        self.lambda_function.dispatch_run_seconds = benchmark_run_seconds
+        self.lambda_function.dispatch_catch_up_after_seconds = catch_up_after_seconds
+
+        try:
+            with stdout_discarded():
+                with self.lambda_function.ThreadPoolExecutor(max_workers=self.lambda_function.dispatch_max_workers) as executor:
+                    stats = self.lambda_function.DispatchStats()
+
+                    if prefetch_minutes > 0:
+                        handler_object.run_timing_wheel(executor, stats, LongRunningContext(), clock.time())
+                    else:
+                        handler_object.run_polling(executor, stats, LongRunningContext(), clock.time())
+        finally:
+            self.lambda_function.dispatch_prefetch_minutes, self.lambda_function.dispatch_run_seconds, self.lambda_function.dispatch_catch_up_after_seconds = original_settings
+
+        summary = stats.summary()
+        summary["dispatch-lag-seconds"] = self.lambda_function.summarize_seconds(on_time_lags)
+        summary["backlog-fired-count"] = backlog_fired_count[0]
+
+        return summary
+
+    def test_benchmark(self):
+
+        results = {
+            "pointers": benchmark_pointer_count,
+            "list-latency-ms": benchmark_list_latency_seconds * 1000,
+            "oversleep-ms": benchmark_oversleep_seconds * 1000,
+            "backlog": benchmark_backlog_count,
+            "scenarios": {
+                "polling": self.run_scenario(0),
+                "timing-wheel": self.run_scenario(2),
+                "backlog": self.run_scenario(2, benchmark_backlog_count),
+                "backlog-catch-up": self.run_scenario(2, benchmark_backlog_count, 120)
+            }
+        }
+
+        print(json.dumps(results, indent=4, sort_keys=True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+'''
+    Throughput and latency benchmarks for the InvocationQueuerFunction hot path.
+
+    Drives lambda_handler with single and batched requests, small and 200 KB
+    payloads, against a cold (new handler and clients for every request) or
+    warm handler. Storage is the local backend and the Lambda API is stubbed, so
+    results measure the function's own work and are stable across runs.
+
+    Like the tests, this runs against the build directory:
+
+    $ python deploy.py --build-lambda-functions-only
+    $ cd tests && python benchmark_InvocationQueuerFunction.py
+
+    Results are written as JSON to BENCHMARK_OUTPUT (by default,
+    build/benchmarks/InvocationQueuerFunction-<commit>.json). If BENCHMARK_BASELINE
+    names an earlier results file, each scenario is compared against it.
+'''
+
+from __future__ import print_function
+
+import os, sys, io, json, time, shutil, tempfile, unittest, subprocess, contextlib
+
+from local_helpers import LambdaFunctionTestCase, generate_lambda_context
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+timer = getattr(time, "perf_counter", time.time)
+
+repo_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+benchmark_iterations = int(os.environ.get("BENCHMARK_ITERATIONS", 200))
+
+function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+def sample_payload(size_bytes):
+    return {
+        "user-id": "9d5c2a4e-90dc-11e6-ac13-99ca095ca6aa",
+        "message": "x" * size_bytes
+    }
+
+def sample_invocation(payload_size_bytes, offset=0):
+    return {
+        "function-name": "ScheduledFunction",
+        "execution-time": int(time.time()) + 300 + offset,
+        "payload": sample_payload(payload_size_bytes)
+    }
+
+benchmark_scenarios = [
+    # (name, handler state, event)
+    ("single-small-warm", "warm", sample_invocation(64)),
+    ("single-small-cold", "cold", sample_invocation(64)),
+    ("single-200kb-warm", "warm", sample_invocation(200 * 1024)),
+    ("batch-100-small-warm", "warm", {"invocations": list(sample_invocation(64, i) for i in range(100))}),
+    ("batch-100-small-cold", "cold", {"invocations": list(sample_invocation(64, i) for i in range(100))}),
+    ("batch-10-200kb-warm", "warm", {"invocations": list(sample_invocation(200 * 1024, i) for i in range(10))})
+]
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir).decode("utf-8").strip()
+    except Exception:
+        return "unknown"
+
+@contextlib.contextmanager
+def stdout_discarded():
+
+    # The function logs each event; the cost of producing those lines is part
+    # of what's measured, but they shouldn't flood the terminal.
+    original_stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = original_stdout
+
+class Benchmark(LambdaFunctionTestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(Benchmark, self).__init__(*args, **kwargs)
+        self.function_name = "InvocationQueuerFunction"
+
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = self.storage_dir
+        os.environ["SHARED_BUCKET"] = "lambda-scheduler-benchmark"
+
+        super(Benchmark, self).setUp()
+
+    def tearDown(self):
+        super(Benchmark, self).tearDown()
+
+        for each_name in ["STORAGE_BACKEND", "LOCAL_STORAGE_DIR", "SHARED_BUCKET"]:
+            del os.environ[each_name]
+
+        shutil.rmtree(self.storage_dir)
+
+    def stub_get_function(self):
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            }
+        )
+
+    def prepare_request(self, handler_state):
+
+        '''
+            Returns a callable making one request against a handler in the given
+            state.
+        '''
+
+        if handler_state == "warm":
+            self.stub_get_function()
+            self.lambda_function.boto3_clients.clear()
+            self.lambda_function.handler_object = None
+
+            def make_request(event):
+                return self.lambda_function.lambda_handler(event, generate_lambda_context())
+
+            # The first request makes the handler (and its caches and clients) warm.
+            return make_request
+
+        def make_cold_request(event):
+
+            # A new container: no handler, no cached clients, no cached ARNs.
+            self.stub_get_function()
+            self.lambda_function.boto3_clients.clear()
+            self.lambda_function.handler_object = None
+
+            return self.lambda_function.lambda_handler(event, generate_lambda_context())
+
+        return make_cold_request
+
+    def run_scenario(self, handler_state, event):
+
+        make_request = self.prepare_request(handler_state)
+
+        invocation_count = len(event.get("invocations", [event]))
+
+        with stdout_discarded():
+
+            # Warm-up request, not measured.
+            make_request(event)
+
+            latencies = []
+            started = timer()
+
+            for i in range(benchmark_iterations):
+                request_started = timer()
+                make_request(event)
+                latencies.append(timer() - request_started)
+
+            elapsed = timer() - started
+
+            peak_allocated_bytes = None
+
+            if tracemalloc is not None and hasattr(tracemalloc, "reset_peak"):
+                peaks = []
+                tracemalloc.start()
+
+                for i in range(min(benchmark_iterations, 50)):
+                    tracemalloc.reset_peak()
+                    baseline_bytes = tracemalloc.get_traced_memory()[0]
+                    make_request(event)
+                    peaks.append(tracemalloc.get_traced_memory()[1] - baseline_bytes)
+
+                tracemalloc.stop()
+                peak_allocated_bytes = percentile(sorted(peaks), 0.5)
+
+        latencies.sort()
+
+        return {
+            "requests": benchmark_iterations,
+            "invocations-per-request": invocation_count,
+            "requests-per-second": round(benchmark_iterations / elapsed, 1),
+            "invocations-per-second": round(benchmark_iterations * invocation_count / elapsed, 1),
+            "latency-p50-ms": round(percentile(latencies, 0.5) * 1000, 3),
+            "latency-p99-ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "peak-allocated-bytes-per-request": peak_allocated_bytes
+        }
+
+    def test_benchmark(self):
+
+        results = {
+            "commit": current_commit(),
+            "python": sys.version.split()[0],
+            "iterations": benchmark_iterations,
+            "scenarios": {}
+        }
+
+        for each_name, each_handler_state, each_event in benchmark_scenarios:
+            results["scenarios"][each_name] = self.run_scenario(each_handler_state, each_event)
+
+        output_path = os.environ.get("BENCHMARK_OUTPUT") or os.path.join(
+            repo_dir,
+            "build",
+            "benchmarks",
+            "{}-{}.json".format(self.function_name, results["commit"])
+        )
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(output_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)))
+
+        with open(output_path, "w") as f:
+            f.write(json.dumps(results, indent=4, sort_keys=True))
+
+        print(json.dumps(results, indent=4, sort_keys=True))
+        print("Results written to {}.".format(output_path))
+
+        baseline_path = os.environ.get("BENCHMARK_BASELINE")
+
+        if baseline_path:
+            with open(baseline_path) as f:
+                baseline_results = json.loads(f.read())
+
+            print("Compared with {} ({}):".format(baseline_path, baseline_results.get("commit")))
+
+            for each_name, each_result in sorted(results["scenarios"].items()):
+                each_baseline = baseline_results["scenarios"].get(each_name)
+
+                if each_baseline is None:
+                    continue
+
+                print(" > {}: {:+.1%} requests/sec, {:+.1%} p99 latency".format(
+                    each_name,
+                    each_result["requests-per-second"] / each_baseline["requests-per-second"] - 1,
+                    each_result["latency-p99-ms"] / each_baseline["latency-p99-ms"] - 1
+                ))
+
+if __name__ == "__main__":
+    unittest.main()
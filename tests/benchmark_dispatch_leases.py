@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+'''
+    Scale test of lease-based dispatch: BENCHMARK_WORKER_COUNT dispatchers
+    share one queue in local storage and a lease store on this machine, in real
+    time. A third of the way in, one of them is killed; half way in, another
+    joins. Reports how many pointers were fired twice or not at all, and how
+    late they were fired.
+
+    Invokes are stubbed with a line appended to a file. Like the tests, this
+    runs against the build directory:
+
+    $ python deploy.py --build-lambda-functions-only
+    $ cd tests && python benchmark_dispatch_leases.py
+'''
+
+from __future__ import print_function
+
+import os, sys, json, time, random, shutil, tempfile, multiprocessing
+
+from benchmark_InvocationQueuerFunction import stdout_discarded
+
+benchmark_worker_count = int(os.environ.get("BENCHMARK_WORKER_COUNT", 4))
+benchmark_pointer_count = int(os.environ.get("BENCHMARK_POINTER_COUNT", 2000))
+benchmark_run_seconds = int(os.environ.get("BENCHMARK_RUN_SECONDS", 40))
+benchmark_lease_seconds = int(os.environ.get("BENCHMARK_LEASE_SECONDS", 6))
+benchmark_lease_store_type = os.environ.get("BENCHMARK_LEASE_STORE", "sqlite")
+
+function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+class LongRunningContext(object):
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+def import_dispatcher(storage_dir):
+
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["LOCAL_STORAGE_DIR"] = storage_dir
+    os.environ["SHARED_BUCKET"] = "lambda-scheduler-benchmark"
+
+    build_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../build")
+
+    for each_path in [build_dir, os.path.join(build_dir, "InvocationDispatcherFunction")]:
+        if each_path not in sys.path:
+            sys.path.append(each_path)
+
+    from InvocationDispatcherFunction import index
+
+    return index
+
+def run_worker(storage_dir, lease_store_spec, run_seconds, fired_path):
+
+    lambda_function = import_dispatcher(storage_dir)
+
+    lambda_function.dispatch_lease_store = lease_store_spec
+    lambda_function.dispatch_lease_seconds = benchmark_lease_seconds
+    lambda_function.dispatch_run_seconds = run_seconds
+    lambda_function.dispatch_legacy_layout = False
+
+    fired_file = open(fired_path, "a")
+
+    def invoke_record(s3_pointer_content):
+        fired_time = time.time()
+
+        # Short appends to a file opened for appending don't interleave.
+        fired_file.write("{} {}\n".format(s3_pointer_content["payload"]["pointer-id"], fired_time))
+        fired_file.flush()
+
+        return fired_time
+
+    handler_object = lambda_function.LambdaHandler(None)
+    handler_object.invoke_record = invoke_record
+
+    with stdout_discarded():
+        try:
+            with lambda_function.ThreadPoolExecutor(max_workers=lambda_function.dispatch_max_workers) as executor:
+                handler_object.run_timing_wheel(executor, lambda_function.DispatchStats(), LongRunningContext(), time.time())
+        finally:
+            handler_object.release_leases()
+
+def write_pointers(lambda_function, started):
+
+    keys = lambda_function.keys
+    records = lambda_function.records
+    storage_backend = lambda_function.storage.LocalStorageBackend(os.environ["LOCAL_STORAGE_DIR"])
+
+    random_offsets = random.Random(0)
+    due_epochs = {}
+
+    # Due while the workers run, leaving time at the end for a dead worker's leases to run out.
+    for i in range(benchmark_pointer_count):
+        pointer_id = "{}".format(i)
+        due_epochs[pointer_id] = int(started) + random_offsets.randint(2, benchmark_run_seconds - benchmark_lease_seconds * 2)
+
+        pointer_key, index_marker_key = keys.pointer_key(
+            keys.epoch_to_datetime_string(due_epochs[pointer_id]),
+            pointer_id,
+            lambda_function.queue_shard_count,
+            now = started
+        )
+
+        storage_backend.put_object(pointer_key, records.encode_pointer_record({
+            "function-arn": function_arn,
+            "payload": {"pointer-id": pointer_id}
+        }))
+        storage_backend.put_object(index_marker_key, b"")
+
+    return due_epochs
+
+def benchmark():
+
+    root_dir = tempfile.mkdtemp()
+    storage_dir = os.path.join(root_dir, "storage")
+    fired_path = os.path.join(root_dir, "fired.txt")
+    lease_store_spec = "{}:{}".format(benchmark_lease_store_type, os.path.join(root_dir, "leases"))
+
+    os.makedirs(storage_dir)
+
+    try:
+        lambda_function = import_dispatcher(storage_dir)
+
+        started = time.time()
+        due_epochs = write_pointers(lambda_function, started)
+
+        def start_worker(run_seconds):
+            worker = multiprocessing.Process(target=run_worker, args=(storage_dir, lease_store_spec, run_seconds, fired_path))
+            worker.start()
+            return worker
+
+        workers = list(start_worker(benchmark_run_seconds) for i in range(benchmark_worker_count))
+
+        time.sleep(max(0, started + benchmark_run_seconds / 3.0 - time.time()))
+        workers[0].terminate()
+
+        time.sleep(max(0, started + benchmark_run_seconds / 2.0 - time.time()))
+        workers.append(start_worker(int(started + benchmark_run_seconds - time.time())))
+
+        for each_worker in workers:
+            each_worker.join()
+
+        fired_times = {}
+
+        with open(fired_path) as fired_file:
+            for each_line in fired_file:
+                each_pointer_id, each_fired_time = each_line.split()
+                fired_times.setdefault(each_pointer_id, []).append(float(each_fired_time))
+
+        lags = list(min(y) - due_epochs[x] for x, y in fired_times.items())
+
+        return {
+            "workers": benchmark_worker_count,
+            "lease-store": benchmark_lease_store_type,
+            "lease-seconds": benchmark_lease_seconds,
+            "pointers": benchmark_pointer_count,
+            "fired-count": len(fired_times),
+            "fired-twice-count": sum(1 for x in fired_times.values() if len(x) > 1),
+            "missing-count": len(set(due_epochs.keys()) - set(fired_times.keys())),
+            "dispatch-lag-seconds": lambda_function.summarize_seconds(lags)
+        }
+    finally:
+        shutil.rmtree(root_dir)
+
+if __name__ == "__main__":
+    print(json.dumps(benchmark(), indent=4, sort_keys=True))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''
+    Compares the original pointer record format (indented JSON) with the
+    versioned record format, for size and encode / decode time.
+
+    $ python tests/benchmark_record_format.py
+'''
+
+from __future__ import print_function
+
+import os, sys, json, timeit, uuid, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "../lambda/shared"))
+
+from lambda_scheduler import records
+
+def sample_pointer_record(payload_size_bytes):
+    return {
+        "function-arn": "arn:aws:lambda:us-east-1:000000000000:function:lambda-scheduler-default-ScheduledFunction-S1Q633SVQCLY",
+        "payload": {
+            "user-id": "{}".format(uuid.uuid4()),
+            "recipients": list({"id": "{}".format(uuid.uuid4()), "notified": False} for i in range(payload_size_bytes // 56))
+        },
+        "aws-request-id": "{}".format(uuid.uuid4()),
+        "queued-function": "lambda-scheduler-default-InvocationQueuerFunction-S1Q633SVQCLY",
+        "queued-timestamp": 1476316800,
+        "queued-log-group": "/aws/lambda/lambda-scheduler-default-InvocationQueuerFunction-S1Q633SVQCLY",
+        "queued-log-stream": "{}/[$LATEST]{}".format(datetime.datetime.utcnow().strftime("%Y/%m/%d"), uuid.uuid4().hex)
+    }
+
+def benchmark(payload_size_bytes, iterations):
+
+    record = sample_pointer_record(payload_size_bytes)
+
+    original_body = json.dumps(record, indent=4).encode("utf-8")
+    versioned_body = records.encode_pointer_record(record)
+
+    def seconds_per_call(f):
+        return min(timeit.repeat(f, number=iterations, repeat=3)) / iterations
+
+    return {
+        "payload-bytes": payload_size_bytes,
+        "original-bytes": len(original_body),
+        "versioned-bytes": len(versioned_body),
+        "original-encode-us": seconds_per_call(lambda: json.dumps(record, indent=4).encode("utf-8")) * 1e6,
+        "versioned-encode-us": seconds_per_call(lambda: records.encode_pointer_record(record)) * 1e6,
+        "original-decode-us": seconds_per_call(lambda: json.loads(original_body.decode("utf-8"))) * 1e6,
+        "versioned-decode-us": seconds_per_call(lambda: records.decode_pointer_record(versioned_body)) * 1e6
+    }
+
+if __name__ == "__main__":
+
+    results = []
+
+    for each_payload_size, each_iterations in [(16, 20000), (1024, 10000), (16 * 1024, 2000), (200 * 1024, 200)]:
+        results.append(benchmark(each_payload_size, each_iterations))
+
+    print(json.dumps(results, indent=4))
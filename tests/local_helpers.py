@@ -14,7 +14,8 @@ def create_boto3_client_with_stubber(*args, **kwargs):
     import boto3
     from botocore.stub import Stubber
     
-    new_client = boto3.client(*args, **kwargs)
+    # boto3.client itself is replaced by this function during tests.
+    new_client = boto3.session.Session().client(*args, **kwargs)
     
     service_name = args[0]
     
@@ -55,8 +56,14 @@ class LambdaFunctionTestCase(unittest.TestCase):
         
         self.lambda_function = lambda_function_module
         
-        if hasattr(self.lambda_function, "boto3"):
-            self.lambda_function.boto3.client = create_boto3_client_with_stubber
+        # Patched on the module itself, since functions may import boto3 lazily.
+        import boto3
+        boto3.client = create_boto3_client_with_stubber
+        
+        # Functions cache their clients at module level, which would otherwise 
+        # leak stubbed clients from one test into the next.
+        if hasattr(self.lambda_function, "boto3_clients"):
+            self.lambda_function.boto3_clients.clear()
     
     def tearDown(self):
         for each_path in self.added_module_paths:
@@ -84,7 +91,7 @@ class LambdaContext(object):
         )
         self.memory_limit_in_mb = 128
     
-    def get_remaining_time_millis():
+    def get_remaining_time_in_millis(self):
         return 9999
     
     def log():
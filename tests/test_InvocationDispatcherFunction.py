@@ -0,0 +1,1013 @@
+from __future__ import print_function
+
+import sys, os, io, json, time, unittest, datetime, tempfile, shutil
+from botocore.response import StreamingBody
+from local_helpers import LambdaFunctionTestCase, generate_lambda_context
+
+class Test(LambdaFunctionTestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(Test, self).__init__(*args, **kwargs)
+        self.function_name = "InvocationDispatcherFunction"
+
+    def setUp(self):
+        super(Test, self).setUp()
+        os.environ["SHARED_BUCKET"] = "lambda-scheduler-default-sharedbucket-ch7n9ibykc7g"
+
+    def tearDown(self):
+        del os.environ["SHARED_BUCKET"]
+        super(Test, self).tearDown()
+
+    def test_warming(self):
+
+        sample_event = {
+            "warming": True
+        }
+
+        response = self.lambda_function.lambda_handler(
+            sample_event,
+            generate_lambda_context()
+        )
+
+        assert len(response.keys()) == 1
+        assert "message" in response
+        assert response["message"] == "Function warmed successfully."
+
+    def test_pointer_keys(self):
+
+        keys = self.lambda_function.keys
+
+        pointer_key, index_marker_key = keys.pointer_key(
+            "2016-10-13T00:00:30Z",
+            "c084c3d0-90dc-11e6-ac13-99ca095ca6aa",
+            16,
+            now=1476316800
+        )
+
+        shard = keys.shard_for_pointer_id("c084c3d0-90dc-11e6-ac13-99ca095ca6aa", 16)
+
+        assert pointer_key == "queued/{}/2016-10-13T00:00Z/2016-10-13T00:00:30Z/c084c3d0-90dc-11e6-ac13-99ca095ca6aa.json".format(shard)
+        assert index_marker_key == "index/2016-10-13T00:00Z/{}".format(shard)
+
+        pointer_key_info = keys.parse_pointer_key(pointer_key)
+        assert pointer_key_info["execution-epoch"] == 1476316830
+        assert pointer_key_info["pointer-id"] == "c084c3d0-90dc-11e6-ac13-99ca095ca6aa"
+
+        legacy_pointer_key_info = keys.parse_pointer_key("queued/2016-10-13T00:00:00Z/c084c3d0-90dc-11e6-ac13-99ca095ca6aa.json")
+        assert legacy_pointer_key_info["execution-epoch"] == 1476316800
+        assert legacy_pointer_key_info["shard"] is None
+
+        # Past-due pointers are clamped into a bucket that's still open.
+        late_pointer_key, late_index_marker_key = keys.pointer_key(
+            "2016-10-13T00:00:30Z",
+            "c084c3d0-90dc-11e6-ac13-99ca095ca6aa",
+            16,
+            now=1476317100
+        )
+
+        assert late_index_marker_key == "index/2016-10-13T00:04Z/{}".format(shard)
+        assert keys.parse_pointer_key(late_pointer_key)["execution-epoch"] == 1476316830
+        assert not keys.is_bucket_closed("2016-10-13T00:04Z", now=1476317100)
+        assert keys.is_bucket_closed("2016-10-13T00:00Z", now=1476317100)
+
+    def test_dispatch_due_invocations(self):
+
+        s3_bucket_name = os.environ["SHARED_BUCKET"]
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        pointer_key = "queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/c084c3d0-90dc-11e6-ac13-99ca095ca6aa.json"
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {
+                "CommonPrefixes": [
+                    {"Prefix": "index/2016-10-13T00:00Z/"},
+                    {"Prefix": "index/2016-10-13T00:01Z/"}
+                ]
+            },
+            {
+                "Bucket": s3_bucket_name,
+                "Prefix": "index/",
+                "Delimiter": "/"
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {
+                "Contents": [
+                    {"Key": "index/2016-10-13T00:00Z/0a"}
+                ]
+            },
+            {
+                "Bucket": s3_bucket_name,
+                "Prefix": "index/2016-10-13T00:00Z/"
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {
+                "Contents": [
+                    {"Key": pointer_key},
+                    {"Key": "queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:59Z/not-yet-due.json"}
+                ]
+            },
+            {
+                "Bucket": s3_bucket_name,
+                "Prefix": "queued/0a/2016-10-13T00:00Z/"
+            }
+        )
+
+        pointer_content = json.dumps({
+            "function-arn": function_arn,
+            "payload": {"hello": "world"}
+        }).encode("utf-8")
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "get_object",
+            {
+                "Body": StreamingBody(io.BytesIO(pointer_content), len(pointer_content))
+            },
+            {
+                "Bucket": s3_bucket_name,
+                "Key": pointer_key
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "copy_object",
+            {},
+            {
+                "Bucket": s3_bucket_name,
+                "Key": "dispatched/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/c084c3d0-90dc-11e6-ac13-99ca095ca6aa.json",
+                "CopySource": {
+                    "Bucket": s3_bucket_name,
+                    "Key": pointer_key
+                }
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "delete_object",
+            {},
+            {
+                "Bucket": s3_bucket_name,
+                "Key": pointer_key
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "invoke",
+            {
+                "StatusCode": 202
+            },
+            {
+                "FunctionName": function_arn,
+                "InvocationType": "Event",
+                "Payload": json.dumps({"hello": "world"})
+            }
+        )
+
+        self.lambda_function.dispatch_legacy_layout = False
+
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        stats = self.lambda_function.DispatchStats()
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            dispatched_count = handler_object.dispatch_due_invocations(executor, stats, now=1476316801)
+
+        self.lambda_function.dispatch_legacy_layout = True
+
+        summary = stats.summary()
+
+        assert dispatched_count == 1
+        assert summary["dispatched-count"] == 1
+        assert summary["failed-count"] == 0
+        assert summary["dispatch-lag-seconds"]["max"] > 0
+
+    def test_dispatch_due_segment(self):
+
+        s3_bucket_name = os.environ["SHARED_BUCKET"]
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        segment_key = "queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/5f3e1c9a-90dc-11e6-ac13-99ca095ca6aa.seg"
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {
+                "CommonPrefixes": [
+                    {"Prefix": "index/2016-10-13T00:00Z/"}
+                ]
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {
+                "Contents": [
+                    {"Key": "index/2016-10-13T00:00Z/0a"}
+                ]
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {
+                "Contents": [
+                    {"Key": segment_key}
+                ]
+            }
+        )
+
+        segment_body = self.lambda_function.segments.encode_segment([
+            {
+                "function-arn": function_arn,
+                "payload": {"index": 0},
+                "execution-time": "2016-10-13T00:00:00Z",
+                "pointer-id": "0"
+            },
+            {
+                "function-arn": function_arn,
+                "payload": {"index": 1},
+                "execution-time": "2016-10-13T00:00:30Z",
+                "pointer-id": "1"
+            }
+        ])
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "get_object",
+            {
+                "Body": StreamingBody(io.BytesIO(segment_body), len(segment_body))
+            },
+            {
+                "Bucket": s3_bucket_name,
+                "Key": segment_key
+            }
+        )
+
+        # No records in that minute's segments have been cancelled.
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "list_objects_v2",
+            {},
+            {
+                "Bucket": s3_bucket_name,
+                "Prefix": "cancellations/2016-10-13T00:00Z/"
+            }
+        )
+
+        # The record that isn't due yet goes back as a new segment, then the fired one is archived.
+        for i in range(2):
+            self.setup_boto3_stubber(
+                "s3",
+                "add_response",
+                "put_object",
+                {}
+            )
+
+        self.setup_boto3_stubber(
+            "s3",
+            "add_response",
+            "delete_object",
+            {},
+            {
+                "Bucket": s3_bucket_name,
+                "Key": segment_key
+            }
+        )
+
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "invoke",
+            {
+                "StatusCode": 202
+            },
+            {
+                "FunctionName": function_arn,
+                "InvocationType": "Event",
+                "Payload": json.dumps({"index": 0})
+            }
+        )
+
+        self.lambda_function.dispatch_legacy_layout = False
+
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        stats = self.lambda_function.DispatchStats()
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            dispatched_count = handler_object.dispatch_due_invocations(executor, stats, now=1476316801)
+
+        self.lambda_function.dispatch_legacy_layout = True
+
+        assert dispatched_count == 1
+        assert stats.summary()["dispatched-count"] == 1
+
+    def test_local_storage_backend(self):
+
+        storage = self.lambda_function.storage
+
+        root_dir = tempfile.mkdtemp()
+
+        try:
+            local_storage = storage.LocalStorageBackend(root_dir)
+
+            local_storage.put_object("index/2016-10-13T00:01Z/0b", b"")
+            local_storage.put_object("index/2016-10-13T00:00Z/0a", b"")
+            local_storage.put_object("queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:01Z/b.json", b"second")
+            local_storage.put_object("queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/a.json", b"first")
+
+            assert list(local_storage.list_prefixes("index/")) == ["index/2016-10-13T00:00Z/", "index/2016-10-13T00:01Z/"]
+            assert list(local_storage.list_keys("queued/0a/2016-10-13T00:00Z/")) == [
+                "queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/a.json",
+                "queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:01Z/b.json"
+            ]
+            assert local_storage.get_object("queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/a.json") == b"first"
+
+            local_storage.move_object(
+                "queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/a.json",
+                "dispatched/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/a.json"
+            )
+            local_storage.delete_objects(["index/2016-10-13T00:01Z/0b"])
+
+            # Emptied directories are pruned, so they don't show up as prefixes.
+            assert list(local_storage.list_prefixes("index/")) == ["index/2016-10-13T00:00Z/"]
+            assert list(local_storage.list_keys("queued/")) == ["queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:01Z/b.json"]
+            assert list(local_storage.list_keys("dispatched/")) == ["dispatched/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/a.json"]
+        finally:
+            shutil.rmtree(root_dir)
+
+    def test_dispatch_due_invocations_local_storage(self):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+
+            for i, each_execution_time in enumerate(["2016-10-13T00:00:00Z", "2016-10-13T00:00:30Z"]):
+                pointer_key, index_marker_key = keys.pointer_key(each_execution_time, "{}".format(i), 4, now=1476316800)
+
+                local_storage.put_object(pointer_key, records.encode_pointer_record({
+                    "function-arn": function_arn,
+                    "payload": {"index": i}
+                }))
+                local_storage.put_object(index_marker_key, b"")
+
+            self.setup_boto3_stubber(
+                "lambda",
+                "add_response",
+                "invoke",
+                {
+                    "StatusCode": 202
+                },
+                {
+                    "FunctionName": function_arn,
+                    "InvocationType": "Event",
+                    "Payload": json.dumps({"index": 0})
+                }
+            )
+
+            self.lambda_function.dispatch_legacy_layout = False
+
+            stats = self.lambda_function.DispatchStats()
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                dispatched_count = handler_object.dispatch_due_invocations(executor, stats, now=1476316801)
+
+            assert dispatched_count == 1
+            assert len(list(local_storage.list_keys("queued/"))) == 1
+            assert len(list(local_storage.list_keys("dispatched/"))) == 1
+        finally:
+            self.lambda_function.dispatch_legacy_layout = True
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+
+    def test_payload_store(self):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+        payloads = self.lambda_function.payloads
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+
+            payload_store = payloads.PayloadStore(local_storage, 10)
+            payload = {"message": "x" * 100}
+
+            # The same payload for two pointers is stored once.
+            for each_pointer_id in ["a", "b"]:
+                pointer_key, index_marker_key = keys.pointer_key("2016-10-13T00:00:00Z", each_pointer_id, 1, now=1476316800)
+
+                local_storage.put_object(pointer_key, records.encode_pointer_record(payload_store.externalize({
+                    "function-arn": function_arn,
+                    "payload": payload
+                }, each_pointer_id)))
+                local_storage.put_object(index_marker_key, b"")
+
+            # Each referenced, and held while the queuer remembers storing it.
+            assert len(list(local_storage.list_keys(payloads.payload_prefix))) == 1
+            assert len(list(local_storage.list_keys(payloads.reference_prefix))) == 3
+
+            for i in range(2):
+                self.setup_boto3_stubber(
+                    "lambda",
+                    "add_response",
+                    "invoke",
+                    {
+                        "StatusCode": 202
+                    },
+                    {
+                        "FunctionName": function_arn,
+                        "InvocationType": "Event",
+                        "Payload": json.dumps(payload, separators=(",", ":")).encode("utf-8")
+                    }
+                )
+
+            self.lambda_function.dispatch_legacy_layout = False
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                dispatched_count = handler_object.dispatch_due_invocations(executor, self.lambda_function.DispatchStats(), now=1476316801)
+
+            assert dispatched_count == 2
+            assert len(list(local_storage.list_keys(payloads.reference_prefix))) == 1
+
+            # Kept through the grace period, then deleted.
+            payload_store = handler_object.get_payload_store()
+            assert payload_store.sweep(time.time()) == 0
+            assert len(list(local_storage.list_keys(payloads.payload_prefix))) == 1
+            assert payload_store.sweep(time.time() + 11 * 60) == 1
+            assert len(list(local_storage.list_keys(payloads.payload_prefix))) == 0
+
+            # The store's own hold is swept once it's passed too.
+            payload_store.sweep(time.time() + payload_store.stored_memo_seconds + 11 * 60)
+            assert len(list(local_storage.list_keys(payloads.release_prefix))) == 0
+
+            # Handed over by reference, a payload is held until its hold ends.
+            payload_store = payloads.PayloadStore(local_storage, 10)
+            record = payload_store.externalize({"function-arn": function_arn, "payload": payload}, "c")
+
+            self.lambda_function.invoke_payload_limit_bytes = 10
+
+            invoke_payload = json.loads(handler_object.get_invoke_payload(record))
+            assert invoke_payload["payload-location"]["key"] == payloads.payload_key(record["payload-ref"])
+
+            handler_object.release_payload(record, "c")
+
+            assert payload_store.sweep(time.time() + 11 * 60) == 0
+            # Deleted by whichever of its release markers comes first once nothing holds it.
+            assert payload_store.sweep(time.time() + self.lambda_function.payload_hold_seconds + 11 * 60) >= 1
+            assert len(list(local_storage.list_keys(payloads.payload_prefix))) == 0
+            assert len(list(local_storage.list_keys(payloads.reference_prefix))) == 0
+
+            # Stored again and released straight away, it outlasts an older release
+            # while the queuer that stored it may skip storing it again.
+            payload_store = payloads.PayloadStore(local_storage, 10)
+            record = payload_store.externalize({"function-arn": function_arn, "payload": payload}, "d")
+
+            local_storage.put_object(payloads.release_key(keys.epoch_to_minute_string(time.time() - 3600), record["payload-ref"]), b"")
+            payload_store.release(record["payload-ref"], "d")
+
+            assert payload_store.sweep(time.time()) == 0
+            assert len(list(local_storage.list_keys(payloads.payload_prefix))) == 1
+            assert payload_store.sweep(time.time() + 11 * 60) == 1
+        finally:
+            self.lambda_function.dispatch_legacy_layout = True
+            self.lambda_function.invoke_payload_limit_bytes = 256 * 1000
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+
+    def test_recurring_schedule_expansion(self):
+
+        recurrence = self.lambda_function.recurrence
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+
+            expander = recurrence.RecurrenceExpander(local_storage, 600, 1)
+
+            # Every minute from 00:00 until 00:30.
+            series = {
+                "schedule-id": "daily-report",
+                "version": 1,
+                "function-arn": function_arn,
+                "payload": {},
+                "schedule-expression": "rate(1 minute)",
+                "start-time": 1476316800,
+                "end-time": 1476318600,
+                "next-occurrence": 1476316800
+            }
+
+            assert expander.expand(series, now=1476316800) == 11
+            assert len(list(local_storage.list_keys("queued/"))) == 11
+
+            # Not due again until its written occurrences run low.
+            assert expander.expand_due(now=1476316800 + 60) == 0
+            assert expander.expand_due(now=1476316800 + 360) == 6
+            assert expander.expand_due(now=1476316800 + 1200) == 14
+            assert len(list(local_storage.list_keys("queued/"))) == 31
+            assert expander.load_series("daily-report")["next-occurrence"] is None
+
+            # Once updated, occurrences written for the old version are dropped.
+            series["version"] = 2
+            expander.save_series(series)
+
+            self.lambda_function.dispatch_legacy_layout = False
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                dispatched_count = handler_object.dispatch_due_invocations(executor, self.lambda_function.DispatchStats(), now=1476316800 + 90)
+
+            assert len(list(local_storage.list_keys("queued/"))) == 29
+            assert len(list(local_storage.list_keys("dispatched/"))) == 0
+        finally:
+            self.lambda_function.dispatch_legacy_layout = True
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+
+    def test_timing_wheel(self):
+
+        timing_wheel = self.lambda_function.timing_wheel
+
+        wheel = timing_wheel.TimingWheel(1476316810, 2)
+
+        assert wheel.horizon_epoch == 1476316800 + 3 * 60 - 1
+        assert wheel.add(1476316800, "past-due")
+        assert wheel.add(1476316812, "this-minute")
+        assert wheel.add(1476316875, "next-minute")
+        assert wheel.add(1476316875, "next-minute")
+        assert not wheel.add(1476316800 + 3 * 60, "past-horizon")
+        assert len(wheel) == 3
+
+        assert list(x.key for x in wheel.advance(1476316811)) == ["past-due"]
+        assert list(x.key for x in wheel.advance(1476316874)) == ["this-minute"]
+        assert list(x.key for x in wheel.advance(1476316875.5)) == ["next-minute"]
+        assert len(wheel) == 0
+
+        # The horizon moves with the wheel.
+        assert wheel.add(1476316800 + 3 * 60, "past-horizon")
+
+    def test_dispatch_timing_wheel(self):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+        original_dispatch_run_seconds = self.lambda_function.dispatch_run_seconds
+
+        class LongRunningContext(object):
+            def get_remaining_time_in_millis(self):
+                return 300000
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            handler_object.clock = self.lambda_function.timing_wheel.SimulatedClock(1476316810.5)
+            local_storage = handler_object.get_storage()
+
+            def write_pointer(execution_epoch, pointer_id):
+                pointer_key, index_marker_key = keys.pointer_key(keys.epoch_to_datetime_string(execution_epoch), pointer_id, 4, now=handler_object.clock.time())
+
+                local_storage.put_object(pointer_key, records.encode_pointer_record({
+                    "function-arn": function_arn,
+                    "payload": {"pointer-id": pointer_id}
+                }))
+                local_storage.put_object(index_marker_key, b"")
+
+            # This minute, the next (prefetched at the start), and one only within the horizon later on.
+            for each_offset in [12, 75, 200]:
+                write_pointer(1476316800 + each_offset, "{}".format(each_offset))
+
+            fired = {}
+
+            def invoke_record(s3_pointer_content):
+                pointer_id = s3_pointer_content["payload"]["pointer-id"]
+                fired[pointer_id] = handler_object.clock.time()
+
+                # Written after its minute was prefetched.
+                if pointer_id == "12":
+                    write_pointer(1476316800 + 20, "20")
+
+                return fired[pointer_id]
+
+            handler_object.invoke_record = invoke_record
+
+            self.lambda_function.dispatch_legacy_layout = False
+            self.lambda_function.dispatch_run_seconds = 240
+
+            stats = self.lambda_function.DispatchStats()
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                handler_object.run_timing_wheel(executor, stats, LongRunningContext(), handler_object.clock.time())
+
+            assert sorted(fired.keys()) == ["12", "20", "200", "75"]
+
+            for each_pointer_id, each_fired in fired.items():
+                assert 0 <= each_fired - (1476316800 + int(each_pointer_id)) < 1
+
+            assert stats.summary()["dispatch-lag-seconds"]["max"] < 1
+            assert len(list(local_storage.list_keys("queued/"))) == 0
+        finally:
+            self.lambda_function.dispatch_legacy_layout = True
+            self.lambda_function.dispatch_run_seconds = original_dispatch_run_seconds
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+
+    def test_dispatch_target_limits(self):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+        segments = self.lambda_function.segments
+        limited_function_arn = "arn:aws:lambda:us-east-1:000000000000:function:SendReminder"
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        throttled_function_arn = "arn:aws:lambda:us-east-1:000000000000:function:Throttled"
+
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            handler_object.clock = self.lambda_function.timing_wheel.SimulatedClock(1476316801)
+            local_storage = handler_object.get_storage()
+
+            # A burst for one target, all at the same second.
+            segment_key, index_marker_key = keys.segment_key("2016-10-13T00:00Z", "2016-10-13T00:00:00Z", "burst", 4)
+
+            local_storage.put_object(segment_key, segments.encode_segment(list({
+                "function-arn": limited_function_arn,
+                "payload": {"index": i},
+                "execution-time": "2016-10-13T00:00:00Z",
+                "pointer-id": "burst-{}".format(i),
+                "dispatch-limits": {"max-concurrency": 2, "rate-per-second": 10, "burst": 5}
+            } for i in range(30))))
+            local_storage.put_object(index_marker_key, b"")
+
+            for each_pointer_id, each_function_arn in [("0", function_arn), ("1", function_arn), ("2", throttled_function_arn)]:
+                pointer_key, index_marker_key = keys.pointer_key("2016-10-13T00:00:00Z", each_pointer_id, 4, now=1476316800)
+
+                local_storage.put_object(pointer_key, records.encode_pointer_record({
+                    "function-arn": each_function_arn,
+                    "payload": {}
+                }))
+                local_storage.put_object(index_marker_key, b"")
+
+            in_flight = {}
+            max_in_flight = {}
+            in_flight_lock = self.lambda_function.threading.Lock()
+
+            def invoke_record(s3_pointer_content):
+                each_function_arn = s3_pointer_content["function-arn"]
+
+                if each_function_arn == throttled_function_arn:
+                    raise self.lambda_function.botocore.exceptions.ClientError({"Error": {"Code": "TooManyRequestsException"}}, "Invoke")
+
+                with in_flight_lock:
+                    in_flight[each_function_arn] = in_flight.get(each_function_arn, 0) + 1
+                    max_in_flight[each_function_arn] = max(max_in_flight.get(each_function_arn, 0), in_flight[each_function_arn])
+
+                time.sleep(0.01)
+
+                with in_flight_lock:
+                    in_flight[each_function_arn] -= 1
+
+                return handler_object.clock.time()
+
+            handler_object.invoke_record = invoke_record
+
+            self.lambda_function.dispatch_legacy_layout = False
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            stats = self.lambda_function.DispatchStats()
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                handler_object.dispatch_due_invocations(executor, stats)
+
+            target_summaries = stats.summary()["targets"]
+
+            # The burst of 5, then 10 a second for the tick's second of waiting.
+            assert max_in_flight[limited_function_arn] <= 2
+            assert 14 <= target_summaries[limited_function_arn]["invoked-count"] <= 16
+            assert target_summaries[limited_function_arn]["invoked-count"] + target_summaries[limited_function_arn]["deferred-count"] == 30
+            assert target_summaries[limited_function_arn]["queue-seconds"]["max"] <= self.lambda_function.dispatch_limit_wait_seconds
+
+            assert target_summaries[function_arn]["invoked-count"] == 2
+            assert target_summaries[throttled_function_arn]["throttled-count"] == 1
+
+            # What's left of the burst is written back, and the throttled pointer left for the next tick.
+            remaining_segment_keys = list(x for x in local_storage.list_keys("queued/") if keys.is_segment_key(x))
+            assert len(remaining_segment_keys) == 1
+            assert len(list(segments.iter_segment_records(local_storage.open_object(remaining_segment_keys[0])))) - 1 == target_summaries[limited_function_arn]["deferred-count"]
+            assert len(handler_object.deferred_pointer_contents) == 1
+
+            stats = self.lambda_function.DispatchStats()
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for each_tick in range(3):
+                    handler_object.clock.advance(1)
+                    handler_object.dispatch_due_invocations(executor, stats)
+
+            assert stats.summary()["targets"][limited_function_arn]["invoked-count"] == 30 - target_summaries[limited_function_arn]["invoked-count"]
+
+            # Backed off, but kept rather than failed.
+            assert stats.summary()["targets"][throttled_function_arn]["throttled-count"] >= 1
+            assert stats.failed_count == 0
+            assert len(list(local_storage.list_keys("queued/"))) == 1
+        finally:
+            self.lambda_function.dispatch_legacy_layout = True
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+
+    def test_dispatch_leases(self):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+        segments = self.lambda_function.segments
+        leases = self.lambda_function.leases
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+        original_settings = (self.lambda_function.dispatch_lease_store, self.lambda_function.queue_shard_count)
+
+        for each_store_type in ["sqlite", "file"]:
+            root_dir = tempfile.mkdtemp()
+            os.environ["STORAGE_BACKEND"] = "local"
+            os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+            try:
+                self.lambda_function.dispatch_lease_store = "{}:{}".format(each_store_type, os.path.join(root_dir, "leases"))
+                self.lambda_function.queue_shard_count = 4
+                self.lambda_function.dispatch_legacy_layout = False
+
+                clock = self.lambda_function.timing_wheel.SimulatedClock(1476316801)
+                fired = []
+
+                def create_handler():
+                    handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+                    handler_object.clock = clock
+                    handler_object.invoke_record = lambda s3_pointer_content: fired.append(s3_pointer_content["payload"]["pointer-id"]) or clock.time()
+                    return handler_object
+
+                handler_a = create_handler()
+                handler_b = create_handler()
+                local_storage = handler_a.get_storage()
+
+                def write_pointers(pointer_ids):
+                    for each_pointer_id in pointer_ids:
+                        pointer_key, index_marker_key = keys.pointer_key(keys.epoch_to_datetime_string(int(clock.time())), each_pointer_id, 4, now=clock.time())
+
+                        local_storage.put_object(pointer_key, records.encode_pointer_record({
+                            "function-arn": function_arn,
+                            "payload": {"pointer-id": each_pointer_id}
+                        }))
+                        local_storage.put_object(index_marker_key, b"")
+
+                # The first worker takes every partition, then gives half up to the second.
+                assert handler_a.maintain_leases()
+                assert handler_a.owned_partitions == ["00", "01", "02", "03"]
+
+                handler_b.maintain_leases()
+                handler_a.maintain_leases()
+                handler_b.maintain_leases()
+
+                assert len(handler_a.owned_partitions) == 2
+                assert sorted(handler_a.owned_partitions + handler_b.owned_partitions) == ["00", "01", "02", "03"]
+
+                pointer_ids = list("{}".format(i) for i in range(40))
+                write_pointers(pointer_ids)
+
+                segment_key, index_marker_key = keys.segment_key(keys.epoch_to_minute_string(clock.time()), keys.epoch_to_datetime_string(int(clock.time())), "batch", 4)
+                local_storage.put_object(segment_key, segments.encode_segment(list({
+                    "function-arn": function_arn,
+                    "payload": {"pointer-id": "batch-{}".format(i)},
+                    "execution-time": keys.epoch_to_datetime_string(int(clock.time())),
+                    "pointer-id": "batch-{}".format(i)
+                } for i in range(5))))
+                local_storage.put_object(index_marker_key, b"")
+
+                from concurrent.futures import ThreadPoolExecutor
+
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    for each_handler in [handler_a, handler_b, handler_a, handler_b]:
+                        each_handler.dispatch_due_invocations(executor, self.lambda_function.DispatchStats())
+
+                    # Each pointer fired once, by whichever worker holds its partition.
+                    assert sorted(fired) == sorted(pointer_ids + list("batch-{}".format(i) for i in range(5)))
+                    assert len(list(local_storage.list_keys("queued/"))) == 0
+
+                    # The first worker stalls, and its leases run out.
+                    stale_lease = handler_a.get_lease_manager().lease_for(handler_a.owned_partitions[0], clock.time())
+
+                    clock.advance(self.lambda_function.dispatch_lease_seconds + 1)
+                    handler_b.maintain_leases()
+
+                    assert handler_b.owned_partitions == ["00", "01", "02", "03"]
+
+                    # It can no longer claim anything, even with a lease it still thinks it has.
+                    self.assertRaises(leases.LeaseLostError, handler_a.get_lease_manager().lease_store.claim, stale_lease, ["stale"], clock.time())
+
+                    del fired[:]
+                    write_pointers(["40", "41", "42", "43"])
+
+                    # Claimed by the worker before, which crashed before moving it.
+                    pointer_key = keys.pointer_key(keys.epoch_to_datetime_string(int(clock.time())), "44", 4, now=clock.time())[0]
+                    write_pointers(["44"])
+                    handler_b.get_lease_manager().claim(keys.parse_pointer_key(pointer_key)["shard"], ["44"], clock.time())
+
+                    handler_a.dispatch_due_invocations(executor, self.lambda_function.DispatchStats())
+                    assert fired == []
+
+                    stats = self.lambda_function.DispatchStats()
+                    handler_b.dispatch_due_invocations(executor, stats)
+
+                    assert sorted(fired) == ["40", "41", "42", "43"]
+                    assert stats.dispatched_count == 4
+                    assert len(list(local_storage.list_keys("queued/"))) == 0
+                    assert len(list(local_storage.list_keys("dispatched/"))) == 45 + 1
+
+                handler_b.release_leases()
+                assert handler_b.get_lease_manager().lease_store.list_leases(clock.time()) == []
+            finally:
+                self.lambda_function.dispatch_lease_store, self.lambda_function.queue_shard_count = original_settings
+                self.lambda_function.dispatch_legacy_layout = True
+                del os.environ["STORAGE_BACKEND"]
+                del os.environ["LOCAL_STORAGE_DIR"]
+                shutil.rmtree(root_dir)
+
+    def test_dispatch_catch_up(self):
+
+        keys = self.lambda_function.keys
+        records = self.lambda_function.records
+        segments = self.lambda_function.segments
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+
+        original_catch_up_max_workers = self.lambda_function.dispatch_catch_up_max_workers
+
+        # Back an hour after dispatch stopped.
+        outage_epoch = 1476316800
+        now_epoch = outage_epoch + 3600 + 30
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            handler_object.clock = self.lambda_function.timing_wheel.SimulatedClock(now_epoch)
+            local_storage = handler_object.get_storage()
+
+            def write_pointer(execution_epoch, pointer_id, **pointer_fields):
+                pointer_key, index_marker_key = keys.pointer_key(keys.epoch_to_datetime_string(execution_epoch), pointer_id, 4, now=execution_epoch)
+
+                pointer_content = {
+                    "function-arn": function_arn,
+                    "payload": {"pointer-id": pointer_id}
+                }
+                pointer_content.update(pointer_fields)
+
+                local_storage.put_object(pointer_key, records.encode_pointer_record(pointer_content))
+                local_storage.put_object(index_marker_key, b"")
+
+            # Written newest first, so they're only dispatched oldest first if they're sorted.
+            overdue_pointer_ids = list("overdue-{:02d}".format(i) for i in range(30))
+
+            for i in reversed(range(30)):
+                write_pointer(outage_epoch + i * 100, overdue_pointer_ids[i])
+
+            write_pointer(outage_epoch + 5, "stale", **{"max-staleness-seconds": 600})
+
+            segment_key, index_marker_key = keys.segment_key(keys.epoch_to_minute_string(outage_epoch + 1800), keys.epoch_to_datetime_string(outage_epoch + 1800), "batch", 4)
+            local_storage.put_object(segment_key, segments.encode_segment([
+                {"function-arn": function_arn, "payload": {"pointer-id": "batch-0"}, "execution-time": keys.epoch_to_datetime_string(outage_epoch + 1800), "pointer-id": "batch-0"},
+                {"function-arn": function_arn, "payload": {"pointer-id": "batch-1"}, "execution-time": keys.epoch_to_datetime_string(outage_epoch + 1800), "pointer-id": "batch-1", "max-staleness-seconds": 60}
+            ]))
+            local_storage.put_object(index_marker_key, b"")
+
+            schedule_index = self.lambda_function.schedule_index
+            schedule_index.ScheduleIndex(local_storage).put_segment_locations("batch", {0: keys.epoch_to_minute_string(outage_epoch + 1800)})
+
+            for each_offset in [1, 2, 3]:
+                write_pointer(now_epoch + each_offset, "on-time-{}".format(each_offset))
+
+            fired = []
+
+            def invoke_record(s3_pointer_content):
+                fired.append((s3_pointer_content["payload"]["pointer-id"], handler_object.clock.time()))
+                return handler_object.clock.time()
+
+            handler_object.invoke_record = invoke_record
+
+            self.lambda_function.dispatch_legacy_layout = False
+            self.lambda_function.dispatch_catch_up_max_workers = 4
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            stats = self.lambda_function.DispatchStats()
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+
+                # Overdue pointers are left to catch-up, a batch at a time.
+                handler_object.dispatch_due_invocations(executor, stats)
+                assert fired == []
+
+                handler_object.catch_up(executor, stats, handler_object.clock.time())
+                # The stale pointer is among the oldest, but set aside rather than fired.
+                assert list(x[0] for x in fired) == overdue_pointer_ids[:3]
+                assert stats.stale_count == 1
+
+                assert stats.catch_up["drained-count"] == 4
+                assert stats.catch_up["overdue-count"] > 0
+                assert stats.catch_up["estimated-drain-seconds"] is not None
+
+                for each_tick in range(30):
+                    handler_object.clock.advance(1 - (handler_object.clock.time() % 1))
+
+                    tick_started = handler_object.clock.time()
+                    handler_object.dispatch_due_invocations(executor, stats)
+                    handler_object.catch_up(executor, stats, int(tick_started) + self.lambda_function.dispatch_catch_up_tick_seconds)
+
+            fired_times = dict(fired)
+
+            # Each fired once, on-time ones on their second despite the backlog.
+            assert len(fired) == len(fired_times)
+            assert sorted(fired_times.keys()) == sorted(overdue_pointer_ids + ["batch-0", "on-time-1", "on-time-2", "on-time-3"])
+
+            for each_offset in [1, 2, 3]:
+                assert fired_times["on-time-{}".format(each_offset)] - (now_epoch + each_offset) < 1
+
+            overdue_fired_order = list(x[0] for x in fired if x[0].startswith("overdue-"))
+            assert overdue_fired_order == overdue_pointer_ids
+
+            # Too late to be wanted, so set aside.
+            assert stats.stale_count == 2
+            assert len(list(local_storage.list_keys("failed/"))) == 2
+            assert len(list(local_storage.list_keys("queued/"))) == 0
+
+            assert handler_object.catch_up_progress is None
+            assert len(list(local_storage.list_keys(schedule_index.index_prefix))) == 0
+            assert all(x >= "index/{}".format(keys.epoch_to_minute_string(now_epoch - 180)) for x in local_storage.list_keys("index/"))
+        finally:
+            self.lambda_function.dispatch_legacy_layout = True
+            self.lambda_function.dispatch_catch_up_max_workers = original_catch_up_max_workers
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
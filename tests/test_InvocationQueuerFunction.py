@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-import sys, os, json, unittest, datetime
+import sys, os, io, json, time, shutil, tempfile, unittest, datetime
 from local_helpers import LambdaFunctionTestCase, generate_lambda_context
 
 class Test(LambdaFunctionTestCase):
@@ -134,4 +134,898 @@ class Test(LambdaFunctionTestCase):
         handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
         response = handler_object.get_own_cloudformation_metadata()
         
-        assert response == cloudformation_metadata_object
\ No newline at end of file
+        assert response == cloudformation_metadata_object
+    
+    def test_batch_invocations(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_client_error",
+            "get_function",
+            service_error_code = "ResourceNotFoundException",
+            http_status_code = 404
+        )
+        
+        # Two pointers and their schedule index entries, plus one index marker
+        # since both land in the same bucket (or two, when both workers write it
+        # before either has remembered it).
+        for i in range(6):
+            self.setup_boto3_stubber(
+                "s3",
+                "add_response",
+                "put_object",
+                {}
+            )
+        
+        sample_event = {
+            "invocations": [
+                {
+                    "function-name": "ScheduledFunction",
+                    "execution-time": 1476316800,
+                    "payload": {"index": 0}
+                },
+                {
+                    "function-name": "MissingFunction",
+                    "execution-time": 1476316800
+                },
+                {
+                    "function-name": "ScheduledFunction",
+                    "execution-time": "not-a-time"
+                },
+                {
+                    "function-name": "ScheduledFunction",
+                    "execution-time": 1476316860,
+                    "payload": "{\"index\": 3}"
+                }
+            ]
+        }
+        
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        handler_object._own_cloudformation_metadata = {
+            "SharedBucket": "lambda-scheduler-default-sharedbucket-ch7n9ibykc7g"
+        }
+        
+        self.lambda_function.queue_shard_count = 1
+        
+        try:
+            response = handler_object.handle_event(sample_event, generate_lambda_context())
+        finally:
+            self.lambda_function.queue_shard_count = self.lambda_function.keys.default_shard_count
+        
+        assert response["queued-count"] == 2
+        assert response["failed-count"] == 2
+        assert list(x["status"] for x in response["results"]) == ["queued", "failed", "failed", "queued"]
+        assert response["results"][1]["error"] == "Function \"MissingFunction\" not found."
+    
+    def test_function_arn_cache(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_client_error",
+            "get_function",
+            service_error_code = "ResourceNotFoundException",
+            http_status_code = 404
+        )
+        
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        
+        # Only the first lookup of each name should reach the (stubbed) API.
+        for i in range(3):
+            assert handler_object.get_function_arn("ScheduledFunction") == function_arn
+            
+            with self.assertRaises(Exception):
+                handler_object.get_function_arn("MissingFunction")
+        
+        stats = handler_object.function_arn_cache.stats()
+        assert stats["hits"] == 4
+        assert stats["misses"] == 2
+    
+    def test_function_arn_cache_eviction(self):
+        
+        cache = self.lambda_function.FunctionArnCache(60, 60, 2)
+        
+        cache.put("a", "arn-a")
+        cache.put("b", "arn-b")
+        cache.get("a")
+        cache.put("c", "arn-c")
+        
+        assert cache.get("a") == (True, "arn-a")
+        assert cache.get("b") == (False, None)
+        assert cache.get("c") == (True, "arn-c")
+        assert cache.stats()["evictions"] == 1
+        
+        expired_cache = self.lambda_function.FunctionArnCache(0, 0, 2)
+        expired_cache.put("a", "arn-a")
+        
+        assert expired_cache.get("a") == (False, None)
+    
+    def test_s3_bucket_name_from_environment(self):
+        
+        os.environ["SHARED_BUCKET"] = "lambda-scheduler-default-sharedbucket-ch7n9ibykc7g"
+        
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            
+            # No stubbed STS / IAM / CloudFormation responses are needed.
+            assert handler_object.get_s3_bucket_name() == os.environ["SHARED_BUCKET"]
+            assert not hasattr(handler_object, "_own_cloudformation_metadata")
+        finally:
+            del os.environ["SHARED_BUCKET"]
+    
+    def test_pointer_record_format(self):
+        
+        records = self.lambda_function.records
+        
+        context = generate_lambda_context()
+        
+        s3_pointer_content = {
+            "function-arn": "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction",
+            "payload": {"hello": "world"},
+            "aws-request-id": context.aws_request_id,
+            "queued-function": context.function_name,
+            "queued-timestamp": 1476316800,
+            "queued-log-group": context.log_group_name,
+            "queued-log-stream": context.log_stream_name
+        }
+        
+        # Version 1 records (as originally written) still decode.
+        assert records.decode_pointer_record(json.dumps(s3_pointer_content, indent=4).encode("utf-8")) == s3_pointer_content
+        
+        compact_body = records.encode_pointer_record(s3_pointer_content)
+        assert len(compact_body) < len(json.dumps(s3_pointer_content, indent=4))
+        assert records.decode_pointer_record(compact_body) == s3_pointer_content
+        
+        s3_pointer_content["payload"] = {"items": list(range(2000))}
+        
+        compressed_body = records.encode_pointer_record(s3_pointer_content)
+        assert compressed_body[:2] == records.gzip_magic_bytes
+        assert records.decode_pointer_record(compressed_body) == s3_pointer_content
+    
+    def test_batch_invocations_segment_mode(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        # One schedule index entry (and minute reference), segment and index marker for the whole batch.
+        for i in range(4):
+            self.setup_boto3_stubber(
+                "s3",
+                "add_response",
+                "put_object",
+                {}
+            )
+        
+        sample_event = {
+            "invocations": list({
+                "function-name": "ScheduledFunction",
+                "execution-time": 1476316800 + i,
+                "payload": {"index": i}
+            } for i in range(50))
+        }
+        
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        handler_object._own_cloudformation_metadata = {
+            "SharedBucket": "lambda-scheduler-default-sharedbucket-ch7n9ibykc7g"
+        }
+        
+        self.lambda_function.segment_mode = True
+        
+        try:
+            response = handler_object.handle_event(sample_event, generate_lambda_context())
+        finally:
+            self.lambda_function.segment_mode = False
+        
+        assert response["queued-count"] == 50
+        assert response["failed-count"] == 0
+    
+    def test_segment_format(self):
+        
+        segments = self.lambda_function.segments
+        
+        segment_records = list({
+            "function-arn": "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction",
+            "payload": {"index": i, "padding": "x" * 100},
+            "execution-time": "2016-10-13T00:00:{:02d}Z".format(59 - i),
+            "pointer-id": "{}".format(i)
+        } for i in range(60))
+        
+        # Large enough to be gzipped, and read back in chunks smaller than a record.
+        body = segments.encode_segment(segment_records)
+        assert body[:2] == self.lambda_function.records.gzip_magic_bytes
+        
+        fileobj = io.BytesIO(body)
+        decoded_records = list(segments.iter_segment_lines(fileobj, chunk_size=7))
+        assert len(decoded_records) == 61
+        
+        decoded_records = list(segments.iter_segment_records(io.BytesIO(body)))
+        
+        assert decoded_records[0]["record-count"] == 60
+        assert decoded_records[0]["first-execution-time"] == "2016-10-13T00:00:00Z"
+        assert list(x["pointer-id"] for x in decoded_records[1:]) == list("{}".format(59 - i) for i in range(60))
+        
+        # A writer counts records as they're written, and writes the lines it counted.
+        written_segments = []
+        record_size = len(self.lambda_function.records.serialize_pointer_record(segment_records[0])) + 1
+        segment_writer = segments.SegmentWriter(lambda *x: written_segments.append(segments.serialize_segment(*x[1:])), 1000, record_size * 10)
+        
+        full_buffers = []
+        for each_record in segment_records[:10]:
+            full_buffers.extend(segment_writer.add("2016-10-13T00:00Z", each_record, lambda error: None))
+        
+        assert len(full_buffers) == 1
+        
+        segment_writer.flush(full_buffers=full_buffers)
+        assert written_segments == [segments.serialize_segment(segment_records[:10])]
+    
+    def test_phase_timing_metrics(self):
+        
+        metrics = self.lambda_function.metrics
+        
+        phase_timer = metrics.PhaseTimer()
+        
+        with phase_timer.phase("Validation"):
+            with phase_timer.phase("ArnResolution"):
+                pass
+        
+        phase_timer.count("PayloadBytes", 128)
+        
+        assert set(phase_timer.durations.keys()) == set(["Validation", "ArnResolution"])
+        
+        log_line = json.loads(metrics.embedded_metric_log_line(
+            {"FunctionName": "InvocationQueuerFunction"},
+            phase_timer,
+            {"ColdStart": True},
+            {"PayloadBytes": "Bytes"}
+        ))
+        
+        metric_definitions = log_line["_aws"]["CloudWatchMetrics"][0]
+        
+        assert metric_definitions["Dimensions"] == [["FunctionName"]]
+        assert set(x["Name"] for x in metric_definitions["Metrics"]) == set(["ValidationTime", "ArnResolutionTime", "TotalTime", "PayloadBytes"])
+        assert {"Name": "PayloadBytes", "Unit": "Bytes"} in metric_definitions["Metrics"]
+        assert log_line["PayloadBytes"] == 128
+        assert log_line["ColdStart"] is True
+        
+        # Nested time is charged to the inner phase only.
+        assert log_line["ValidationTime"] + log_line["ArnResolutionTime"] <= log_line["TotalTime"]
+    
+    def test_event_logging(self):
+        
+        event_logs = self.lambda_function.event_logs
+        
+        sample_event = {
+            "function-name": "ScheduledFunction",
+            "execution-time": 1476316800,
+            "payload": {"message": "x" * 5000}
+        }
+        
+        def logged_lines(event_logger, log):
+            original_stdout = sys.stdout
+            sys.stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+            try:
+                log(event_logger)
+                return sys.stdout.getvalue().splitlines()
+            finally:
+                sys.stdout = original_stdout
+        
+        # Not sampled: a summary, without the payload.
+        lines = logged_lines(
+            event_logs.EventLogger("INFO", 0.5, 100, random_source=lambda: 0.9),
+            lambda x: x.log_event("Received event", sample_event)
+        )
+        assert len(lines) == 1
+        assert lines[0].startswith("[INFO] Received event (summary): ")
+        assert "xxxx" not in lines[0]
+        
+        # Sampled: the event, with its payload truncated and hashed.
+        lines = logged_lines(
+            event_logs.EventLogger("INFO", 0.5, 100, random_source=lambda: 0.1),
+            lambda x: x.log_event("Received event", sample_event)
+        )
+        logged_event = json.loads(lines[0].split(": ", 1)[1])
+        assert logged_event["execution-time"] == 1476316800
+        assert len(logged_event["payload"]["truncated"]) == 100
+        assert logged_event["payload"]["bytes"] == len(json.dumps(sample_event["payload"], separators=(",", ":")))
+        assert len(logged_event["payload"]["sha256"]) == 64
+        
+        # Errors log the complete event, whatever the level and sampling.
+        lines = logged_lines(
+            event_logs.EventLogger("ERROR", 0, 100),
+            lambda x: (x.log_event("Received event", sample_event), x.log_error_event("Unable to queue event", sample_event, Exception("Failed")))
+        )
+        assert len(lines) == 1
+        assert lines[0].startswith("[ERROR] Unable to queue event: Failed. Event: ")
+        assert json.loads(lines[0].split(". Event: ", 1)[1]) == sample_event
+    
+    def test_bulk_import(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+        
+        source_lines = list(json.dumps({
+            "function-name": "ScheduledFunction",
+            "execution-time": 1476316800 + i,
+            "payload": {"index": i}
+        }) for i in range(4))
+        source_lines.insert(2, "{not json")
+        
+        handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+        handler_object._own_cloudformation_metadata = {
+            "SharedBucket": "lambda-scheduler-default-sharedbucket-ch7n9ibykc7g"
+        }
+        
+        self.lambda_function.bulk_import_batch_size = 2
+        self.lambda_function.bulk_import_reserved_millis = 10000
+        
+        try:
+            handler_object.get_storage().put_object("imports/schedules.ndjson", "\n".join(source_lines) + "\n\n")
+            
+            # Out of time after the first batch.
+            response = handler_object.handle_event({
+                "bulk-import": {
+                    "source": "imports/schedules.ndjson"
+                }
+            }, generate_lambda_context())
+            
+            assert response["complete"] is False
+            assert response["imported-count"] == 2
+            
+            self.lambda_function.bulk_import_reserved_millis = 0
+            
+            response = handler_object.handle_event({
+                "bulk-import": {
+                    "source": "imports/schedules.ndjson",
+                    "import-id": response["import-id"]
+                }
+            }, generate_lambda_context())
+            
+            assert response["complete"] is True
+            assert response["imported-count"] == 4
+            assert response["failed-count"] == 1
+            assert response["errors"][0]["line-number"] == 3
+            
+            pointer_keys = list(handler_object.get_storage().list_keys("queued/"))
+            assert len(pointer_keys) == 4
+            assert all("{}-".format(response["import-id"]) in x for x in pointer_keys)
+            
+            # An interrupted batch is bucketed as it was the first time.
+            self.lambda_function.bulk_import_batch_size = 1000
+            handler_object.get_storage().put_object(self.lambda_function.bulk_import.checkpoint_key("interrupted"), json.dumps({
+                "checkpoint-format-version": 1,
+                "import-id": "interrupted",
+                "source": "s3://lambda-scheduler-default-sharedbucket-ch7n9ibykc7g/imports/schedules.ndjson",
+                "offset": 0,
+                "line-count": 0,
+                "imported-count": 0,
+                "failed-count": 0,
+                "errors": [],
+                "batch-started": 1476316800 + 3600,
+                "complete": False
+            }).encode("utf-8"))
+            
+            response = handler_object.handle_event({
+                "bulk-import": {
+                    "source": "s3://lambda-scheduler-default-sharedbucket-ch7n9ibykc7g/imports/schedules.ndjson",
+                    "import-id": "interrupted"
+                }
+            }, generate_lambda_context())
+            
+            assert response["imported-count"] == 4
+            
+            pointer_keys = list(handler_object.get_storage().list_keys("queued/"))
+            interrupted_pointer_keys = list(x for x in pointer_keys if "/interrupted-" in x)
+            assert len(interrupted_pointer_keys) == 4
+            assert all(x.split("/")[2] == "2016-10-13T00:59Z" for x in interrupted_pointer_keys)
+            
+            # Sources the queuer can't read are refused before anything is imported.
+            for each_source in ["s3://another-bucket/imports/schedules.ndjson", "schedules.ndjson", "queued/schedules.ndjson"]:
+                with self.assertRaises(Exception) as raised:
+                    handler_object.handle_event({
+                        "bulk-import": {
+                            "source": each_source
+                        }
+                    }, generate_lambda_context())
+                
+                assert "Import source" in "{}".format(raised.exception)
+            
+            assert len(list(handler_object.get_storage().list_keys("imports/"))) == 3
+        finally:
+            self.lambda_function.bulk_import_batch_size = 1000
+            self.lambda_function.bulk_import_reserved_millis = 30000
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+    
+    def test_recurring_schedule(self):
+        
+        recurrence = self.lambda_function.recurrence
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        
+        # 2016-10-13 is a Thursday.
+        weekday_mornings = recurrence.parse_schedule_expression("cron(30 9 ? * MON-FRI *)", 0)
+        assert weekday_mornings.next_occurrence(1476316800) == 1476351000
+        assert weekday_mornings.next_occurrence(1476351000) == 1476437400
+        assert weekday_mornings.next_occurrence(1476437400) == 1476696600
+        
+        every_five_minutes = recurrence.parse_schedule_expression("rate(5 minutes)", 1476316800)
+        assert every_five_minutes.next_occurrence(0) == 1476316800
+        assert every_five_minutes.next_occurrence(1476316800) == 1476317100
+        
+        for each_invalid_expression in ["rate(0 minutes)", "cron(61 * * * ? *)", "cron(* * * *)", "every 5 minutes"]:
+            with self.assertRaises(Exception):
+                recurrence.parse_schedule_expression(each_invalid_expression, 0)
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+        
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+            
+            response = handler_object.handle_event({
+                "function-name": "ScheduledFunction",
+                "schedule-expression": "rate(5 minutes)",
+                "payload": {"hello": "world"}
+            }, generate_lambda_context())
+            
+            schedule_id = response["schedule-id"]
+            
+            # Only the occurrences within the horizon are written.
+            pointer_keys = list(local_storage.list_keys("queued/"))
+            assert len(pointer_keys) == self.lambda_function.recurrence_horizon_seconds // 300 + 1
+            assert len(list(local_storage.list_keys(recurrence.expansion_prefix))) == 1
+            
+            response = handler_object.handle_event({
+                "update-schedule": schedule_id,
+                "payload": {"hello": "again"}
+            }, generate_lambda_context())
+            
+            series = handler_object.get_recurrence_expander().load_series(schedule_id)
+            assert series["version"] == 2
+            assert series["payload"] == {"hello": "again"}
+            assert series["function-arn"] == function_arn
+            
+            response = handler_object.handle_event({
+                "cancel-schedule": schedule_id
+            }, generate_lambda_context())
+            
+            assert local_storage.get_object_if_exists(recurrence.series_key(schedule_id)) is None
+            
+            with self.assertRaises(Exception):
+                handler_object.handle_event({
+                    "cancel-schedule": schedule_id
+                }, generate_lambda_context())
+        finally:
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+    
+    def test_schedule_index(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        schedule_index = self.lambda_function.schedule_index
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+        
+        execution_time = int(time.time()) + 3600
+        
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+            
+            schedule_id = handler_object.handle_event({
+                "function-name": "ScheduledFunction",
+                "execution-time": execution_time,
+                "payload": {"hello": "world"},
+                "dispatch-limits": {"max-concurrency": "5", "rate-per-second": 20},
+                "max-staleness-seconds": "600"
+            }, generate_lambda_context())["schedule-id"]
+            
+            response = handler_object.handle_event({"get-schedule": schedule_id}, generate_lambda_context())
+            assert response["type"] == "one-time"
+            assert response["payload"] == {"hello": "world"}
+            assert response["dispatch-limits"] == {"max-concurrency": 5, "rate-per-second": 20.0}
+            assert response["max-staleness-seconds"] == 600
+            
+            for each_invalid_parameters in [{"dispatch-limits": {"rate-per-second": 0}}, {"max-staleness-seconds": "soon"}]:
+                with self.assertRaises(Exception):
+                    each_event = {
+                        "function-name": "ScheduledFunction",
+                        "execution-time": execution_time
+                    }
+                    each_event.update(each_invalid_parameters)
+                    
+                    handler_object.handle_event(each_event, generate_lambda_context())
+            
+            response = handler_object.handle_event({
+                "reschedule-schedule": schedule_id,
+                "execution-time": execution_time + 60
+            }, generate_lambda_context())
+            
+            pointer_keys = list(local_storage.list_keys("queued/"))
+            assert len(pointer_keys) == 1
+            assert pointer_keys[0].endswith("/{}/{}.json".format(response["execution-time"], schedule_id))
+            
+            handler_object.handle_event({"cancel-schedule": schedule_id}, generate_lambda_context())
+            
+            assert len(list(local_storage.list_keys("queued/"))) == 0
+            assert len(list(local_storage.list_keys(schedule_index.index_prefix))) == 0
+            
+            with self.assertRaises(Exception):
+                handler_object.handle_event({"get-schedule": schedule_id}, generate_lambda_context())
+            
+            # Records written as segments are found through their request's entry.
+            self.lambda_function.segment_mode = True
+            
+            try:
+                results = handler_object.handle_event({
+                    "invocations": list({
+                        "function-name": "ScheduledFunction",
+                        "execution-time": execution_time + i,
+                        "payload": {"index": i}
+                    } for i in range(3))
+                }, generate_lambda_context())["results"]
+            finally:
+                self.lambda_function.segment_mode = False
+            
+            response = handler_object.handle_event({"get-schedule": results[1]["schedule-id"]}, generate_lambda_context())
+            assert response["payload"] == {"index": 1}
+            
+            handler_object.handle_event({"cancel-schedule": results[1]["schedule-id"]}, generate_lambda_context())
+            
+            assert len(list(local_storage.list_keys(schedule_index.cancellation_prefix))) == 1
+            
+            with self.assertRaises(Exception):
+                handler_object.handle_event({"get-schedule": results[1]["schedule-id"]}, generate_lambda_context())
+            
+            # Once their minute is dispatched and settled, they're neither found nor cancelled.
+            local_storage.delete_objects(list(local_storage.list_keys("queued/")) + list(local_storage.list_keys("index/")) + list(local_storage.list_keys(schedule_index.cancellation_prefix)))
+            
+            for each_operation in ["get-schedule", "cancel-schedule"]:
+                with self.assertRaises(Exception):
+                    handler_object.handle_event({each_operation: results[0]["schedule-id"]}, generate_lambda_context())
+            
+            assert len(list(local_storage.list_keys(schedule_index.cancellation_prefix))) == 0
+            
+            for each_reference_key in list(local_storage.list_keys(schedule_index.minute_reference_prefix)):
+                handler_object.get_schedule_index().settle_minute(each_reference_key.split("/")[-2])
+            
+            assert len(list(local_storage.list_keys(schedule_index.index_prefix))) == 0
+            
+            # Cancelling releases a stored payload's reference, whether written as a pointer or in a segment.
+            payloads = self.lambda_function.payloads
+            original_payload_store_threshold_bytes = self.lambda_function.payload_store_threshold_bytes
+            self.lambda_function.payload_store_threshold_bytes = 0
+            del handler_object._payload_store
+            
+            try:
+                for each_segment_mode in [False, True]:
+                    self.lambda_function.segment_mode = each_segment_mode
+                    
+                    each_schedule_id = handler_object.handle_event({
+                        "invocations": [{
+                            "function-name": "ScheduledFunction",
+                            "execution-time": execution_time,
+                            "payload": {"segment-mode": each_segment_mode}
+                        }]
+                    }, generate_lambda_context())["results"][0]["schedule-id"]
+                    
+                    assert any(x.endswith("/{}".format(each_schedule_id)) for x in local_storage.list_keys(payloads.reference_prefix))
+                    
+                    handler_object.handle_event({"cancel-schedule": each_schedule_id}, generate_lambda_context())
+                    
+                    assert not any(x.endswith("/{}".format(each_schedule_id)) for x in local_storage.list_keys(payloads.reference_prefix))
+                
+                assert len(list(local_storage.list_keys(payloads.release_prefix))) > 0
+            finally:
+                self.lambda_function.segment_mode = False
+                self.lambda_function.payload_store_threshold_bytes = original_payload_store_threshold_bytes
+        finally:
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+    
+    def test_idempotency_keys(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        idempotency = self.lambda_function.idempotency
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+        
+        event = {
+            "function-name": "ScheduledFunction",
+            "execution-time": int(time.time()) + 3600,
+            "payload": {"hello": "world"},
+            "idempotency-key": "job-1"
+        }
+        
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+            
+            response = handler_object.handle_event(event, generate_lambda_context())
+            assert response["schedule-id"] == idempotency.schedule_id("job-1")
+            assert "duplicate" not in response
+            
+            # A retry is answered from the warm container's memo.
+            response = handler_object.handle_event(event, generate_lambda_context())
+            assert response["duplicate"]
+            assert handler_object.get_idempotency_store().memo_hits == 1
+            
+            # And from the stored record by a cold one.
+            cold_handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            cold_handler_object.function_arn_cache.put("ScheduledFunction", function_arn)
+            response = cold_handler_object.handle_event(event, generate_lambda_context())
+            assert response["duplicate"]
+            assert response["schedule-id"] == idempotency.schedule_id("job-1")
+            
+            assert len(list(local_storage.list_keys("queued/"))) == 1
+            assert len(list(local_storage.list_keys(idempotency.record_prefix))) == 1
+            
+            with self.assertRaises(Exception):
+                handler_object.handle_event(dict(event, payload={"hello": "there"}), generate_lambda_context())
+            
+            # In a batch, keys already recorded or repeated are queued once.
+            response = handler_object.handle_event({
+                "invocations": [
+                    event,
+                    dict(event, **{"idempotency-key": "job-2"}),
+                    dict(event, **{"idempotency-key": "job-2"}),
+                    dict(event, **{"idempotency-key": "job-2", "payload": {}}),
+                    dict((x, y) for x, y in event.items() if x != "idempotency-key")
+                ]
+            }, generate_lambda_context())
+            
+            assert list(x["status"] for x in response["results"]) == ["queued", "queued", "queued", "failed", "queued"]
+            assert list(x.get("duplicate", False) for x in response["results"]) == [True, False, True, False, False]
+            assert response["results"][2]["schedule-id"] == idempotency.schedule_id("job-2")
+            
+            assert len(list(local_storage.list_keys("queued/"))) == 3
+            assert len(list(local_storage.list_keys(idempotency.record_prefix))) == 2
+            
+            # In segment mode too, even when the key's record was never written.
+            self.lambda_function.segment_mode = True
+            
+            try:
+                for each_attempt in range(2):
+                    local_storage.delete_objects(list(local_storage.list_keys(idempotency.record_key("job-3"))))
+                    
+                    cold_handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+                    cold_handler_object.function_arn_cache.put("ScheduledFunction", function_arn)
+                    
+                    response = cold_handler_object.handle_event({
+                        "invocations": [dict(event, **{"idempotency-key": "job-3"})]
+                    }, generate_lambda_context())
+                    
+                    assert response["results"][0]["schedule-id"] == idempotency.schedule_id("job-3")
+            finally:
+                self.lambda_function.segment_mode = False
+            
+            assert len(list(x for x in local_storage.list_keys("queued/") if idempotency.schedule_id("job-3") in x)) == 1
+            assert len(list(x for x in local_storage.list_keys("queued/") if x.endswith(".seg"))) == 0
+        finally:
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
+    
+    def test_near_term_fast_path(self):
+        
+        function_arn = "arn:aws:lambda:us-east-1:000000000000:function:ScheduledFunction"
+        keys = self.lambda_function.keys
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "get_function",
+            {
+                "Configuration": {
+                    "FunctionArn": function_arn
+                }
+            },
+            {
+                "FunctionName": "ScheduledFunction"
+            }
+        )
+        
+        for _ in range(2):
+            self.setup_boto3_stubber(
+                "lambda",
+                "add_response",
+                "invoke",
+                {
+                    "StatusCode": 202
+                },
+                {
+                    "FunctionName": function_arn,
+                    "InvocationType": "Event",
+                    "Payload": json.dumps({"hello": "world"})
+                }
+            )
+        
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_client_error",
+            "invoke",
+            "TooManyRequestsException"
+        )
+        
+        root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = root_dir
+        
+        # Test contexts have less time left than a real invocation would.
+        original_near_term_reserved_millis = self.lambda_function.near_term_reserved_millis
+        self.lambda_function.near_term_reserved_millis = 1000
+        
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            local_storage = handler_object.get_storage()
+            
+            def queue_invocation(lead_seconds, **event_fields):
+                event = {
+                    "function-name": "ScheduledFunction",
+                    "execution-time": int(time.time()) + lead_seconds,
+                    "payload": {"hello": "world"}
+                }
+                event.update(event_fields)
+                
+                return handler_object.handle_event(event, generate_lambda_context())
+            
+            # Past due: invoked straight away, and its pointer settled.
+            response = queue_invocation(-5)
+            assert response["dispatch-path"] == "immediate"
+            assert handler_object.metric_properties["DispatchPath"] == "immediate"
+            
+            # Due in a moment: held until then.
+            started = time.time()
+            response = queue_invocation(2)
+            assert response["dispatch-path"] == "held"
+            assert time.time() - started >= 1
+            
+            assert len(list(local_storage.list_keys(keys.queued_prefix))) == 0
+            assert len(list(local_storage.list_keys(keys.dispatched_prefix))) == 2
+            
+            # Unable to invoke: left to the dispatcher once its claim runs out.
+            response = queue_invocation(-5)
+            assert response["dispatch-path"] == "queued"
+            
+            pointer_keys = list(local_storage.list_keys(keys.queued_prefix))
+            assert len(pointer_keys) == 1
+            assert self.lambda_function.records.decode_pointer_record(local_storage.get_object(pointer_keys[0]))["claimed-until"] > time.time()
+            
+            # Further ahead than the threshold: queued as usual.
+            response = queue_invocation(3600)
+            assert response["dispatch-path"] == "queued"
+            assert len(list(local_storage.list_keys(keys.queued_prefix))) == 2
+            
+            # Left to the dispatcher to enforce its limits: past its staleness limit, or rate-limited.
+            response = queue_invocation(-3600, **{"max-staleness-seconds": 600})
+            assert response["dispatch-path"] == "queued"
+            
+            response = queue_invocation(-5, **{"dispatch-limits": {"rate-per-second": 1}})
+            assert response["dispatch-path"] == "queued"
+            
+            original_dispatch_target_limits = self.lambda_function.dispatch_target_limits
+            self.lambda_function.dispatch_target_limits = {"ScheduledFunction": {"max-concurrency": 1}}
+            
+            try:
+                response = queue_invocation(-5)
+                assert response["dispatch-path"] == "queued"
+            finally:
+                self.lambda_function.dispatch_target_limits = original_dispatch_target_limits
+            
+            assert len(list(local_storage.list_keys(keys.queued_prefix))) == 5
+        finally:
+            self.lambda_function.near_term_reserved_millis = original_near_term_reserved_millis
+            del os.environ["STORAGE_BACKEND"]
+            del os.environ["LOCAL_STORAGE_DIR"]
+            shutil.rmtree(root_dir)
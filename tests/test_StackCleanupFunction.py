@@ -0,0 +1,205 @@
+from __future__ import print_function
+
+import sys, os, json, time, shutil, tempfile, unittest
+from local_helpers import LambdaFunctionTestCase, LambdaContext, generate_lambda_context
+
+class Test(LambdaFunctionTestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(Test, self).__init__(*args, **kwargs)
+        self.function_name = "StackCleanupFunction"
+
+    def setUp(self):
+        super(Test, self).setUp()
+        self.root_dir = tempfile.mkdtemp()
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_DIR"] = self.root_dir
+        os.environ["SHARED_BUCKET"] = "lambda-scheduler-default-sharedbucket-ch7n9ibykc7g"
+
+        # Test contexts have less time left than a real invocation would.
+        self.original_purge_reserved_millis = self.lambda_function.purge_reserved_millis
+        self.lambda_function.purge_reserved_millis = 1000
+
+    def tearDown(self):
+        self.lambda_function.purge_reserved_millis = self.original_purge_reserved_millis
+        del os.environ["STORAGE_BACKEND"]
+        del os.environ["LOCAL_STORAGE_DIR"]
+        del os.environ["SHARED_BUCKET"]
+        shutil.rmtree(self.root_dir)
+        super(Test, self).tearDown()
+
+    def test_purge(self):
+
+        storage = self.lambda_function.storage
+        purge = self.lambda_function.purge
+        local_storage = storage.LocalStorageBackend(self.root_dir)
+
+        object_keys = ["cf-stack-template.yaml", "lambda/InvocationQueuerFunction.zip"]
+
+        for each_shard in ["0a", "0b"]:
+            for each_minute in ["2016-10-13T00:00Z", "2016-10-13T00:01Z"]:
+                object_keys.append("index/{}/{}".format(each_minute, each_shard))
+                object_keys.extend("queued/{}/{}/{}/{}.json".format(each_shard, each_minute, each_minute[:-1] + ":00Z", i) for i in range(5))
+
+        for each_key in object_keys:
+            local_storage.put_object(each_key, b"{}")
+
+        class FlakyStorageBackend(storage.LocalStorageBackend):
+
+            '''
+                Fails to delete each queued/ key the first time it's asked to.
+            '''
+
+            failed_keys = set()
+
+            def try_delete_objects(self, keys):
+                failing_keys = list(x for x in keys if x.startswith("queued/") and x not in self.failed_keys)
+                self.failed_keys.update(failing_keys)
+                failures = super(FlakyStorageBackend, self).try_delete_objects(x for x in keys if x not in failing_keys)
+                return failures + list((x, "SlowDown") for x in failing_keys)
+
+        flaky_storage = FlakyStorageBackend(self.root_dir)
+
+        with self.lambda_function.ThreadPoolExecutor(max_workers=4) as executor:
+            result = purge.Purger(flaky_storage, batch_size=3, retry_delay_seconds=0).purge([""], executor)
+
+        assert result["complete"]
+        assert result["deleted-count"] == len(object_keys)
+        assert result["failed-count"] == 0
+        assert len(flaky_storage.failed_keys) == 20
+        assert len(list(local_storage.list_keys(""))) == 0
+
+    def test_retention_sweep(self):
+
+        storage = self.lambda_function.storage
+        local_storage = storage.LocalStorageBackend(self.root_dir)
+
+        now = int(time.time())
+        old_minute = time.strftime("%Y-%m-%dT%H:%MZ", time.gmtime(now - 40 * 24 * 60 * 60))
+        recent_minute = time.strftime("%Y-%m-%dT%H:%MZ", time.gmtime(now - 24 * 60 * 60))
+
+        old_keys = [
+            "dispatched/0a/{}/{}:00Z/old.json".format(old_minute, old_minute[:-1]),
+            "failed/0b/{}/{}:00Z/old.seg".format(old_minute, old_minute[:-1]),
+            "dispatched/{}:00Z/legacy.json".format(old_minute[:-1])
+        ]
+
+        kept_keys = [
+            "dispatched/0a/{}/{}:00Z/recent.json".format(recent_minute, recent_minute[:-1]),
+            "queued/0a/{}/{}:00Z/due.json".format(old_minute, old_minute[:-1])
+        ]
+
+        for each_key in old_keys + kept_keys:
+            local_storage.put_object(each_key, b"{}")
+
+        response = self.lambda_function.lambda_handler(
+            {
+                "retention-sweep": {
+                    "retention-days": 30
+                }
+            },
+            generate_lambda_context()
+        )
+
+        assert response["complete"]
+        assert response["deleted-count"] == len(old_keys)
+        assert sorted(local_storage.list_keys("")) == sorted(kept_keys)
+
+    def test_cleanup_continuation(self):
+
+        storage = self.lambda_function.storage
+        local_storage = storage.LocalStorageBackend(self.root_dir)
+
+        for i in range(5):
+            local_storage.put_object("queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/{}.json".format(i), b"{}")
+
+        cfn_responses = []
+        original_send_cfn_response = self.lambda_function.send_cfn_response
+        original_purger_class = self.lambda_function.purge.Purger
+        self.lambda_function.send_cfn_response = lambda event, context, status: cfn_responses.append(status)
+
+        self.setup_boto3_stubber(
+            "lambda",
+            "add_response",
+            "invoke",
+            {
+                "StatusCode": 202
+            }
+        )
+
+        event = {
+            "RequestType": "Delete",
+            "StackId": "arn:aws:cloudformation:us-east-1:000000000000:stack/lambda-scheduler-default/00000000-0000-0000-0000-000000000000",
+            "RequestId": "00000000-0000-0000-0000-000000000000",
+            "LogicalResourceId": "StackCleanupInvocation",
+            "ResponseURL": "https://localhost/",
+            "ResourceProperties": {
+                "SharedBucket": os.environ["SHARED_BUCKET"]
+            },
+            "purge-continuation": {
+                "count": 1,
+                "total-deleted-count": 10
+            }
+        }
+
+        class OutOfTimeContext(LambdaContext):
+            def get_remaining_time_in_millis(self):
+                return 0
+
+        try:
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+
+            # Out of time: the rest is handed on, and the stack kept waiting.
+            response = handler_object.handle_event(event, OutOfTimeContext())
+            assert not response["complete"]
+            assert response["total-deleted-count"] == 15
+            assert cfn_responses == []
+
+            local_storage.put_object("queued/0a/2016-10-13T00:00Z/2016-10-13T00:00:00Z/late.json", b"{}")
+
+            handler_object.handle_event(event, generate_lambda_context())
+            assert cfn_responses == ["SUCCESS"]
+            assert len(list(local_storage.list_keys(""))) == 0
+
+            def fail_cleanup(event, context):
+                raise Exception("Access Denied")
+
+            handler_object.handle_cleanup_event = fail_cleanup
+
+            self.setup_boto3_stubber(
+                "lambda",
+                "add_response",
+                "invoke",
+                {
+                    "StatusCode": 202
+                }
+            )
+            self.lambda_function.boto3_clients.clear()
+
+            # An error is retried by a continuation rather than reported as success.
+            response = handler_object.handle_event(event, generate_lambda_context())
+            assert not response["complete"]
+            assert response["total-deleted-count"] == 10
+            assert cfn_responses == ["SUCCESS"]
+
+            # And once the continuations have run out, the stack is told it failed.
+            event["purge-continuation"]["count"] = self.lambda_function.purge_max_continuations
+            handler_object.handle_event(event, generate_lambda_context())
+            assert cfn_responses == ["SUCCESS", "FAILED"]
+
+            class IncompletePurger(original_purger_class):
+                def purge(self, prefixes, executor, should_stop=lambda: False):
+                    result = super(IncompletePurger, self).purge(prefixes, executor, should_stop)
+                    result["failed-count"] = 1
+                    result["complete"] = False
+                    return result
+
+            self.lambda_function.purge.Purger = IncompletePurger
+
+            # Likewise a purge left incomplete on the last continuation.
+            handler_object = self.lambda_function.LambdaHandler(generate_lambda_context())
+            handler_object.handle_event(event, generate_lambda_context())
+            assert cfn_responses == ["SUCCESS", "FAILED", "FAILED"]
+        finally:
+            self.lambda_function.purge.Purger = original_purger_class
+            self.lambda_function.send_cfn_response = original_send_cfn_response